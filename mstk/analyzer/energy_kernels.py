@@ -6,65 +6,181 @@ def ew_dot(vec1, vec2):
     '''
     Element-wise dot product
     '''
-    return np.sum(vec1 * vec2, axis=1)
+    return np.sum(vec1 * vec2, axis=-1)
 
 
-class HarmonicBondKernel():
+def scatter_add(n_atom, *terms):
     '''
-    E = k (r-r0)^2
+    Sum up the forces acting on the atoms of all terms.
+
+    The forces are accumulated with one `np.bincount` for each component,
+    so that the cost is proportional to the number of terms instead of n_atom * n_term.
+    The forces of several frames can be accumulated at once by providing them with leading frame axes.
+
+    Parameters
+    ----------
+    n_atom : int
+    terms : tuple of (np.ndarray, np.ndarray)
+        The indexes of atoms in shape of (n_term,) and the forces acting on them in shape of (..., n_term, 3).
+
+    Returns
+    -------
+    forces : np.ndarray
+        The total forces acting on all atoms in shape of (..., n_atom, 3)
+    '''
+    indexes = np.concatenate([index for index, _ in terms])
+    values = np.concatenate([value for _, value in terms], axis=-2)
+    shape = values.shape[:-2]
+    n_frame = int(np.prod(shape))
+    values = values.reshape(n_frame, len(indexes), 3)
+    # the atoms in different frames are distinguished by offsetting their indexes
+    indexes = (indexes + n_atom * np.arange(n_frame)[:, np.newaxis]).ravel()
+    forces = np.empty((n_frame * n_atom, 3), dtype=np.float64)
+    for k in range(3):
+        forces[:, k] = np.bincount(indexes, weights=values[..., k].ravel(), minlength=n_frame * n_atom)
+    return forces.reshape(shape + (n_atom, 3))
+
+
+class EnergyKernel():
+    '''
+    Base class of the kernels for evaluating the energies and forces of bonded and nonbonded terms.
+
+    The indexes of atoms and the parameters of terms are processed once at construction.
+    The kernel can then be evaluated for the positions provided at construction,
+    or for any other configurations of the same atoms, including a stack of frames from a trajectory.
+
+    The method :func:`_evaluate` should be implemented by subclasses.
+    It works on a stack of frames in shape of (n_frame, n_atom, 3) with broadcast NumPy operations.
 
     Parameters
     ----------
     positions : list of list of float
     indexes : list of list of int
     parameters : list of list of float
+
+    Attributes
+    ----------
+    max_chunk_terms : int
+        Class attribute. When a stack of frames is evaluated, the frames are evaluated in chunks,
+        so that the number of frames in each chunk times the number of terms does not exceed this value.
+        It bounds the memory occupied by the intermediate arrays.
     '''
 
+    max_chunk_terms = 1024 * 1024
+
     def __init__(self, positions, indexes, parameters):
         self.positions = np.array(positions, dtype=np.float64)
         self.indexes = np.array(indexes, dtype=int)
+        self.parameters = np.array(parameters, dtype=np.float64)
+
+    def evaluate(self, positions=None, chunk_size=None):
+        '''
+        Evaluate the values (e.g. bond lengths, angles), energies and forces of all terms.
+
+        Parameters
+        ----------
+        positions : array_like, optional
+            The positions of atoms in shape of (n_atom, 3), or a stack of frames in shape of (n_frame, n_atom, 3).
+            If not set, the positions provided at construction will be used.
+        chunk_size : int, optional
+            The number of frames evaluated at once for a stack of frames.
+            If not set, it is determined from `max_chunk_terms`.
+
+        Returns
+        -------
+        values : np.ndarray
+            The values of all terms in shape of (n_term,), or (n_frame, n_term) for a stack of frames.
+        energy : np.ndarray
+            The energies of all terms in shape of (n_term,), or (n_frame, n_term) for a stack of frames.
+        forces : np.ndarray
+            The forces acting on all atoms in shape of (n_atom, 3), or (n_frame, n_atom, 3) for a stack of frames.
+        '''
+        positions = self.positions if positions is None else np.asarray(positions, dtype=np.float64)
+        if positions.ndim == 2:
+            values, energy, forces = self._evaluate(positions[np.newaxis])
+            return values[0], energy[0], forces[0]
+
+        n_frame, n_atom = positions.shape[:2]
+        n_term = len(self.indexes)
+        if chunk_size is None:
+            chunk_size = max(1, self.max_chunk_terms // max(1, n_term))
+        values = np.empty((n_frame, n_term), dtype=np.float64)
+        energy = np.empty((n_frame, n_term), dtype=np.float64)
+        forces = np.empty((n_frame, n_atom, 3), dtype=np.float64)
+        for start in range(0, n_frame, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            values[chunk], energy[chunk], forces[chunk] = self._evaluate(positions[chunk])
+        return values, energy, forces
+
+    def _evaluate(self, positions):
+        '''
+        Evaluate the values, energies and forces of all terms for a stack of frames.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            The positions in shape of (n_frame, n_atom, 3)
+
+        Returns
+        -------
+        values : np.ndarray
+            In shape of (n_frame, n_term)
+        energy : np.ndarray
+            In shape of (n_frame, n_term)
+        forces : np.ndarray
+            In shape of (n_frame, n_atom, 3)
+        '''
+        raise NotImplementedError('Method not implemented')
+
+
+class HarmonicBondKernel(EnergyKernel):
+    '''
+    E = k (r-r0)^2
+
+    Parameters
+    ----------
+    positions : list of list of float
+    indexes : list of list of int
+    parameters : list of list of float
+    '''
+
+    def __init__(self, positions, indexes, parameters):
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.r0 = self.parameters[:, 0]
         self.k = self.parameters[:, 1]
 
-    def evaluate(self):
-        delta = self.positions[self.a2] - self.positions[self.a1]
+    def _evaluate(self, positions):
+        delta = positions[:, self.a2] - positions[:, self.a1]
         rsq = ew_dot(delta, delta)
         r = np.sqrt(rsq)
         energy = self.k * (r - self.r0) ** 2
 
-        forces_a1 = (2 * self.k * (r - self.r0) / r)[:, np.newaxis] * delta
+        forces_a1 = (2 * self.k * (r - self.r0) / r)[..., np.newaxis] * delta
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] -= forces_a1[self.a2 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a2, -forces_a1))
 
         return r, energy, forces
 
 
-class HarmonicAngleKernel():
+class HarmonicAngleKernel(EnergyKernel):
     '''
     E = k (theta-theta0)^2
 
     '''
 
     def __init__(self, positions, indexes, parameters):
-        self.positions = np.array(positions, dtype=np.float64)
-        self.indexes = np.array(indexes, dtype=int)
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
         self.a3 = self.indexes[:, 2]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.theta0 = self.parameters[:, 0]
         self.k = self.parameters[:, 1]
 
-    def evaluate(self):
-        vec1 = self.positions[self.a1] - self.positions[self.a2]
-        vec2 = self.positions[self.a3] - self.positions[self.a2]
+    def _evaluate(self, positions):
+        vec1 = positions[:, self.a1] - positions[:, self.a2]
+        vec2 = positions[:, self.a3] - positions[:, self.a2]
         r1 = np.sqrt(ew_dot(vec1, vec1))
         r2 = np.sqrt(ew_dot(vec2, vec2))
         cos = ew_dot(vec1, vec2) / r1 / r2
@@ -80,49 +196,43 @@ class HarmonicAngleKernel():
         c12 = factor / r1 / r2
         c31 = -factor * cos / r2 / r2
 
-        forces_a1 = c11[:, np.newaxis] * vec1 + c12[:, np.newaxis] * vec2
-        forces_a3 = c31[:, np.newaxis] * vec2 + c12[:, np.newaxis] * vec1
+        forces_a1 = c11[..., np.newaxis] * vec1 + c12[..., np.newaxis] * vec2
+        forces_a3 = c31[..., np.newaxis] * vec2 + c12[..., np.newaxis] * vec1
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] += forces_a3[self.a3 == i].sum(axis=0)
-            forces[i] -= forces_a1[self.a2 == i].sum(axis=0) + forces_a3[self.a2 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a3, forces_a3),
+                             (self.a2, -forces_a1 - forces_a3))
 
         return theta, energy, forces
 
 
-class OplsTorsionKernel():
+class OplsTorsionKernel(EnergyKernel):
     '''
     E = k1 (1+cos(phi)) + k2 (1-cos(2 phi)) + k3 (1+cos(3 phi)) + k4 (1-cos(4 phi))
 
     '''
 
     def __init__(self, positions, indexes, parameters):
-        self.positions = np.array(positions, dtype=np.float64)
-        self.indexes = np.array(indexes, dtype=int)
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
         self.a3 = self.indexes[:, 2]
         self.a4 = self.indexes[:, 3]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.k1 = self.parameters[:, 0]
         self.k2 = self.parameters[:, 1]
         self.k3 = self.parameters[:, 2]
         self.k4 = self.parameters[:, 3]
 
-    def evaluate(self):
-        vec1 = self.positions[self.a1] - self.positions[self.a2]
-        vec2 = self.positions[self.a3] - self.positions[self.a2]
-        vec3 = self.positions[self.a3] - self.positions[self.a4]
+    def _evaluate(self, positions):
+        vec1 = positions[:, self.a1] - positions[:, self.a2]
+        vec2 = positions[:, self.a3] - positions[:, self.a2]
+        vec3 = positions[:, self.a3] - positions[:, self.a4]
         n1 = np.cross(vec1, vec2)
         n2 = np.cross(vec2, vec3)
         rsq_n1 = ew_dot(n1, n1)
         rsq_n2 = ew_dot(n2, n2)
         cos = ew_dot(n1, n2) / np.sqrt(rsq_n1 * rsq_n2)
         np.clip(cos, -1, 1, out=cos)
-        sign = np.ones(vec1.shape[0])
+        sign = np.ones(vec1.shape[:-1])
         sign[ew_dot(vec1, n2) < 0] = -1
         phi = sign * np.arccos(cos)
 
@@ -150,57 +260,50 @@ class OplsTorsionKernel():
         factor1 = factor * r2 / rsq_n1
         factor4 = -factor * r2 / rsq_n2
 
-        forces_a1 = factor1[:, np.newaxis] * n1
-        forces_a4 = factor4[:, np.newaxis] * n2
+        forces_a1 = factor1[..., np.newaxis] * n1
+        forces_a4 = factor4[..., np.newaxis] * n2
 
         factor2 = ew_dot(vec1, vec2) / rsq2
         factor3 = ew_dot(vec3, vec2) / rsq2
 
-        s = factor2[:, np.newaxis] * forces_a1 - factor3[:, np.newaxis] * forces_a4
+        s = factor2[..., np.newaxis] * forces_a1 - factor3[..., np.newaxis] * forces_a4
 
         forces_a2 = -forces_a1 + s
         forces_a3 = -forces_a4 - s
         ###
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] += forces_a2[self.a2 == i].sum(axis=0)
-            forces[i] += forces_a3[self.a3 == i].sum(axis=0)
-            forces[i] += forces_a4[self.a4 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a2, forces_a2),
+                             (self.a3, forces_a3), (self.a4, forces_a4))
 
         return phi, energy, forces
 
 
-class HarmonicTorsionKernel():
+class HarmonicTorsionKernel(EnergyKernel):
     '''
     E = k (phi-phi0)^2
 
     '''
 
     def __init__(self, positions, indexes, parameters):
-        self.positions = np.array(positions, dtype=np.float64)
-        self.indexes = np.array(indexes, dtype=int)
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
         self.a3 = self.indexes[:, 2]
         self.a4 = self.indexes[:, 3]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.phi0 = self.parameters[:, 0]
         self.k = self.parameters[:, 1]
 
-    def evaluate(self):
-        vec1 = self.positions[self.a1] - self.positions[self.a2]
-        vec2 = self.positions[self.a3] - self.positions[self.a2]
-        vec3 = self.positions[self.a3] - self.positions[self.a4]
+    def _evaluate(self, positions):
+        vec1 = positions[:, self.a1] - positions[:, self.a2]
+        vec2 = positions[:, self.a3] - positions[:, self.a2]
+        vec3 = positions[:, self.a3] - positions[:, self.a4]
         n1 = np.cross(vec1, vec2)
         n2 = np.cross(vec2, vec3)
         rsq_n1 = ew_dot(n1, n1)
         rsq_n2 = ew_dot(n2, n2)
         cos = ew_dot(n1, n2) / np.sqrt(rsq_n1 * rsq_n2)
         np.clip(cos, -1, 1, out=cos)
-        sign = np.ones(vec1.shape[0])
+        sign = np.ones(vec1.shape[:-1])
         sign[ew_dot(vec1, n2) < 0] = -1
         phi = sign * np.arccos(cos)
 
@@ -228,57 +331,50 @@ class HarmonicTorsionKernel():
         factor1 = factor * r2 / rsq_n1
         factor4 = -factor * r2 / rsq_n2
 
-        forces_a1 = factor1[:, np.newaxis] * n1
-        forces_a4 = factor4[:, np.newaxis] * n2
+        forces_a1 = factor1[..., np.newaxis] * n1
+        forces_a4 = factor4[..., np.newaxis] * n2
 
         factor2 = ew_dot(vec1, vec2) / rsq2
         factor3 = ew_dot(vec3, vec2) / rsq2
 
-        s = factor2[:, np.newaxis] * forces_a1 - factor3[:, np.newaxis] * forces_a4
+        s = factor2[..., np.newaxis] * forces_a1 - factor3[..., np.newaxis] * forces_a4
 
         forces_a2 = -forces_a1 + s
         forces_a3 = -forces_a4 - s
         ###
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] += forces_a2[self.a2 == i].sum(axis=0)
-            forces[i] += forces_a3[self.a3 == i].sum(axis=0)
-            forces[i] += forces_a4[self.a4 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a2, forces_a2),
+                             (self.a3, forces_a3), (self.a4, forces_a4))
 
         return phi, energy, forces
 
 
-class ConstrainedTorsionKernel():
+class ConstrainedTorsionKernel(EnergyKernel):
     '''
     E = k (1-cos(phi-phi0))
 
     '''
 
     def __init__(self, positions, indexes, parameters):
-        self.positions = np.array(positions, dtype=np.float64)
-        self.indexes = np.array(indexes, dtype=int)
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
         self.a3 = self.indexes[:, 2]
         self.a4 = self.indexes[:, 3]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.phi0 = self.parameters[:, 0]
         self.k = self.parameters[:, 1]
 
-    def evaluate(self):
-        vec1 = self.positions[self.a1] - self.positions[self.a2]
-        vec2 = self.positions[self.a3] - self.positions[self.a2]
-        vec3 = self.positions[self.a3] - self.positions[self.a4]
+    def _evaluate(self, positions):
+        vec1 = positions[:, self.a1] - positions[:, self.a2]
+        vec2 = positions[:, self.a3] - positions[:, self.a2]
+        vec3 = positions[:, self.a3] - positions[:, self.a4]
         n1 = np.cross(vec1, vec2)
         n2 = np.cross(vec2, vec3)
         rsq_n1 = ew_dot(n1, n1)
         rsq_n2 = ew_dot(n2, n2)
         cos = ew_dot(n1, n2) / np.sqrt(rsq_n1 * rsq_n2)
         np.clip(cos, -1, 1, out=cos)
-        sign = np.ones(vec1.shape[0])
+        sign = np.ones(vec1.shape[:-1])
         sign[ew_dot(vec1, n2) < 0] = -1
         phi = sign * np.arccos(cos)
 
@@ -295,47 +391,40 @@ class ConstrainedTorsionKernel():
         factor1 = factor * r2 / rsq_n1
         factor4 = -factor * r2 / rsq_n2
 
-        forces_a1 = factor1[:, np.newaxis] * n1
-        forces_a4 = factor4[:, np.newaxis] * n2
+        forces_a1 = factor1[..., np.newaxis] * n1
+        forces_a4 = factor4[..., np.newaxis] * n2
 
         factor2 = ew_dot(vec1, vec2) / rsq2
         factor3 = ew_dot(vec3, vec2) / rsq2
 
-        s = factor2[:, np.newaxis] * forces_a1 - factor3[:, np.newaxis] * forces_a4
+        s = factor2[..., np.newaxis] * forces_a1 - factor3[..., np.newaxis] * forces_a4
 
         forces_a2 = -forces_a1 + s
         forces_a3 = -forces_a4 - s
         ###
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] += forces_a2[self.a2 == i].sum(axis=0)
-            forces[i] += forces_a3[self.a3 == i].sum(axis=0)
-            forces[i] += forces_a4[self.a4 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a2, forces_a2),
+                             (self.a3, forces_a3), (self.a4, forces_a4))
 
         return phi, energy, forces
 
 
-class NonbondedKernel():
+class NonbondedKernel(EnergyKernel):
     '''
     E = 4 * eps*((sig/r)^12 - (sig/r)^6) + 138.935455 * qq/r
     '''
 
     def __init__(self, positions, indexes, parameters):
-        self.positions = np.array(positions, dtype=np.float64)
-        self.indexes = np.array(indexes, dtype=int)
+        super().__init__(positions, indexes, parameters)
         self.a1 = self.indexes[:, 0]
         self.a2 = self.indexes[:, 1]
-        self.parameters = np.array(parameters, dtype=np.float64)
         self.c12 = 4 * self.parameters[:, 0] * self.parameters[:, 1] ** 12
         self.c6 = 4 * self.parameters[:, 0] * self.parameters[:, 1] ** 6
         self.qq = self.parameters[:, 2]
         self.qqconv = constant.ONE_4PI_EPS0
 
-    def evaluate(self):
-        delta = self.positions[self.a2] - self.positions[self.a1]
+    def _evaluate(self, positions):
+        delta = positions[:, self.a2] - positions[:, self.a1]
         rsq = ew_dot(delta, delta)
         r = np.sqrt(rsq)
         r6 = r ** 6
@@ -344,12 +433,8 @@ class NonbondedKernel():
 
         forces_a1 = -(12 * self.c12 / r12 / rsq - 6 * self.c6 / r6 / rsq
                       + self.qqconv * self.qq / rsq / r) \
-            [:, np.newaxis] * delta
+            [..., np.newaxis] * delta
 
-        forces = np.zeros(self.positions.shape, dtype=np.float64)
-        # TODO vectorize this loop
-        for i in range(self.positions.shape[0]):
-            forces[i] += forces_a1[self.a1 == i].sum(axis=0)
-            forces[i] -= forces_a1[self.a2 == i].sum(axis=0)
+        forces = scatter_add(positions.shape[1], (self.a1, forces_a1), (self.a2, -forces_a1))
 
         return r, energy, forces
@@ -4,6 +4,17 @@ import numpy as np
 
 class NeighborList:
     '''
+    Cell list for finding the atoms close to each other in a rectangular periodic box.
+
+    The box is divided into cells with size no smaller than the cutoff.
+    When the cell list is built, the atoms are sorted by the index of the cell they belong to,
+    and the index of first atom and the number of atoms in each cell are recorded,
+    so that the atoms in a cell is a slice of the sorted atoms.
+    The 27 cells surrounding every cell are determined once at construction.
+    Therefore, building the cell list costs only one sort, no matter how many atoms there are.
+
+    All the pairs of atoms within a cutoff can be enumerated with :func:`get_pairs`.
+
     Parameters
     ----------
     box : np.ndarray of shape (3,)
@@ -15,23 +26,39 @@ class NeighborList:
     n_cell : np.ndarray of shape (3,)
     cell_size : np.ndarray of shape (3,)
     cell_indexes : list of tuple of int
+    max_chunk_pairs : int
+        Class attribute. The candidate pairs are processed in chunks in :func:`get_pairs`,
+        so that the number of candidate pairs in each chunk does not exceed this value.
+        It bounds the memory occupied by the intermediate arrays.
     '''
 
+    max_chunk_pairs = 4 * 1024 * 1024
+
     def __init__(self, box, cutoff):
+        box = np.array(box, dtype=float)
         if any(box / 3 < cutoff):
             raise Exception('Cutoff larger than box/3')
-        n = np.zeros(3, dtype=int)
-        for i in range(3):
-            while True:
-                if box[i] / (n[i] + 1) < cutoff:
-                    break
-                n[i] += 1
+        n = np.floor(box / cutoff).astype(int)
 
         self.box = box
         self.n_cell = n
         self.cell_indexes = list(itertools.product(range(n[0]), range(n[1]), range(n[2])))
         self.cell_size = box / n
-        self._cells = [[[[] for _ in range(n[2])] for _ in range(n[1])] for _ in range(n[0])]
+
+        # the flat index of the 27 cells surrounding each cell, in shape of (n_cell_total, 27)
+        cells = np.array(self.cell_indexes, dtype=int).reshape(-1, 1, 3)
+        shifts = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=int)
+        self._neighbors = self._get_flat_index((cells + shifts) % n)
+        # the cell itself and the 13 cells in the positive half shell, so that every pair of cells is visited once
+        half = [k for k, shift in enumerate(shifts) if tuple(shift) >= (0, 0, 0)]
+        self._half_neighbors = self._neighbors[:, half]
+
+        self._atoms = np.zeros(0, dtype=int)  # the index of atoms sorted by their cells
+        self._starts = np.zeros(len(self.cell_indexes), dtype=int)
+        self._counts = np.zeros(len(self.cell_indexes), dtype=int)
+
+    def _get_flat_index(self, index):
+        return (index[..., 0] * self.n_cell[1] + index[..., 1]) * self.n_cell[2] + index[..., 2]
 
     def build(self, positions):
         '''
@@ -41,8 +68,10 @@ class NeighborList:
         '''
         positions -= np.floor(positions / self.box) * self.box
         locations = np.clip(np.floor(positions / self.cell_size).astype(int), 0, self.n_cell - 1)
-        for i, (x, y, z) in enumerate(locations):
-            self._cells[x][y][z].append(i)
+        cells = self._get_flat_index(locations)
+        self._atoms = np.argsort(cells, kind='stable')
+        self._counts = np.bincount(cells, minlength=len(self.cell_indexes))
+        self._starts = np.cumsum(self._counts) - self._counts
 
     def get_cell(self, index):
         '''
@@ -52,9 +81,10 @@ class NeighborList:
 
         Returns
         -------
-        index_atoms : list of int
+        index_atoms : np.ndarray of int
         '''
-        return self._cells[index[0]][index[1]][index[2]]
+        i = self._get_flat_index(np.asarray(index))
+        return self._atoms[self._starts[i]:self._starts[i] + self._counts[i]]
 
     def get_interacting_cell(self, index):
         '''
@@ -66,17 +96,106 @@ class NeighborList:
 
         Returns
         -------
-        index_atoms : list of int
+        index_atoms : np.ndarray of int
         '''
-        idx_surround = [[], [], []]
-        for i in range(3):
-            idx = index[i]
-            idx_surround[i] = [idx - 1 if idx - 1 >= 0 else self.n_cell[i] - 1,
-                               idx,
-                               idx + 1 if idx + 1 <= self.n_cell[i] - 1 else 0
-                               ]
-        cell = []
-        for index in itertools.product(*idx_surround):
-            cell.extend(self.get_cell(index))
-
-        return cell
+        cells = self._neighbors[self._get_flat_index(np.asarray(index))]
+        counts = self._counts[cells]
+        # the position in sorted atoms of every atom in these cells
+        offsets = np.repeat(self._starts[cells] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return self._atoms[offsets]
+
+    def get_pairs(self, positions, cutoff, molecules=None, exclusions=None):
+        '''
+        Find all the pairs of atoms within the cutoff under minimum image convention.
+
+        The cell list is built from the positions.
+        The atoms in every cell are paired with the atoms in the same cell and in the 13 cells of the positive half shell,
+        so that every pair is considered only once.
+        The candidate pairs are processed in chunks with vectorized operations.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            The positions of atoms in shape of (n_atom, 3). It will not be modified.
+        cutoff : float
+            The cutoff should not be larger than the size of cells.
+        molecules : array_like of int, optional
+            The index of molecule each atom belongs to. If provided, the intramolecular pairs will be dropped.
+        exclusions : array_like of int, optional
+            The pairs of atoms to be dropped in shape of (n_pair, 2),
+            e.g. the 1-2 and 1-3 pairs from :func:`mstk.topology.Topology.get_12_13_14_pairs`.
+
+        Returns
+        -------
+        i : np.ndarray of int
+        j : np.ndarray of int
+            The indexes of atoms of all pairs. `i` is always smaller than `j`.
+        r : np.ndarray of float
+            The distances of all pairs
+        '''
+        if any(self.cell_size < cutoff):
+            raise Exception('Cutoff larger than the size of cells')
+
+        positions = np.array(positions, dtype=float)
+        n_atom = len(positions)
+        self.build(positions)
+
+        if molecules is not None:
+            molecules = np.asarray(molecules, dtype=int)
+        excluded = None
+        if exclusions is not None:
+            exclusions = np.asarray(exclusions, dtype=int).reshape(-1, 2)
+            # the excluded pairs are encoded as i*n_atom+j with i<j
+            excluded = np.unique(exclusions.min(axis=1) * n_atom + exclusions.max(axis=1))
+
+        # all pairs of cells to be visited and the number of candidate pairs of atoms in each pair of cells
+        cells1 = np.repeat(np.arange(len(self.cell_indexes)), self._half_neighbors.shape[1])
+        cells2 = self._half_neighbors.ravel()
+        counts1 = self._counts[cells1]
+        counts2 = self._counts[cells2]
+        n_candidates = counts1 * counts2
+        ends = np.cumsum(n_candidates)
+
+        i_list, j_list, r_list = [], [], []
+        start = 0
+        while start < len(cells1):
+            # at least one pair of cells is processed in each chunk
+            offset = ends[start] - n_candidates[start]
+            stop = max(start + 1, int(np.searchsorted(ends, offset + self.max_chunk_pairs, side='right')))
+            chunk = slice(start, stop)
+            start = stop
+
+            n = n_candidates[chunk]
+            k = np.repeat(np.arange(len(n)), n)
+            p = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            _counts2 = counts2[chunk][k]
+            a = p // _counts2
+            b = p % _counts2
+            same = cells1[chunk][k] == cells2[chunk][k]
+            if same.any():
+                # the pairs in the same cell are taken only once
+                keep = ~same | (a < b)
+                k, a, b = k[keep], a[keep], b[keep]
+            i = self._atoms[self._starts[cells1[chunk]][k] + a]
+            j = self._atoms[self._starts[cells2[chunk]][k] + b]
+
+            delta = positions[j] - positions[i]
+            delta -= np.round(delta / self.box) * self.box
+            rsq = np.sum(delta * delta, axis=-1)
+            within = rsq < cutoff * cutoff
+            i, j, rsq = i[within], j[within], rsq[within]
+            i, j = np.minimum(i, j), np.maximum(i, j)
+
+            if molecules is not None:
+                inter = molecules[i] != molecules[j]
+                i, j, rsq = i[inter], j[inter], rsq[inter]
+            if excluded is not None:
+                included = ~np.isin(i * n_atom + j, excluded)
+                i, j, rsq = i[included], j[included], rsq[included]
+
+            i_list.append(i)
+            j_list.append(j)
+            r_list.append(np.sqrt(rsq))
+
+        return (np.concatenate(i_list).astype(int), np.concatenate(j_list).astype(int),
+                np.concatenate(r_list).astype(float))
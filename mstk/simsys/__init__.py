@@ -2,4 +2,5 @@ from .system import System
 from .lmpexporter import LammpsExporter
 from .gmxexporter import GromacsExporter
 from .namdexporter import NamdExporter
-from .ommexporter import OpenMMExporter
\ No newline at end of file
+from .ommexporter import OpenMMExporter
+from .npengine import NumpyEngine
@@ -0,0 +1,288 @@
+import numpy as np
+from mstk.forcefield import *
+from mstk.chem.constant import *
+from mstk.analyzer.energy_kernels import (scatter_add, HarmonicBondKernel, HarmonicAngleKernel,
+                                          OplsTorsionKernel, HarmonicTorsionKernel, NonbondedKernel)
+from mstk.analyzer.neighborlist import NeighborList
+
+
+class NumpyEngine:
+    '''
+    NumpyEngine evaluates the energies and forces of a :class:`System` with NumPy only.
+
+    It is a reference implementation for single-point calculation and rescoring trajectories
+    when no simulation engine is available.
+    The topological elements are grouped by the class of their force field terms into contiguous index and parameter arrays,
+    which are evaluated by the kernels in :mod:`mstk.analyzer.energy_kernels`.
+    The energies and forces are reported per force group, in the same way as :func:`System.decompose_energy`.
+
+    The non-bonded interactions follow the settings of the force field.
+    1-2 and 1-3 pairs are excluded, and 1-4 pairs are scaled by `scale_14_vdw` and `scale_14_coulomb`.
+    If periodic boundary condition is used, the pairs within `vdw_cutoff` are found with a cell list,
+    vdW interactions are shifted or corrected for long range according to `vdw_long_range`,
+    and Coulomb interactions are truncated at the cutoff with reaction field,
+    like the `CutoffPeriodic` method of OpenMM. Ewald summation is not performed.
+    Otherwise, all pairs are considered without cutoff.
+
+    The bonded terms and 1-4 pairs are evaluated without periodic images,
+    therefore the molecules should not be broken by periodic boundaries.
+    Use :class:`mstk.trajectory.MakeWhole` to repair the molecules in a trajectory.
+    Only rectangular cell is supported.
+
+    Only LJ126Term, HarmonicBondTerm, HarmonicAngleTerm, OplsDihedralTerm, OplsImproperTerm and HarmonicImproperTerm
+    are supported. PeriodicDihedralTerm is supported if it can be converted to OplsDihedralTerm.
+    Drude particles and virtual sites are not supported.
+    Constrained bonds and angles do not contribute to the energy.
+
+    Parameters
+    ----------
+    system : System
+
+    Attributes
+    ----------
+    dielectric : float
+        Class attribute. The dielectric constant of the continuum outside the cutoff for reaction field.
+    '''
+
+    dielectric = 78.3
+
+    def __init__(self, system):
+        supported_terms = {LJ126Term, HarmonicBondTerm, HarmonicAngleTerm,
+                           OplsDihedralTerm, PeriodicDihedralTerm, OplsImproperTerm, HarmonicImproperTerm}
+        unsupported = system.ff.energy_term_classes - supported_terms
+        if unsupported != set():
+            raise Exception('Unsupported FF terms: %s' % (', '.join(map(lambda x: x.__name__, unsupported))))
+        if system.drude_pairs or system.vsite_pairs:
+            raise Exception('Drude particles and virtual sites are not supported')
+        if system.use_pbc and not system.topology.cell.is_rectangular:
+            raise Exception('Triclinic cell is not supported')
+
+        self._system = system
+        self.n_atom = system.topology.n_atom
+        self.positions = np.array(system.topology.positions, dtype=np.float64)
+        self.box = system.topology.cell.get_size() if system.use_pbc else None
+
+        self._kernels = {}  # {group: [EnergyKernel]}
+        self._setup_bonded()
+        self._setup_nonbonded()
+
+    def _add_kernel(self, group, Kernel, indexes, parameters):
+        if len(indexes) == 0:
+            return
+        self._kernels.setdefault(group, []).append(Kernel(self.positions, indexes, parameters))
+
+    def _setup_bonded(self):
+        system = self._system
+
+        indexes, parameters = [], []
+        for bond, bterm in system.bond_terms.items():
+            if bond in system.constrain_bonds:
+                continue
+            indexes.append((bond.atom1.id, bond.atom2.id))
+            parameters.append((bterm.length, bterm.k))
+        self._add_kernel('Bond', HarmonicBondKernel, indexes, parameters)
+
+        indexes, parameters = [], []
+        for angle, aterm in system.angle_terms.items():
+            if angle in system.constrain_angles:
+                continue
+            indexes.append((angle.atom1.id, angle.atom2.id, angle.atom3.id))
+            parameters.append((aterm.theta, aterm.k))
+        self._add_kernel('Angle', HarmonicAngleKernel, indexes, parameters)
+
+        indexes, parameters = [], []
+        for dihedral, dterm in system.dihedral_terms.items():
+            if type(dterm) is PeriodicDihedralTerm:
+                dterm = dterm.to_opls_term()
+            indexes.append((dihedral.atom1.id, dihedral.atom2.id, dihedral.atom3.id, dihedral.atom4.id))
+            parameters.append((dterm.k1, dterm.k2, dterm.k3, dterm.k4))
+        self._add_kernel('Dihedral', OplsTorsionKernel, indexes, parameters)
+
+        opls_indexes, opls_parameters = [], []
+        harmonic_indexes, harmonic_parameters = [], []
+        for improper, iterm in system.improper_terms.items():
+            if type(iterm) is OplsImproperTerm:
+                # in OPLS convention, the third atom is the central atom. k*(1-cos(2*phi)) is the k2 term of OPLS torsion
+                opls_indexes.append((improper.atom2.id, improper.atom3.id, improper.atom1.id, improper.atom4.id))
+                opls_parameters.append((0, iterm.k, 0, 0))
+            else:
+                harmonic_indexes.append((improper.atom1.id, improper.atom2.id, improper.atom3.id, improper.atom4.id))
+                harmonic_parameters.append((iterm.phi, iterm.k))
+        self._add_kernel('Improper', OplsTorsionKernel, opls_indexes, opls_parameters)
+        self._add_kernel('Improper', HarmonicTorsionKernel, harmonic_indexes, harmonic_parameters)
+
+    def _setup_nonbonded(self):
+        system = self._system
+        top = system.topology
+        ff = system.ff
+
+        # the vdW parameters of all pairs of atom types are tabulated, and every atom refers to its type
+        atom_types = list(ff.atom_types.values())
+        type_names = list(ff.atom_types.keys())
+        n_type = len(atom_types)
+        self._c12 = np.zeros((n_type, n_type))
+        self._c6 = np.zeros((n_type, n_type))
+        for i, atype1 in enumerate(atom_types):
+            for j, atype2 in enumerate(atom_types):
+                vdw = ff.get_vdw_term(atype1, atype2)
+                self._c12[i, j] = 4 * vdw.epsilon * vdw.sigma ** 12
+                self._c6[i, j] = 4 * vdw.epsilon * vdw.sigma ** 6
+        self._types = np.array([type_names.index(atom.type) for atom in top.atoms], dtype=int)
+        self._charges = np.array([atom.charge for atom in top.atoms], dtype=np.float64)
+
+        self.cutoff = ff.vdw_cutoff if system.use_pbc else None
+        self._vdw_shift = system.use_pbc and ff.vdw_long_range == ForceField.VDW_LONGRANGE_SHIFT
+        self._vdw_correct = system.use_pbc and ff.vdw_long_range == ForceField.VDW_LONGRANGE_CORRECT
+        if self._vdw_correct:
+            # the same averaging over pairs as CustomNonbondedForce of OpenMM, where self pairs are also counted
+            # E_lrc = 2*pi*N^2/V * sum_{i<=j} N_ij * int_rc^inf r^2 u_ij(r) dr / (N*(N+1)/2)
+            # N_ij = N_i*N_j for different types and N_i*(N_i+1)/2 for the same type
+            counts = np.bincount(self._types, minlength=n_type)
+            integral = self._c12 / (9 * self.cutoff ** 9) - self._c6 / (3 * self.cutoff ** 3)
+            n_pair = self.n_atom * (self.n_atom + 1) / 2
+            average = (counts @ integral @ counts + counts @ np.diag(integral)) / 2 / n_pair
+            self._vdw_correction = 2 * PI * self.n_atom ** 2 * average
+        if system.use_pbc:
+            self._k_rf = (self.dielectric - 1) / ((2 * self.dielectric + 1) * self.cutoff ** 3)
+            self._c_rf = 1 / self.cutoff + self._k_rf * self.cutoff ** 2
+        else:
+            self._k_rf = self._c_rf = 0
+
+        # the excluded pairs are encoded as i*n_atom+j with i<j, so that they can be looked up with a sorted array
+        pairs12, pairs13, pairs14 = top.get_12_13_14_pairs()
+        excluded = [(atom1.id, atom2.id) for atom1, atom2 in pairs12 + pairs13 + pairs14]
+        self._exclusions = np.array(excluded, dtype=int).reshape(-1, 2)
+        self._excluded = np.unique(self._exclusions.min(axis=1) * self.n_atom + self._exclusions.max(axis=1))
+
+        # the scaled 1-4 pairs are evaluated as bonded terms
+        indexes, vdw_parameters, coul_parameters = [], [], []
+        for atom1, atom2 in pairs14:
+            vdw = ff.get_vdw_term(ff.atom_types[atom1.type], ff.atom_types[atom2.type])
+            indexes.append((atom1.id, atom2.id))
+            vdw_parameters.append((vdw.epsilon * ff.scale_14_vdw, vdw.sigma, 0))
+            coul_parameters.append((0, 0, atom1.charge * atom2.charge * ff.scale_14_coulomb))
+        if ff.scale_14_vdw != 0:
+            self._add_kernel('vdW', NonbondedKernel, indexes, vdw_parameters)
+        if system.charged and ff.scale_14_coulomb != 0:
+            self._add_kernel('Coulomb', NonbondedKernel, indexes, coul_parameters)
+
+    def _get_pairs(self, positions, box):
+        '''
+        Get the pairs of atoms interacting through non-bonded potential, excluding 1-2, 1-3 and 1-4 pairs.
+
+        Returns
+        -------
+        i : np.ndarray
+        j : np.ndarray
+        delta : np.ndarray
+            The minimum image vectors from atom i to atom j
+        '''
+        if box is not None and np.any(box < 2 * self.cutoff):
+            raise Exception('Cutoff larger than half of the box')
+
+        if box is not None and np.all(box / 3 >= self.cutoff):
+            nlist = NeighborList(box, self.cutoff)
+            i, j, _ = nlist.get_pairs(positions, self.cutoff, exclusions=self._exclusions)
+            delta = positions[j] - positions[i]
+            delta -= np.round(delta / box) * box
+            return i, j, delta
+
+        # the box is too small for cell list, or there is no periodic boundary
+        i, j = np.triu_indices(self.n_atom, 1)
+        delta = positions[j] - positions[i]
+        if box is not None:
+            delta -= np.round(delta / box) * box
+            within = np.sum(delta * delta, axis=-1) < self.cutoff ** 2
+            i, j, delta = i[within], j[within], delta[within]
+
+        included = ~np.isin(i * self.n_atom + j, self._excluded)
+        return i[included], j[included], delta[included]
+
+    def _evaluate_nonbonded(self, positions, box):
+        '''
+        Evaluate the vdW and Coulomb energies and forces of the pairs not excluded for a single frame.
+        '''
+        i, j, delta = self._get_pairs(positions, box)
+        rsq = np.sum(delta * delta, axis=-1)
+        r = np.sqrt(rsq)
+
+        type_i, type_j = self._types[i], self._types[j]
+        c12 = self._c12[type_i, type_j]
+        c6 = self._c6[type_i, type_j]
+        r6 = rsq * rsq * rsq
+        r12 = r6 * r6
+        e_vdw = np.sum(c12 / r12 - c6 / r6)
+        if self._vdw_shift:
+            e_vdw -= np.sum(c12 / self.cutoff ** 12 - c6 / self.cutoff ** 6)
+        if self._vdw_correct:
+            e_vdw += self._vdw_correction / np.prod(box)
+        forces_j = ((12 * c12 / r12 - 6 * c6 / r6) / rsq)[:, np.newaxis] * delta
+        f_vdw = scatter_add(self.n_atom, (i, -forces_j), (j, forces_j))
+
+        qq = ONE_4PI_EPS0 * self._charges[i] * self._charges[j]
+        e_coul = np.sum(qq * (1 / r + self._k_rf * rsq - self._c_rf))
+        forces_j = (qq * (1 / rsq / r - 2 * self._k_rf))[:, np.newaxis] * delta
+        f_coul = scatter_add(self.n_atom, (i, -forces_j), (j, forces_j))
+
+        return e_vdw, f_vdw, e_coul, f_coul
+
+    def evaluate(self, positions=None, boxes=None):
+        '''
+        Evaluate the energies and forces of each force group.
+
+        Parameters
+        ----------
+        positions : array_like, optional
+            The positions of atoms in shape of (n_atom, 3), or a stack of frames in shape of (n_frame, n_atom, 3).
+            If not set, the positions of the topology will be used.
+        boxes : array_like, optional
+            The lengths of the rectangular box in shape of (3,), or (n_frame, 3) for a stack of frames.
+            If not set, the box of the topology will be used for all frames.
+            It is ignored if periodic boundary condition is not used by the system.
+
+        Returns
+        -------
+        energies : Dict[str, np.ndarray]
+            The energy of each force group in kJ/mol. It is a float, or an array of shape (n_frame,) for a stack of frames.
+        forces : Dict[str, np.ndarray]
+            The forces of each force group in kJ/mol/nm in shape of (n_atom, 3), or (n_frame, n_atom, 3).
+        '''
+        positions = self.positions if positions is None else np.asarray(positions, dtype=np.float64)
+        single = positions.ndim == 2
+        if single:
+            positions = positions[np.newaxis]
+        if positions.shape[1] != self.n_atom:
+            raise Exception('Number of atoms in system and positions do not match')
+        n_frame = len(positions)
+        if self.box is None:
+            boxes = [None] * n_frame
+        else:
+            boxes = self.box if boxes is None else np.asarray(boxes, dtype=np.float64)
+            boxes = np.broadcast_to(boxes, (n_frame, 3))
+
+        energies, forces = {}, {}
+        for group, kernels in self._kernels.items():
+            energies[group] = np.zeros(n_frame)
+            forces[group] = np.zeros((n_frame, self.n_atom, 3))
+            for kernel in kernels:
+                _, energy, _forces = kernel.evaluate(positions)
+                energies[group] += energy.sum(axis=-1)
+                forces[group] += _forces
+
+        for group in ('vdW', 'Coulomb'):
+            if group == 'Coulomb' and not self._system.charged:
+                continue
+            energies.setdefault(group, np.zeros(n_frame))
+            forces.setdefault(group, np.zeros((n_frame, self.n_atom, 3)))
+        for k in range(n_frame):
+            e_vdw, f_vdw, e_coul, f_coul = self._evaluate_nonbonded(positions[k], boxes[k])
+            energies['vdW'][k] += e_vdw
+            forces['vdW'][k] += f_vdw
+            if self._system.charged:
+                energies['Coulomb'][k] += e_coul
+                forces['Coulomb'][k] += f_coul
+
+        if single:
+            energies = {group: float(energy[0]) for group, energy in energies.items()}
+            forces = {group: _forces[0] for group, _forces in forces.items()}
+        return energies, forces
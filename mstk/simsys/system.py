@@ -354,6 +354,17 @@ class System:
         from .ommexporter import OpenMMExporter
         return OpenMMExporter.export(self, disable_inter_mol=disable_inter_mol, **kwargs)
 
+    def to_numpy_engine(self):
+        '''
+        Export this system to a NumPy engine for evaluating energies and forces without simulation engine
+
+        Returns
+        -------
+        engine : NumpyEngine
+        '''
+        from .npengine import NumpyEngine
+        return NumpyEngine(self)
+
     def decompose_energy(self, disable_inter_mol=False, verbose=True):
         '''
         Calculate the contribution of each energy term in this system
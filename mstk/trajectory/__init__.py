@@ -1,9 +1,13 @@
 from .frame import Frame
 from .trajectory import Trajectory
 from .handler import TrjHandler
+from .index import FrameIndex
+from .compress import CompressedFile
+from .transform import Transform, SetBox, Shift, Center, Wrap, MakeWhole
 from .io.gro import Gro
-from .io.dcd import Dcd
+from .io.dcd import Dcd, ChemfilesDcd
 from .io.lammps import LammpsTrj
-from .io.xtc import Xtc
+from .io.xtc import Xtc, ChemfilesXtc
 from .io.xyz import Xyz
+from .io.mtrj import Mtrj
 from .io.combined_trj import CombinedTrj
@@ -0,0 +1,346 @@
+import io
+import os
+import bz2
+import lzma
+import zlib
+import bisect
+
+COMPRESSIONS = {
+    '.gz' : 'gzip',
+    '.bz2': 'bzip2',
+    '.xz' : 'xz',
+    '.zst': 'zstd',
+}
+
+_DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError)
+
+try:
+    import zstandard
+except ImportError:
+    ZSTANDARD_FOUND = False
+else:
+    ZSTANDARD_FOUND = True
+    _DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+
+def split_compression(file):
+    '''
+    Split the compression extension from the name of a file.
+
+    Parameters
+    ----------
+    file : str
+
+    Returns
+    -------
+    name : str
+        The name of the file without compression extension, e.g. `traj.gro` for `traj.gro.gz`.
+    compression : str or None
+        The compression algorithm. None if the file is not compressed.
+    '''
+    name, ext = os.path.splitext(file)
+    compression = COMPRESSIONS.get(ext.lower())
+    if compression is None:
+        return file, None
+    return name, compression
+
+
+def open_file(file, mode='r'):
+    '''
+    Open a trajectory file in binary mode.
+
+    In 'r' mode, a compressed file is opened as :class:`CompressedFile` so that it is decompressed transparently.
+    Writing compressed file is not supported.
+
+    Parameters
+    ----------
+    file : str
+    mode : ['r', 'w', 'a']
+
+    Returns
+    -------
+    file : file object
+    '''
+    if split_compression(file)[1] is None:
+        return open(file, mode + 'b')
+    if mode != 'r':
+        raise Exception('Writing compressed trajectory is not supported')
+    return CompressedFile(file)
+
+
+class CompressedFile(io.RawIOBase):
+    '''
+    A read-only seekable binary file object over a compressed file.
+
+    The compressed file is decompressed on request, and the positions in this file object refer to the decompressed data.
+    To avoid decompressing from the start of the file for every backward seek,
+    seek points are recorded while the file is read for the first time (e.g. when the frame index is built).
+    A seek point is the offset in the compressed file from where the decompression can be restarted,
+    paired with its position in the decompressed data.
+    Seeking to an arbitrary position only decompresses the data after the nearest seek point before it.
+
+    The seek points are recorded at the start of every compressed stream in the file,
+    which can be several concatenated streams (e.g. by `pigz --independent`, `pbzip2`, `pzstd`).
+    For gzip, the state of decompressor is also recorded every `spacing` bytes of decompressed data,
+    so that random access is cheap even for a single stream.
+    The state of other decompressors cannot be copied,
+    therefore random access within a single stream of bzip2, xz or zstd is as slow as reading from the start of the stream.
+
+    The seek points at the start of streams can be retrieved with :attr:`seek_points`
+    and restored with :func:`add_seek_points` after the file is opened again,
+    so that they are not searched by decompressing the whole file again (see :class:`~mstk.trajectory.FrameIndex`).
+    The seek points within a gzip stream cannot be restored, because the state of decompressor cannot be serialized.
+
+    The `zstandard` package is required for reading zstd compressed file.
+
+    Parameters
+    ----------
+    file : str
+    compression : ['gzip', 'bzip2', 'xz', 'zstd'], optional
+        If not set, the compression algorithm will be determined from the extension of the file.
+
+    Attributes
+    ----------
+    spacing : int
+        Class attribute. The interval in bytes of decompressed data between the seek points for gzip.
+        Every seek point of gzip costs about 40 KB of memory.
+    history : int
+        Class attribute. The number of bytes of decompressed data before current position kept in memory,
+        so that short backward seek does not require restarting from a seek point.
+    '''
+
+    spacing = 16 * 1024 * 1024
+    history = 1024 * 1024
+    chunk_size = 256 * 1024
+
+    def __init__(self, file, compression=None):
+        super().__init__()
+        if compression is None:
+            compression = split_compression(file)[1]
+        if compression not in COMPRESSIONS.values():
+            raise Exception('Unknown compression for file: %s' % file)
+
+        self.name = file
+        self.compression = compression
+        self._raw = open(file, 'rb')
+        self._decompressor = self._new_decompressor()
+        self._copyable = compression == 'gzip'
+        self._fresh = True  # no data has been decompressed from current stream
+        # seek points as offset in compressed file, position in decompressed data and state of decompressor
+        self._point_raws = [0]
+        self._point_positions = [0]
+        self._point_states = [None]
+        self._buffer = bytearray()  # decompressed data kept in memory
+        self._buffer_start = 0  # the position of the first byte in buffer
+        self._pos = 0
+        self._size = None
+
+    def _new_decompressor(self):
+        if self.compression == 'gzip':
+            return zlib.decompressobj(wbits=31)
+        if self.compression == 'bzip2':
+            return bz2.BZ2Decompressor()
+        if self.compression == 'xz':
+            return lzma.LZMADecompressor()
+        if not ZSTANDARD_FOUND:
+            raise ImportError('zstandard is required for reading zstd compressed file')
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    @property
+    def n_seek_point(self):
+        '''
+        The number of seek points recorded so far
+
+        Returns
+        -------
+        n : int
+        '''
+        return len(self._point_positions)
+
+    @property
+    def seek_points(self):
+        '''
+        The seek points at the start of streams recorded so far,
+        from where the decompression can be restarted without the state of decompressor.
+
+        Returns
+        -------
+        points : list of tuple of int
+            The offset in compressed file and the position in decompressed data of every seek point.
+        '''
+        return [(raw, position) for raw, position, state in
+                zip(self._point_raws, self._point_positions, self._point_states) if state is None]
+
+    def add_seek_points(self, points):
+        '''
+        Add the seek points at the start of streams, which are retrieved from :attr:`seek_points`
+        when the same compressed file was opened previously.
+
+        Parameters
+        ----------
+        points : list of tuple of int
+            The offset in compressed file and the position in decompressed data of every seek point.
+        '''
+        for raw, position in points:
+            self._insert_point(int(raw), int(position), None)
+
+    def _insert_point(self, raw, position, state):
+        i = bisect.bisect_left(self._point_positions, position)
+        # do not record the seek point again when the data is decompressed again
+        if i < len(self._point_positions) and self._point_positions[i] == position:
+            return
+        self._point_raws.insert(i, raw)
+        self._point_positions.insert(i, position)
+        self._point_states.insert(i, state)
+
+    def _add_point(self, raw, state):
+        self._insert_point(raw, self._buffer_start + len(self._buffer), state)
+
+    def _restore(self, i_point):
+        self._raw.seek(self._point_raws[i_point])
+        state = self._point_states[i_point]
+        # copy the state again so that the seek point can be reused
+        self._decompressor = self._new_decompressor() if state is None else state.copy()
+        self._fresh = state is None
+        self._buffer.clear()
+        self._buffer_start = self._point_positions[i_point]
+
+    def _fill(self):
+        '''
+        Decompress next chunk of data and append it to the buffer.
+
+        Returns
+        -------
+        filled : bool
+            False if the end of file is reached.
+        '''
+        data = b''
+        if self._decompressor.eof:
+            # the current stream is finished. The next stream starts from the unused data
+            data = self._decompressor.unused_data
+            self._decompressor = self._new_decompressor()
+            self._fresh = True
+            self._add_point(self._raw.tell() - len(data), None)
+        if not data:
+            data = self._raw.read(self.chunk_size)
+        if not data:
+            self._size = self._buffer_start + len(self._buffer)
+            return False
+
+        try:
+            out = self._decompressor.decompress(data)
+        except _DECOMPRESS_ERRORS:
+            # garbage (e.g. padding) after the last stream is ignored
+            if not self._fresh or self._buffer_start + len(self._buffer) == 0:
+                raise
+            self._raw.seek(0, os.SEEK_END)
+            self._size = self._buffer_start + len(self._buffer)
+            return False
+        if out:
+            self._buffer += out
+            self._fresh = False
+
+        if self._copyable and not self._decompressor.eof:
+            end = self._buffer_start + len(self._buffer)
+            # the seek points after current position may have been added by add_seek_points
+            i_point = bisect.bisect_right(self._point_positions, end) - 1
+            if end - self._point_positions[i_point] >= self.spacing:
+                self._add_point(self._raw.tell(), self._decompressor.copy())
+        return True
+
+    def _locate(self):
+        '''
+        Make sure the buffer starts before the current position,
+        and the current position is either in the buffer or at the end of buffer.
+        '''
+        i_point = bisect.bisect_right(self._point_positions, self._pos) - 1
+        if self._pos < self._buffer_start or self._point_positions[i_point] > self._buffer_start + len(self._buffer):
+            self._restore(i_point)
+        while self._buffer_start + len(self._buffer) < self._pos:
+            # the skipped data is not kept
+            self._buffer_start += len(self._buffer)
+            self._buffer.clear()
+            if not self._fill():
+                break
+
+    def _trim(self):
+        n_drop = self._pos - self._buffer_start - self.history
+        if n_drop > 0:
+            del self._buffer[:n_drop]
+            self._buffer_start += n_drop
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            while self._size is None:
+                # decompress until the end of file to know its size
+                self._buffer_start += len(self._buffer)
+                self._buffer.clear()
+                self._fill()
+            pos = self._size + offset
+        else:
+            raise ValueError('Invalid whence')
+        if pos < 0:
+            raise ValueError('Negative seek position')
+        self._pos = pos
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._locate()
+        while size < 0 or self._buffer_start + len(self._buffer) < self._pos + size:
+            if not self._fill():
+                break
+        start = self._pos - self._buffer_start
+        end = len(self._buffer) if size < 0 else start + size
+        data = bytes(self._buffer[start:end])
+        self._pos += len(data)
+        self._trim()
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        self._locate()
+        start = self._pos - self._buffer_start
+        i = self._buffer.find(b'\n', start)
+        while i < 0:
+            n_searched = len(self._buffer)
+            if not self._fill():
+                break
+            i = self._buffer.find(b'\n', n_searched)
+        end = len(self._buffer) if i < 0 else i + 1
+        if size >= 0:
+            end = min(end, start + size)
+        data = bytes(self._buffer[start:end])
+        self._pos += len(data)
+        self._trim()
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+            self._buffer = bytearray()
+            self._point_states = []
+        super().close()
@@ -15,6 +15,9 @@ class Frame:
     ----------
     n_atom : int
         The number of atoms in the frame.
+    dtype : data-type
+        The data type of positions and velocities.
+        Use np.float32 to halve the memory if the precision of trajectory is not a concern (e.g. XTC).
 
     Attributes
     ----------
@@ -39,15 +42,15 @@ class Frame:
         It's a np.ndarry of shape (n_atom,)
     '''
 
-    def __init__(self, n_atom):
+    def __init__(self, n_atom, dtype=float):
         self.step = -1  # -1 means step information not found
         self.time = -1  # in ps. -1 means time information not found
         self.cell = UnitCell()
         self.n_atom = n_atom
         self.has_velocity = False
         self.has_charge = False
-        self._positions = np.zeros((n_atom, 3), dtype=float)
-        self._velocities = np.zeros((n_atom, 3), dtype=float)
+        self._positions = np.zeros((n_atom, 3), dtype=dtype)
+        self._velocities = np.zeros((n_atom, 3), dtype=dtype)
         self._charges = np.zeros(n_atom, dtype=float)  # for fluctuating charge simulations
 
     def reset(self):
@@ -66,7 +69,7 @@ class Frame:
 
         Usually it is not necessary to call this method explicitly.
         If n_atom is smaller than previous value, the information of the end atoms will be trimmed.
-        If n_atom is larger than previous value, the information for the new atoms will be random.
+        If n_atom is larger than previous value, the information for the new atoms will be zero.
 
         Parameters
         ----------
@@ -76,7 +79,7 @@ class Frame:
         self.n_atom = n_atom
         self._positions.resize((n_atom, 3), refcheck=False)
         self._velocities.resize((n_atom, 3), refcheck=False)
-        self._charges.resize((n_atom, 3), refcheck=False)
+        self._charges.resize(n_atom, refcheck=False)
 
     @property
     def positions(self):
@@ -1,5 +1,14 @@
 import os
-from io import IOBase
+import re
+import threading
+import numpy as np
+from io import IOBase, BufferedReader
+from .frame import Frame
+from .index import FrameIndex
+from .compress import split_compression, CompressedFile
+
+_STEP_PATTERN = re.compile(rb'\bstep=\s*(-?\d+)')
+_TIME_PATTERN = re.compile(rb'\bt=\s*(\S+?)(?:,|\s|$)')
 
 
 class TrjHandler():
@@ -8,14 +17,47 @@ class TrjHandler():
 
     The methods :func:`get_info`, :func:`read_frame` and :func:`write_frame` should be implemented by subclasses.
     The method :func:`close` should also be overriden by subclasses if more works are required more than close the file.
+    The method :func:`read_positions` can be overriden by subclasses if several frames can be read more efficiently at once.
+    Subclasses should call :func:`_frame_written` after every frame written,
+    so that the file is flushed according to `flush_interval`.
+    The argument `atoms` of :func:`read_frame` should be honoured by subclasses,
+    so that the atoms not selected are skipped as early as possible.
+
+    Handlers which locate frames by byte offsets should implement :func:`_build_index`
+    and call :func:`_load_or_build_index` in :func:`get_info`,
+    so that the frame index of large trajectory file is persisted and reused.
+    Such handlers should also implement :func:`_scan_metadata` and call :func:`_load_or_build_metadata`
+    in :func:`read_metadata`, so that the step, time and box of frames are read from headers only once.
+
+    Handlers which only read the file through `read`, `readline`, `seek` and `tell`
+    can open it with :func:`~mstk.trajectory.compress.open_file` and set `compressible` to True,
+    so that compressed files (e.g. `traj.gro.gz`) can be read transparently.
+
+    In 'r' mode, :func:`read_frame` and :func:`read_positions` should be safe to be called from several threads at the same time,
+    so that frames can be decoded concurrently (see :func:`Trajectory.iter_frames`).
+    The frame index is never modified after :func:`get_info`, therefore it can be shared by all threads.
+    Subclasses should read the bytes of a frame with :func:`_read_at` instead of `seek` followed by `read`,
+    because the position of the file object is shared by all threads.
+    The code which has to move the position of the file object should be guarded by `_lock`.
+
+    Attributes
+    ----------
+    flush_interval : int
+        In 'w' and 'a' modes, flush the file after every this number of frames written.
+        If set to 0, the file is flushed only when the buffer is full or the handler is closed.
     '''
 
     _klass_map = {}
+    compressible = False
 
     def __init__(self):
         self._file = IOBase()
         self.n_atom = -1
         self.n_frame = -1
+        self.flush_interval = 1
+        self._n_frame_unflushed = 0
+        self._lock = threading.RLock()  # guard the position of the file object
+        self._positional = None  # whether or not positional read is available for the file object
 
     @staticmethod
     def register_format(extension, Handler):
@@ -48,10 +90,13 @@ class TrjHandler():
         if isinstance(file, list):
             Handler = CombinedTrj
         elif isinstance(file, str):
+            name, compression = split_compression(file)
             try:
-                Handler = TrjHandler._klass_map[os.path.splitext(file)[-1].lower()]
+                Handler = TrjHandler._klass_map[os.path.splitext(name)[-1].lower()]
             except:
                 raise Exception('Unknown extension for trajectory file: %s' % file)
+            if compression is not None and not Handler.compressible:
+                raise Exception('Compressed file is not supported by %s: %s' % (Handler.__name__, file))
         else:
             raise Exception('Only string and list of string are accepted for trajectory file')
 
@@ -61,8 +106,8 @@ class TrjHandler():
         '''
         Get the number of atoms and frames in the trajectory.
 
-        Also record the offset of lines and frames, so that we can read arbitrary frame later.
-        It assumes all frames have the same number of atoms.
+        Also record the offset of frames, so that we can read arbitrary frame later.
+        If the number of atoms varies between frames, the number of atoms in the first frame is returned.
 
         Returns
         -------
@@ -71,7 +116,178 @@ class TrjHandler():
         '''
         raise NotImplementedError('Method not implemented')
 
-    def read_frame(self, i_frame, frame):
+    def _build_index(self):
+        '''
+        Scan the trajectory file and build the frame index.
+
+        Returns
+        -------
+        index : FrameIndex
+        '''
+        raise NotImplementedError('Method not implemented')
+
+    def _load_or_build_index(self, file):
+        '''
+        Load the frame index from the sidecar index file if it is valid.
+        Otherwise, build the frame index with :func:`_build_index` and save it into the sidecar index file.
+        If the file is compressed, the seek points found while building the index are also saved,
+        and they are restored when the index is loaded.
+
+        Parameters
+        ----------
+        file : str
+            The trajectory file opened by this handler.
+
+        Returns
+        -------
+        index : FrameIndex
+        '''
+        compressed = isinstance(self._file, CompressedFile)
+        index = FrameIndex.load(file)
+        if index is None:
+            index = self._build_index()
+            if compressed:
+                index.seek_points = np.array(self._file.seek_points, dtype=np.int64)
+            index.save(file)
+        elif compressed and index.seek_points is not None:
+            self._file.add_seek_points(index.seek_points.tolist())
+        return index
+
+    def _read_at(self, offset, size):
+        '''
+        Read bytes from an offset of the file, without moving the position of the file object.
+
+        It is safe to call this method from several threads at the same time.
+        Positional read (`os.pread`) is used for regular file, so that the threads never wait for each other.
+        Otherwise (e.g. compressed file or platforms without `os.pread`), the reads are serialized by `_lock`.
+
+        Parameters
+        ----------
+        offset : int
+        size : int
+
+        Returns
+        -------
+        data : bytes
+            Shorter than `size` only if the end of file is reached.
+        '''
+        if self._positional is None:
+            self._positional = hasattr(os, 'pread') and isinstance(self._file, BufferedReader)
+        if not self._positional:
+            with self._lock:
+                self._file.seek(offset)
+                return self._file.read(size)
+
+        fileno = self._file.fileno()
+        chunks = []
+        # a single call may return less bytes than requested for very large size
+        while size > 0:
+            data = os.pread(fileno, size, offset)
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def _scan_metadata(self):
+        '''
+        Scan the headers of all frames for the step, time and box.
+
+        Returns
+        -------
+        steps : array_like
+            The steps in shape of (n_frame,). -1 means unknown.
+        times : array_like
+            The times in shape of (n_frame,). -1 means unknown.
+        boxes : array_like
+            The box vectors in shape of (n_frame, 3, 3). Zero means unknown.
+        '''
+        raise NotImplementedError('Method not implemented')
+
+    def _load_or_build_metadata(self, file):
+        '''
+        Get the step, time and box of all frames from the frame index.
+        If they are not recorded in the frame index yet,
+        scan them with :func:`_scan_metadata`, and save them into the sidecar index file along with the offsets.
+
+        Parameters
+        ----------
+        file : str
+            The trajectory file opened by this handler.
+
+        Returns
+        -------
+        steps : np.ndarray
+        times : np.ndarray
+        boxes : np.ndarray
+        '''
+        index = self._index
+        with self._lock:
+            if index.steps is None or index.times is None or index.boxes is None:
+                steps, times, boxes = self._scan_metadata()
+                index.steps = np.asarray(steps, dtype=np.int64)
+                index.times = np.asarray(times, dtype=float)
+                index.boxes = np.asarray(boxes, dtype=float).reshape(-1, 3, 3)
+                index.save(file)
+        return index.steps, index.times, index.boxes
+
+    @staticmethod
+    def _parse_step_time(title):
+        '''
+        Parse the step and time from the title line written by mstk or GROMACS,
+        e.g. `Created by mstk: step= 100, t= 0.200000 ps` or `Generated by trjconv : t= 0.20000 step= 100`.
+
+        Parameters
+        ----------
+        title : bytes
+
+        Returns
+        -------
+        step : int
+            -1 if not found
+        time : float
+            -1 if not found
+        '''
+        match = _STEP_PATTERN.search(title)
+        step = int(match.group(1)) if match else -1
+        match = _TIME_PATTERN.search(title)
+        try:
+            time = float(match.group(1)) if match else -1
+        except ValueError:
+            time = -1
+        return step, time
+
+    def read_metadata(self):
+        '''
+        Read the step, time and box of all frames, without reading the positions of atoms.
+
+        The default implementation reads only the first atom of every frame with :func:`read_frame`.
+        It should be overriden by subclasses which can read the headers of frames alone.
+
+        Returns
+        -------
+        steps : np.ndarray
+            The steps in shape of (n_frame,). -1 means unknown.
+        times : np.ndarray
+            The times in shape of (n_frame,). -1 means unknown.
+        boxes : np.ndarray
+            The box vectors in shape of (n_frame, 3, 3). Zero means unknown.
+        '''
+        steps = np.empty(self.n_frame, dtype=np.int64)
+        times = np.empty(self.n_frame, dtype=float)
+        boxes = np.empty((self.n_frame, 3, 3), dtype=float)
+        frame = Frame(1)
+        atoms = np.zeros(1, dtype=int)
+        for i_frame in range(self.n_frame):
+            frame.reset()
+            self.read_frame(i_frame, frame, atoms=atoms)
+            steps[i_frame] = frame.step
+            times[i_frame] = frame.time
+            boxes[i_frame] = frame.cell.vectors
+        return steps, times, boxes
+
+    def read_frame(self, i_frame, frame, atoms=None):
         '''
         Read a single frame.
 
@@ -80,10 +296,111 @@ class TrjHandler():
         i_frame : int
             The index of the frame in the trajectory
         frame : Frame
-            The information read from the trajectory will be written into this Frame
+            The information read from the trajectory will be written into this Frame.
+            If atoms is set, the number of atoms in this Frame should be the same as the length of atoms.
+        atoms : np.ndarray of int, optional
+            The indexes of atoms to read. If not set, all atoms will be read.
         '''
         raise NotImplementedError('Method not implemented')
 
+    def _read_uniform_lines(self, start, end, n_head, n_line, rows):
+        '''
+        Read several lines from a block of lines with identical length, without reading the other lines in the block.
+
+        The block starts after `n_head` lines from the offset `start`, and it contains `n_line` lines.
+        The position of a line in the block is calculated from the length of the first line in the block.
+        Therefore, only the span between the first and the last requested lines is read.
+
+        Parameters
+        ----------
+        start : int
+            The offset of the frame in the file
+        end : int
+            The offset of the end of the frame in the file
+        n_head : int
+            Number of lines before the block
+        n_line : int
+            Number of lines in the block
+        rows : np.ndarray of int
+            The indexes of lines in the block to read
+
+        Returns
+        -------
+        chars : np.ndarray or None
+            The requested lines as an uint8 array of shape (len(rows), line_length), including the line ending.
+            None if the lines in the block are not of identical length,
+            or the requested lines are not aligned with the positions calculated from the first line.
+        tail : bytes or None
+            The remaining content of the frame after the block
+        '''
+        with self._lock:
+            self._file.seek(start)
+            for _ in range(n_head):
+                self._file.readline()
+            block_start = self._file.tell()
+            width = len(self._file.readline())
+        block_end = block_start + width * n_line
+        if width == 0 or block_end > end:
+            return None, None
+
+        lo, hi = rows.min(), rows.max() + 1
+        # the byte before the first requested line is also read, so that every requested line can be verified
+        # to start right after a line ending. The first line in the block always does
+        data = self._read_at(block_start + lo * width - 1, (hi - lo) * width + 1) if lo > 0 \
+            else b'\n' + self._read_at(block_start, hi * width)
+        tail = self._read_at(block_end - 1, end - block_end + 1)
+        if len(data) != (hi - lo) * width + 1 or tail[:1] != b'\n':
+            return None, None
+        data = np.frombuffer(data, dtype=np.uint8)
+        heads = data[(rows - lo) * width]
+        chars = data[1:].reshape(hi - lo, width)[rows - lo]
+        # the lines of different lengths may happen to sum up to the expected length of the block.
+        # They are detected by the line endings at unexpected positions
+        newline = ord('\n')
+        if not ((heads == newline).all() and (chars[:, -1] == newline).all() and (chars[:, :-1] != newline).all()):
+            return None, None
+        return chars, tail[1:]
+
+    def read_positions(self, i_frames, positions, boxes, steps, times, atoms=None, velocities=None, charges=None):
+        '''
+        Read the positions, boxes, steps and times (and optionally velocities and charges) of several frames
+        into preallocated arrays.
+
+        The default implementation reads the frames one by one with :func:`read_frame`.
+        The velocities and charges are set to zero for frames without such information.
+
+        Parameters
+        ----------
+        i_frames : list of int
+            The indexes of the frames in the trajectory
+        positions : np.ndarray
+            Array of shape (n_frame, n_atom, 3)
+        boxes : np.ndarray
+            Array of shape (n_frame, 3, 3) for box vectors
+        steps : np.ndarray
+            Array of shape (n_frame,)
+        times : np.ndarray
+            Array of shape (n_frame,)
+        atoms : np.ndarray of int, optional
+            The indexes of atoms to read. If not set, all atoms will be read.
+        velocities : np.ndarray, optional
+            Array of shape (n_frame, n_atom, 3). If not set, velocities will not be read.
+        charges : np.ndarray, optional
+            Array of shape (n_frame, n_atom). If not set, charges will not be read.
+        '''
+        frame = Frame(self.n_atom if atoms is None else len(atoms))
+        for ii, i_frame in enumerate(i_frames):
+            frame.reset()
+            self.read_frame(i_frame, frame, atoms=atoms)
+            positions[ii] = frame.positions
+            boxes[ii] = frame.cell.vectors
+            steps[ii] = frame.step
+            times[ii] = frame.time
+            if velocities is not None:
+                velocities[ii] = frame.velocities if frame.has_velocity else 0
+            if charges is not None:
+                charges[ii] = frame.charges if frame.has_charge else 0
+
     def write_frame(self, frame, **kwargs):
         '''
         Write a frame into the trajectory file opened by the handler.
@@ -97,6 +414,15 @@ class TrjHandler():
         '''
         raise NotImplementedError('Method not implemented')
 
+    def _frame_written(self):
+        '''
+        Flush the file if `flush_interval` frames have been written since last flush.
+        '''
+        self._n_frame_unflushed += 1
+        if self.flush_interval > 0 and self._n_frame_unflushed >= self.flush_interval:
+            self._file.flush()
+            self._n_frame_unflushed = 0
+
     def close(self):
         '''
         Close the handler.
@@ -0,0 +1,298 @@
+import os
+import numpy as np
+from mstk import logger
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def scan_frame_offsets(file, n_line_per_frame, chunk_size=CHUNK_SIZE):
+    '''
+    Locate the byte offsets of all frames in a text trajectory file in which every frame has the same number of lines.
+
+    The file is scanned in large binary chunks instead of line by line.
+    Chunks containing no frame boundary are skipped after counting the line endings in it.
+    Only the offsets of frames are recorded, so the memory usage is proportional to the number of frames.
+    Incomplete frame at the end of the file is ignored.
+
+    Parameters
+    ----------
+    file : file object
+        The trajectory file opened in binary mode.
+    n_line_per_frame : int
+        Number of lines in every frame.
+    chunk_size : int
+        Number of bytes to read in each chunk.
+
+    Returns
+    -------
+    offsets : np.ndarray
+        The offsets of frames as an array of int of shape (n_frame + 1,).
+        The last element is the end of the last complete frame.
+    '''
+    if n_line_per_frame < 1:
+        raise ValueError('n_line_per_frame should be positive')
+
+    file.seek(0)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    n_line = 0  # number of line endings found so far
+    n_line_next = n_line_per_frame  # number of line endings at the end of next frame
+    position = 0
+    last_byte = b''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        n_newline = chunk.count(b'\n')
+        if n_line + n_newline >= n_line_next:
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            ends = newlines[n_line_next - n_line - 1::n_line_per_frame] + (position + 1)
+            offsets.append(ends)
+            n_line_next += len(ends) * n_line_per_frame
+        n_line += n_newline
+        position += len(chunk)
+        last_byte = chunk[-1:]
+    file.seek(0)
+
+    # the last line of the file may not be terminated by line ending
+    if last_byte not in (b'', b'\n') and n_line + 1 == n_line_next:
+        offsets.append(np.array([position], dtype=np.int64))
+
+    return np.concatenate(offsets)
+
+
+def scan_frame_markers(file, marker, chunk_size=CHUNK_SIZE):
+    '''
+    Locate the byte offsets of all frames in a text trajectory file in which every frame starts with a marker line,
+    and count the lines in every frame.
+
+    Unlike :func:`scan_frame_offsets`, the frames are not required to have the same number of lines.
+    The file is scanned in large binary chunks. Every chunk is cut at its last line ending,
+    so that a line is never split between chunks.
+
+    Parameters
+    ----------
+    file : file object
+        The trajectory file opened in binary mode.
+    marker : bytes
+        The beginning of the first line of every frame, e.g. `ITEM: TIMESTEP` for LAMMPS dump file.
+    chunk_size : int
+        Number of bytes to read in each chunk.
+
+    Returns
+    -------
+    offsets : np.ndarray
+        The offsets of frames as an array of int of shape (n_frame + 1,).
+        The last element is the end of the file.
+    n_lines : np.ndarray
+        The number of lines in every frame as an array of int of shape (n_frame,).
+        The content before the first marker is ignored.
+    '''
+    file.seek(0)
+    offsets = []
+    line_numbers = []  # the number of lines before every frame
+    n_line = 0  # number of lines before the current buffer
+    position = 0  # offset of the current buffer
+    rest = b''
+    while True:
+        chunk = file.read(chunk_size)
+        buffer = rest + chunk
+        if chunk:
+            end = buffer.rfind(b'\n') + 1
+            buffer, rest = buffer[:end], buffer[end:]
+        counted = 0
+        i = buffer.find(marker)
+        while i >= 0:
+            if i == 0 or buffer[i - 1] == ord('\n'):
+                n_line += buffer.count(b'\n', counted, i)
+                counted = i
+                offsets.append(position + i)
+                line_numbers.append(n_line)
+            i = buffer.find(marker, i + 1)
+        n_line += buffer.count(b'\n', counted)
+        position += len(buffer)
+        if not chunk:
+            # the last line of the file may not be terminated by line ending
+            if buffer[-1:] not in (b'', b'\n'):
+                n_line += 1
+            break
+    file.seek(0)
+
+    offsets.append(position)
+    line_numbers.append(n_line)
+    return np.array(offsets, dtype=np.int64), np.diff(np.array(line_numbers, dtype=np.int64))
+
+
+class FrameIndex():
+    '''
+    The frame index of a trajectory file, which records the number of atoms and the byte offsets of all frames.
+
+    Optionally, the step, time and box of every frame can also be recorded.
+    For trajectory in which the number of atoms varies between frames (e.g. LAMMPS dump file of GCMC simulation),
+    the number of atoms in every frame is also recorded.
+    For compressed trajectory file, the seek points at the start of compressed streams can also be recorded,
+    so that they are not searched again when the file is opened again (see :class:`~mstk.trajectory.CompressedFile`).
+
+    Building the frame index requires a full scan of the trajectory file, which is slow for large files.
+    Therefore, the index of large file is saved in a sidecar file alongside the trajectory file
+    (e.g. `traj.gro.mstkidx` for `traj.gro`) after the first scan, and reused when the trajectory is opened again.
+    The sidecar file is validated by the size and modification time of the trajectory file.
+    A stale sidecar file will be ignored and overwritten.
+
+    Parameters
+    ----------
+    n_atom : int
+        The number of atoms in the first frame.
+    offsets : array_like
+        The byte offsets of frames in shape of (n_frame + 1,).
+        The last element is the end of the last frame.
+    steps : array_like, optional
+        The step of every frame in shape of (n_frame,)
+    times : array_like, optional
+        The time (in ps) of every frame in shape of (n_frame,)
+    boxes : array_like, optional
+        The box vectors (in nm) of every frame in shape of (n_frame, 3, 3)
+    n_atoms : array_like, optional
+        The number of atoms in every frame in shape of (n_frame,).
+        It is only required if the number of atoms varies between frames.
+    seek_points : array_like, optional
+        The seek points of compressed trajectory file in shape of (n_point, 2).
+        Every seek point is the offset in compressed file and the position in decompressed data.
+
+    Attributes
+    ----------
+    enabled : bool
+        Class attribute. Set it to False to disable loading and saving sidecar index files.
+    min_file_size : int
+        Class attribute. The sidecar index file will not be saved for trajectory file smaller than this size in bytes,
+        because it is cheap to build the index for small files.
+    '''
+
+    EXTENSION = '.mstkidx'
+    VERSION = 1
+
+    enabled = True
+    min_file_size = 64 * 1024 * 1024
+
+    def __init__(self, n_atom, offsets, steps=None, times=None, boxes=None, n_atoms=None, seek_points=None):
+        self.n_atom = n_atom
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.steps = None if steps is None else np.asarray(steps, dtype=np.int64)
+        self.times = None if times is None else np.asarray(times, dtype=float)
+        self.boxes = None if boxes is None else np.asarray(boxes, dtype=float)
+        self.n_atoms = None if n_atoms is None else np.asarray(n_atoms, dtype=np.int64)
+        self.seek_points = None if seek_points is None else np.asarray(seek_points, dtype=np.int64).reshape(-1, 2)
+
+    def __repr__(self):
+        return f'<FrameIndex: {self.n_frame} frames {self.n_atom} atoms>'
+
+    @property
+    def n_frame(self):
+        '''
+        The number of frames in the index
+
+        Returns
+        -------
+        n_frame : int
+        '''
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def get_index_file(file):
+        '''
+        Get the name of the sidecar index file for a trajectory file.
+
+        Parameters
+        ----------
+        file : str
+
+        Returns
+        -------
+        index_file : str
+        '''
+        return file + FrameIndex.EXTENSION
+
+    @staticmethod
+    def load(file):
+        '''
+        Load the frame index of a trajectory file from its sidecar index file.
+
+        Parameters
+        ----------
+        file : str
+            The trajectory file (not the sidecar index file).
+
+        Returns
+        -------
+        index : FrameIndex or None
+            None is returned if the sidecar index file does not exist or it is not valid anymore.
+        '''
+        index_file = FrameIndex.get_index_file(file)
+        if not FrameIndex.enabled or not os.path.exists(index_file):
+            return None
+
+        try:
+            stat = os.stat(file)
+            with np.load(index_file) as data:
+                if int(data['version']) != FrameIndex.VERSION \
+                        or int(data['file_size']) != stat.st_size \
+                        or int(data['file_mtime']) != stat.st_mtime_ns:
+                    return None
+                kwargs = {key: data[key] for key in ('steps', 'times', 'boxes', 'n_atoms', 'seek_points') if key in data}
+                index = FrameIndex(int(data['n_atom']), data['offsets'], **kwargs)
+        except Exception as e:
+            logger.warning(f'Cannot load frame index from {index_file}: {e}')
+            return None
+
+        return index
+
+    def save(self, file, force=False):
+        '''
+        Save the frame index into the sidecar index file of a trajectory file.
+
+        Nothing will be done if the sidecar index is disabled or the trajectory file is small,
+        unless `force` is set to True.
+        Failure of writing the sidecar index file (e.g. for read-only directory) is ignored.
+
+        Parameters
+        ----------
+        file : str
+            The trajectory file (not the sidecar index file).
+        force : bool
+            Save the sidecar index file even if it is disabled or the trajectory file is small.
+
+        Returns
+        -------
+        saved : bool
+            Whether or not the sidecar index file is saved.
+        '''
+        stat = os.stat(file)
+        if not force and (not FrameIndex.enabled or stat.st_size < FrameIndex.min_file_size):
+            return False
+
+        arrays = {
+            'version'   : FrameIndex.VERSION,
+            'file_size' : stat.st_size,
+            'file_mtime': stat.st_mtime_ns,
+            'n_atom'    : self.n_atom,
+            'offsets'   : self.offsets,
+        }
+        for key in ('steps', 'times', 'boxes', 'n_atoms', 'seek_points'):
+            if getattr(self, key) is not None:
+                arrays[key] = getattr(self, key)
+
+        index_file = FrameIndex.get_index_file(file)
+        # write into a temporary file first so that other processes never see a partially written index
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, index_file)
+        except OSError as e:
+            logger.warning(f'Cannot save frame index into {index_file}: {e}')
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            return False
+
+        return True
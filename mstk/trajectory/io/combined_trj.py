@@ -1,3 +1,7 @@
+import numpy as np
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from mstk.trajectory.handler import TrjHandler
 
 
@@ -7,39 +11,146 @@ class CombinedTrj(TrjHandler):
 
     It is useful for processing truncated trajectories after restarting simulation.
     All trajectory files should contain the same number of atoms.
+
+    The files are indexed concurrently by a pool of threads when :func:`get_info` is called.
+    Only a limited number of files are kept open. The least recently used file is closed when the limit is reached,
+    and it will be opened again when its frames are requested.
+    Therefore, hundreds of trajectory files can be combined without hitting the limit of file descriptors.
+    The files being read by other threads are never closed, so that frames can be read from several threads.
+
+    Attributes
+    ----------
+    max_open : int
+        Class attribute. The maximum number of files kept open at the same time.
+    n_thread : int
+        Class attribute. The number of threads for indexing the files.
     '''
 
+    max_open = 64
+    n_thread = 8
+
     def __init__(self, files, mode='r'):
         if mode != 'r':
             raise Exception('CombinedTrj is read-only')
 
         super().__init__()
 
-        self._handlers = []
-        for file in files:
-            Handler = TrjHandler.get_handler_for_file(file)
-            self._handlers.append(Handler(file, mode='r'))
+        self._files = list(files)
+        if len(self._files) == 0:
+            raise Exception('At least one trajectory file is required')
+        # the handler classes are determined at once so that unknown format is reported early
+        self._Handlers = [TrjHandler.get_handler_for_file(file) for file in self._files]
+        self._handlers = OrderedDict()  # the opened handlers in the order of last use
+        self._n_users = Counter()  # the number of threads using each opened handler
 
-    def get_info(self):
-        self._i_frame_handler = []
-        self._i_frame_offset = []
-        for handler in self._handlers:
+    def _open(self, i_file):
+        handler = self._Handlers[i_file](self._files[i_file], mode='r')
+        try:
             handler.get_info()
-            self._i_frame_handler += [handler] * handler.n_frame
-            self._i_frame_offset += list(range(handler.n_frame))
+        except:
+            handler.close()
+            raise
+        return handler
+
+    def _scan(self, i_file):
+        handler = self._open(i_file)
+        n_atom, n_frame = handler.n_atom, handler.n_frame
+        # keep the first several files open, so that they need not to be opened and indexed again
+        if i_file >= self.max_open:
+            handler.close()
+            handler = None
+        return n_atom, n_frame, handler
 
-        if set([handler.n_atom for handler in self._handlers]).__len__() != 1:
+    def get_info(self):
+        n_file = len(self._files)
+        n_atoms = np.zeros(n_file, dtype=int)
+        n_frames = np.zeros(n_file, dtype=int)
+        with ThreadPoolExecutor(min(self.n_thread, n_file)) as executor:
+            futures = [executor.submit(self._scan, i_file) for i_file in range(n_file)]
+
+        # all the files have been scanned when the executor is shut down
+        error = None
+        for i_file, future in enumerate(futures):
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            n_atoms[i_file], n_frames[i_file], handler = future.result()
+            if handler is not None:
+                self._handlers[i_file] = handler
+        if error is not None:
+            # close the handlers opened successfully before reporting the error
+            self.close()
+            raise error
+
+        if len(set(n_atoms)) != 1:
+            self.close()
             raise Exception('All trajectories should have same number of atoms')
 
-        self.n_frame = len(self._i_frame_offset)
-        self.n_atom = self._handlers[0].n_atom
+        # the index of the first frame of each file in the combined trajectory
+        self._frame_starts = np.concatenate([[0], np.cumsum(n_frames)])
+        self.n_frame = int(self._frame_starts[-1])
+        self.n_atom = int(n_atoms[0])
         return self.n_atom, self.n_frame
 
+    @contextmanager
+    def _use_handler(self, i_file):
+        '''
+        Get the handler for a file. Open it if it is not opened yet, and close the least recently used one if required.
+        The handler will not be closed by other threads until the context is exited.
+        '''
+        with self._lock:
+            handler = self._handlers.get(i_file)
+            if handler is not None:
+                self._handlers.move_to_end(i_file)
+            else:
+                # the handlers in use by other threads are not closed. The limit may be exceeded temporarily
+                idle = [i for i in self._handlers if self._n_users[i] == 0]
+                for i in idle[:max(len(self._handlers) - self.max_open + 1, 0)]:
+                    self._handlers.pop(i).close()
+                handler = self._open(i_file)
+                self._handlers[i_file] = handler
+            self._n_users[i_file] += 1
+        try:
+            yield handler
+        finally:
+            with self._lock:
+                self._n_users[i_file] -= 1
+
+    def _locate(self, i_frames):
+        '''
+        Get the index of file and the index of frame in that file for frames in the combined trajectory.
+        '''
+        i_files = np.searchsorted(self._frame_starts, i_frames, side='right') - 1
+        return i_files, i_frames - self._frame_starts[i_files]
+
     def close(self):
-        for handler in self._handlers:
+        for handler in self._handlers.values():
             handler.close()
+        self._handlers.clear()
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        i_file, i = self._locate(i_frame)
+        with self._use_handler(int(i_file)) as handler:
+            handler.read_frame(int(i), frame, atoms)
+
+    def read_metadata(self):
+        metadata = []
+        for i_file in range(len(self._files)):
+            with self._use_handler(i_file) as handler:
+                metadata.append(handler.read_metadata())
+        return tuple(np.concatenate(arrays) for arrays in zip(*metadata))
 
-    def read_frame(self, i_frame, frame):
-        handler = self._i_frame_handler[i_frame]
-        i = self._i_frame_offset[i_frame]
-        handler.read_frame(i, frame)
+    def read_positions(self, i_frames, positions, boxes, steps, times, atoms=None, velocities=None, charges=None):
+        # dispatch the frames to the handlers, so that the handlers can read their frames at once
+        i_files, i_locals = self._locate(np.asarray(i_frames, dtype=int))
+        for i_file in np.unique(i_files):
+            idx = np.flatnonzero(i_files == i_file)
+            n = len(idx)
+            arrays = [np.empty((n,) + array.shape[1:], dtype=array.dtype) if array is not None else None
+                      for array in (positions, boxes, steps, times, velocities, charges)]
+            with self._use_handler(int(i_file)) as handler:
+                handler.read_positions(i_locals[idx].tolist(), *arrays[:4], atoms=atoms,
+                                       velocities=arrays[4], charges=arrays[5])
+            for array, _array in zip((positions, boxes, steps, times, velocities, charges), arrays):
+                if array is not None:
+                    array[idx] = _array
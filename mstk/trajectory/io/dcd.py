@@ -1,14 +1,304 @@
+import os
+import struct
 import numpy as np
+from mstk import logger
 from mstk.chem.constant import *
+from mstk.topology import UnitCell
 from mstk.trajectory import Frame
 from mstk.trajectory.handler import TrjHandler
 
+# the time unit of CHARMM (AKMA) in ps
+AKMA_TIME = 0.048888821
+
 
 class Dcd(TrjHandler):
     '''
     Read and write step, cell and positions from/to DCD file.
 
-    Currently mstk use chemfiles to support DCD file.
+    DCD is a fixed-record binary format, therefore the location of every frame can be calculated arithmetically.
+    The file is memory-mapped in read mode,
+    and the positions of all frames are exposed as a strided view of shape (n_frame, n_atom, 3) without copying.
+    Therefore, the positions of many frames can be read at once with :func:`read_positions`.
+
+    CHARMM, NAMD and OpenMM flavors of DCD files are supported in both endianness.
+    For file with fixed atoms, which cannot be handled by this class,
+    the parsing will be delegated to :class:`ChemfilesDcd` if chemfiles is available.
+    '''
+
+    def __init__(self, file, mode='r'):
+        super().__init__()
+
+        if mode not in ('r', 'w', 'a'):
+            raise Exception('Invalid mode')
+
+        self._fallback = None
+        self._n_frame_written = 0
+        self._istart = 0
+        self._nsavc = 1
+        self._nstep = -1  # the step of last frame written
+        self._header_outdated = False  # whether or not NSET and NSTEP in the header should be rewritten
+
+        if mode == 'r':
+            self._file = open(file, 'rb')
+            if not self._parse_header():
+                logger.warning(f'Fixed atoms in DCD file is not supported natively. Try chemfiles for {file}')
+                self._file.close()
+                self._fallback = ChemfilesDcd(file, mode)
+                return
+            self._mmap = np.memmap(file, dtype=np.uint8, mode='r')
+        elif mode == 'a' and os.path.exists(file) and os.path.getsize(file) > 0:
+            self._file = open(file, 'r+b')
+            if not self._parse_header():
+                raise Exception('Cannot append to DCD file with fixed atoms')
+            if not self._has_cell or self._four_dims:
+                raise Exception('Can only append to DCD file with unit cell and without the fourth dimension')
+            self._n_frame_written = self._get_n_frame()
+            # discard the incomplete frame at the end if there is any
+            self._file.truncate(self._frame_start + self._frame_size * self._n_frame_written)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(file, 'wb')
+            self._endian = '<'
+
+    def close(self):
+        if self._fallback is not None:
+            self._fallback.close()
+            return
+        self._mmap = None
+        if self._header_outdated:
+            self._update_header()
+        self._file.close()
+
+    def _parse_header(self):
+        '''
+        Parse the header of DCD file and calculate the layout of frames.
+
+        Returns
+        -------
+        supported : bool
+            False if there are fixed atoms in this DCD file, which is not supported.
+        '''
+        self._file.seek(0)
+        head = self._file.read(92)
+        if len(head) < 92:
+            raise Exception('Invalid DCD file')
+
+        for endian in ('<', '>'):
+            if struct.unpack(endian + 'i', head[:4])[0] == 84 and head[4:8] == b'CORD':
+                break
+        else:
+            raise Exception('Invalid DCD file')
+        self._endian = endian
+
+        icntrl = struct.unpack(endian + '20i', head[8:88])
+        self._istart, self._nsavc = icntrl[1], icntrl[2]
+        is_charmm = icntrl[19] != 0
+        self._delta = struct.unpack(endian + 'f', head[44:48])[0] if is_charmm else 0.0
+        self._has_cell = is_charmm and icntrl[10] != 0
+        self._four_dims = is_charmm and icntrl[11] != 0
+        if icntrl[8] != 0:
+            return False
+
+        # title block and number of atoms
+        length = struct.unpack(endian + 'i', self._file.read(4))[0]
+        self._file.seek(length + 4, os.SEEK_CUR)
+        length, self.n_atom, _ = struct.unpack(endian + '3i', self._file.read(12))
+        if length != 4:
+            raise Exception('Invalid DCD file')
+
+        self._frame_start = self._file.tell()
+        self._frame_size = (4 * self.n_atom + 8) * (4 if self._four_dims else 3) + (56 if self._has_cell else 0)
+        return True
+
+    def _get_n_frame(self):
+        # calculate the number of frames from file size, because NSET in header is not reliable for truncated files
+        return (os.path.getsize(self._file.name) - self._frame_start) // self._frame_size
+
+    def get_info(self):
+        if self._fallback is not None:
+            return self._fallback.get_info()
+
+        self.n_frame = self._get_n_frame()
+        if self.n_frame == 0:
+            raise Exception('Empty DCD file')
+
+        # strided views into the memory map. No data is copied
+        size_record = 4 * self.n_atom + 8
+        offset = self._frame_start + (56 if self._has_cell else 0) + 4
+        self._positions = np.ndarray((self.n_frame, self.n_atom, 3), dtype=self._endian + 'f4', buffer=self._mmap,
+                                     offset=offset, strides=(self._frame_size, 4, size_record))
+        if self._has_cell:
+            self._cell = UnitCell()
+            self._cells = np.ndarray((self.n_frame, 6), dtype=self._endian + 'f8', buffer=self._mmap,
+                                     offset=self._frame_start + 4, strides=(self._frame_size, 8))
+
+        return self.n_atom, self.n_frame
+
+    @property
+    def positions(self):
+        '''
+        The positions of all frames in the DCD file, in unit of A.
+
+        It is a read-only view of the memory-mapped file. No data is copied.
+
+        Returns
+        -------
+        positions : np.ndarray
+            The positions is a float32 array of shape (n_frame, n_atom, 3)
+        '''
+        if self._fallback is not None:
+            raise Exception('Positions view is not available for DCD file parsed by chemfiles')
+        return self._positions
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        if self._fallback is not None:
+            return self._fallback.read_frame(i_frame, frame, atoms)
+
+        # only the selected atoms are gathered from the memory map
+        view = self._positions[i_frame] if atoms is None else self._positions[i_frame, atoms]
+        np.divide(view, 10, out=frame.positions, dtype=float)  # convert from A to nm
+        if self._has_cell:
+            frame.cell.set_box(self._cell_from_record(self._cells[i_frame]))
+        frame.step = self._istart + i_frame * self._nsavc
+        if self._delta != 0:
+            frame.time = frame.step * self._delta * AKMA_TIME
+
+    def read_positions(self, i_frames, positions, boxes, steps, times, atoms=None, velocities=None, charges=None):
+        if self._fallback is not None:
+            return self._fallback.read_positions(i_frames, positions, boxes, steps, times, atoms, velocities, charges)
+
+        i_frames = np.asarray(i_frames, dtype=int)
+        if atoms is None:
+            view = self._positions[i_frames]
+        else:
+            view = self._positions[i_frames[:, None], atoms]
+        np.divide(view, 10, out=positions, dtype=positions.dtype)  # convert from A to nm
+
+        for ii, i_frame in enumerate(i_frames):
+            if self._has_cell:
+                self._cell.set_box(self._cell_from_record(self._cells[i_frame]))
+                boxes[ii] = self._cell.vectors
+            else:
+                boxes[ii] = 0
+        steps[:] = self._istart + i_frames * self._nsavc
+        times[:] = steps * self._delta * AKMA_TIME if self._delta != 0 else -1
+        if velocities is not None:
+            velocities.fill(0)
+        if charges is not None:
+            charges.fill(0)
+
+    def read_metadata(self):
+        if self._fallback is not None:
+            return self._fallback.read_metadata()
+
+        # steps and times are calculated from the header. Boxes are gathered from the memory map
+        steps = self._istart + np.arange(self.n_frame, dtype=np.int64) * self._nsavc
+        if self._delta != 0:
+            times = steps * self._delta * AKMA_TIME
+        else:
+            times = np.full(self.n_frame, -1, dtype=float)
+        boxes = np.zeros((self.n_frame, 3, 3), dtype=float)
+        if self._has_cell:
+            for i_frame in range(self.n_frame):
+                self._cell.set_box(self._cell_from_record(self._cells[i_frame]))
+                boxes[i_frame] = self._cell.vectors
+        return steps, times, boxes
+
+    @staticmethod
+    def _cell_from_record(record):
+        '''
+        Get box lengths and angles from unit cell record [A, gamma, B, beta, alpha, C].
+
+        Recent versions of CHARMM and NAMD write the cosine of angles instead of angles.
+        '''
+        lengths = np.array([record[0], record[2], record[5]], dtype=float) / 10  # convert from A to nm
+        angles = np.array([record[4], record[3], record[1]], dtype=float)
+        if all(np.abs(angles) <= 1):
+            angles = np.arccos(angles) * RAD2DEG
+        return [lengths, angles * DEG2RAD]
+
+    def _write_header(self, n_atom):
+        header = struct.pack('<i4s20ii', 84, b'CORD', 0, self._istart, self._nsavc, 0, 0, 0, 0, 3 * n_atom, 0, 0, 1,
+                             0, 0, 0, 0, 0, 0, 0, 0, 24, 84)
+        # empty title block and number of atoms
+        header += struct.pack('<3i', 4, 0, 4) + struct.pack('<3i', 4, n_atom, 4)
+        self._file.write(header)
+        self.n_atom = n_atom
+
+    def _update_header(self):
+        # seeking pushes the buffered frames to disk. Therefore, the header is updated only when the file is flushed
+        position = self._file.tell()
+        self._file.seek(8)
+        self._file.write(struct.pack(self._endian + '3i', self._n_frame_written, self._istart, self._nsavc))
+        if self._nstep >= 0:
+            self._file.seek(20)
+            self._file.write(struct.pack(self._endian + 'i', self._nstep))
+        self._file.seek(position)
+        self._header_outdated = False
+
+    def _frame_written(self):
+        '''
+        Update NSET and NSTEP in the header and flush the file if `flush_interval` frames have been written since last flush,
+        so that the file on disk is always valid.
+        '''
+        self._n_frame_unflushed += 1
+        if self.flush_interval > 0 and self._n_frame_unflushed >= self.flush_interval:
+            self._update_header()
+            self._file.flush()
+            self._n_frame_unflushed = 0
+
+    def write_frame(self, frame, subset=None, **kwargs):
+        '''
+        Write a frame into the opened DCD file
+
+        Parameters
+        ----------
+        frame : Frame
+        subset : list of int, optional
+        kwargs : dict
+            Ignored
+        '''
+        if subset is None:
+            positions = frame.positions
+        else:
+            positions = frame.positions[subset]
+
+        if self._n_frame_written == 0:
+            # record ISTART and NSAVC from the steps of the first two frames
+            if frame.step >= 0:
+                self._istart = frame.step
+            if self.n_atom == -1:
+                self._write_header(len(positions))
+        elif self._n_frame_written == 1 and frame.step > self._istart:
+            self._nsavc = frame.step - self._istart
+
+        if len(positions) != self.n_atom:
+            raise Exception('Number of atoms should be the same for all frames in DCD file')
+
+        size_record = 4 * self.n_atom
+        lengths = frame.cell.lengths * 10  # convert from nm to A
+        alpha, beta, gamma = np.degrees(frame.cell.angles)
+        data = struct.pack(self._endian + 'i6di', 48, lengths[0], gamma, lengths[1], beta, alpha, lengths[2], 48)
+        marker = struct.pack(self._endian + 'i', size_record)
+        xyz = (positions * 10).astype(self._endian + 'f4')  # convert from nm to A
+        for k in range(3):
+            data += marker + xyz[:, k].tobytes() + marker
+        self._file.write(data)
+
+        self._n_frame_written += 1
+        if frame.step >= 0:
+            self._nstep = frame.step
+        self._header_outdated = True
+        self._frame_written()
+
+
+class ChemfilesDcd(TrjHandler):
+    '''
+    Read and write step, cell and positions from/to DCD file with chemfiles.
+
+    It is the fallback of :class:`Dcd` for DCD files cannot be parsed natively.
+    The file is buffered by chemfiles, which cannot be flushed before closing.
+    Therefore, `flush_interval` has no effect for this handler.
     '''
 
     def __init__(self, file, mode='r'):
@@ -17,7 +307,7 @@ class Dcd(TrjHandler):
         try:
             import chemfiles
         except:
-            raise ImportError('Currently mstk use chemfiles to parse DCD format. Cannot import chemfiles')
+            raise ImportError('Cannot import chemfiles for parsing DCD format')
 
         if mode not in ('r', 'w', 'a'):
             raise Exception('Invalid mode')
@@ -39,14 +329,17 @@ class Dcd(TrjHandler):
 
         return self.n_atom, self.n_frame
 
-    def read_frame(self, i_frame, frame):
-        cf_frame = self._dcd.read_step(i_frame)
+    def read_frame(self, i_frame, frame, atoms=None):
+        # chemfiles trajectory is not thread-safe
+        with self._lock:
+            cf_frame = self._dcd.read_step(i_frame)
         cf_cell = cf_frame.cell
         lengths = [i / 10 for i in cf_cell.lengths]
         angles = [i * DEG2RAD for i in cf_cell.angles]
-        frame.positions = cf_frame.positions.astype(float) / 10
+        positions = cf_frame.positions if atoms is None else cf_frame.positions[atoms]
+        frame.positions = positions.astype(float) / 10
         frame.cell.set_box([lengths, angles])
-        frame.step = frame.step
+        frame.step = cf_frame.step
 
     def write_frame(self, frame, subset=None, **kwargs):
         '''
@@ -1,7 +1,9 @@
 import numpy as np
-from mstk.topology import Topology
+from mstk.topology import Topology, UnitCell
 from mstk.trajectory import Frame
 from mstk.trajectory.handler import TrjHandler
+from mstk.trajectory.index import FrameIndex, scan_frame_offsets
+from mstk.trajectory.compress import open_file
 
 
 class Gro(TrjHandler):
@@ -9,78 +11,130 @@ class Gro(TrjHandler):
     Read and write cell, atomic positions and optionally velocities from/to GRO file.
     '''
 
+    compressible = True
+
     def __init__(self, file, mode='r'):
         super().__init__()
         if mode not in ('r', 'w', 'a'):
             raise Exception('Invalid mode')
 
-        if mode == 'r':
-            # open it in binary mode so that we can correctly seek despite of line ending
-            self._file = open(file, 'rb')
-        elif mode == 'a':
-            self._file = open(file, 'ab')
-        elif mode == 'w':
-            self._file = open(file, 'wb')
+        # open it in binary mode so that we can correctly seek despite of line ending
+        # compressed file is decompressed transparently in 'r' mode
+        self._file = open_file(file, mode)
+        self._template = None
 
     def get_info(self):
+        self._index = self._load_or_build_index(self._file.name)
+        self._frame_offset = self._index.offsets
+        self.n_atom = self._index.n_atom
+        self.n_frame = self._index.n_frame
+
+        return self.n_atom, self.n_frame
+
+    def _build_index(self):
         try:
             self._file.readline()
-            self.n_atom = int(self._file.readline())
+            n_atom = int(self._file.readline())
         except:
             print('Invalid gro file')
             raise
         self._file.seek(0)
 
-        # read in the file once and build a list of line offsets
-        # the last element is the length of whole file
-        self._line_offset = [0]
-        offset = 0
-        for line in self._file:
-            offset += len(line)
-            self._line_offset.append(offset)
-        self._file.seek(0)
-
-        # build a list of frame offsets
-        self.n_frame = len(self._line_offset) // (3 + self.n_atom)
-        self._frame_offset = []
-        for i in range(self.n_frame + 1):
-            line_start = (3 + self.n_atom) * i
-            self._frame_offset.append(self._line_offset[line_start])
-
-        return self.n_atom, self.n_frame
-
-    def read_frame(self, i_frame, frame):
-        # skip to frame i and read only this frame
-        self._file.seek(self._frame_offset[i_frame])
-        lines = self._file.read(self._frame_offset[i_frame + 1] - self._frame_offset[i_frame]) \
-            .decode().splitlines()
-        # assume there are velocities. we'll see later
-        frame.has_velocity = True
-        for i in range(self.n_atom):
-            line = lines[i + 2]
-            x = float(line[20:28])
-            y = float(line[28:36])
-            z = float(line[36:44])
-            frame.positions[i][:] = x, y, z
-
-            if frame.has_velocity:
-                try:
-                    vx = float(line[44:52])
-                    vy = float(line[52:60])
-                    vz = float(line[60:68])
-                except:
-                    frame.has_velocity = False
-                else:
-                    frame.velocities[i][:] = vx, vy, vz
-        _box = tuple(map(float, lines[self.n_atom + 2].split()))
+        # record the offsets of frames, so that we can read arbitrary frame later
+        offsets = scan_frame_offsets(self._file, n_atom + 3)
+
+        return FrameIndex(n_atom, offsets)
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        start, end = self._frame_offset[i_frame], self._frame_offset[i_frame + 1]
+        block = None
+        if atoms is not None:
+            # atom lines are of fixed width, so only the lines of selected atoms are read
+            block, box_line = self._read_uniform_lines(start, end, 2, self.n_atom, atoms)
+        if block is None:
+            lines = self._read_at(start, end - start).splitlines()
+            rows = lines[2:self.n_atom + 2] if atoms is None else [lines[i + 2] for i in atoms]
+            # decode the atom block at once as a fixed-width char array
+            # lines shorter than 68 columns are padded with null bytes, longer ones are truncated
+            block = np.array(rows, dtype='S68').view(np.uint8).reshape(len(rows), 68)
+            box_line = lines[self.n_atom + 2]
+
+        frame.positions[:] = self._parse_columns(block, 20, 3)
+
+        # velocities are either present for all atoms or absent for all atoms
+        frame.has_velocity = len(block[0].tobytes().rstrip(b'\0').rstrip()) >= 68
+        if frame.has_velocity:
+            try:
+                frame.velocities[:] = self._parse_columns(block, 44, 3)
+            except ValueError:
+                frame.has_velocity = False
+
+        frame.cell.set_box(self._parse_box(box_line))
+
+    @staticmethod
+    def _parse_box(line):
+        '''
+        Parse the box line into the argument for :func:`UnitCell.set_box`
+        '''
+        _box = tuple(map(float, line.split()))
         if len(_box) == 3:
-            frame.cell.set_box(_box)
+            return _box
         elif len(_box) == 9:
             ax, by, cz, ay, az, bx, bz, cx, cy = _box
-            frame.cell.set_box([[ax, ay, az], [bx, by, bz], [cx, cy, cz]])
+            return [[ax, ay, az], [bx, by, bz], [cx, cy, cz]]
         else:
             raise ValueError('Invalid box')
 
+    def read_metadata(self):
+        return self._load_or_build_metadata(self._file.name)
+
+    def _scan_metadata(self):
+        steps = np.empty(self.n_frame, dtype=np.int64)
+        times = np.empty(self.n_frame, dtype=float)
+        boxes = np.empty((self.n_frame, 3, 3), dtype=float)
+        for i_frame in range(self.n_frame):
+            start, end = self._frame_offset[i_frame], self._frame_offset[i_frame + 1]
+            # only the title line and the box line at the end of the frame are read
+            self._file.seek(start)
+            steps[i_frame], times[i_frame] = self._parse_step_time(self._file.readline())
+            tail_start = max(start, end - 512)
+            self._file.seek(tail_start)
+            box_line = self._file.read(end - tail_start).rstrip().rsplit(b'\n', 1)[-1]
+            boxes[i_frame] = UnitCell(self._parse_box(box_line)).vectors
+        return steps, times, boxes
+
+    @staticmethod
+    def _parse_columns(block, start, n_column, width=8):
+        '''
+        Parse several adjacent fixed-width columns of a char array into a float array of shape (n_row, n_column)
+        '''
+        chars = np.ascontiguousarray(block[:, start:start + width * n_column])
+        return chars.view('S%i' % width).astype(float)
+
+    def _get_template(self, topology, subset, write_velocity):
+        '''
+        Get the format string of the atom block.
+
+        The residue and atom columns are formatted only once for the same topology, subset and write_velocity,
+        so that only the numbers need to be formatted for every frame.
+        It is assumed that the topology is not modified during writing.
+        '''
+        key = (subset if isinstance(subset, range) else tuple(subset), write_velocity)
+        if self._template is not None and self._template[0] is topology and self._template[1] == key:
+            return self._template[2]
+
+        columns = '%8.3f%8.3f%8.3f' + ('%8.4f%8.4f%8.4f' if write_velocity else '') + '\n'
+        lines = []
+        for id in subset:
+            atom = topology.atoms[id]
+            residue = atom.residue
+            prefix = '%5i%5s%5s%5i' % ((residue.id + 1) % 100000, residue.name[:5], atom.symbol[:5],
+                                       (atom.id + 1) % 100000)
+            lines.append(prefix.replace('%', '%%') + columns)
+        template = ''.join(lines)
+        self._template = (topology, key, template)
+        return template
+
     def write_frame(self, frame, topology, subset=None, write_velocity=False, **kwargs):
         '''
         Write a frame into the opened GRO file
@@ -96,33 +150,29 @@ class Gro(TrjHandler):
         kwargs : dict
             Ignored
         '''
-        if subset is None:
-            subset = list(range(len(frame.positions)))
         if write_velocity and not frame.has_velocity:
             raise Exception('Velocities are requested but not exist in frame')
+        index = slice(None) if subset is None else subset
+        if subset is None:
+            subset = range(len(frame.positions))
+
+        values = positions = frame.positions[index]
+        if (np.abs(positions) >= 1000).any():
+            raise Exception('Positions are too large to be written in GRO format')
+        if write_velocity:
+            values = np.hstack([positions, frame.velocities[index]])
 
         string = 'Created by mstk: step= %i, t= %f ps\n' % (frame.step, frame.time)
         string += '%i\n' % len(subset)
-
-        for id in subset:
-            atom = topology.atoms[id]
-            residue = atom.residue
-            pos = frame.positions[id]
-            if any(np.abs(pos) >= 1000):
-                raise Exception('Positions are too large to be written in GRO format')
-            string += '%5i%5s%5s%5i%8.3f%8.3f%8.3f' % (
-                (residue.id + 1) % 100000, residue.name[:5], atom.symbol[:5], (atom.id + 1) % 100000,
-                pos[0], pos[1], pos[2])
-            if write_velocity:
-                vel = frame.velocities[id]
-                string += '%8.4f%8.4f%8.4f' % (vel[0], vel[1], vel[2])
-            string += '\n'
+        # the whole atom block is formatted at once
+        string += self._get_template(topology, subset, write_velocity) % tuple(values.ravel().tolist())
 
         a, b, c = frame.cell.vectors
         string += ' %.4f %.4f %.4f %.4f %.4f %.4f %.4f %.4f %.4f\n' % (
             a[0], b[1], c[2], a[1], a[2], b[0], b[2], c[0], c[1])
 
         self._file.write(string.encode())
-        self._file.flush()
+        self._frame_written()
+
 
 TrjHandler.register_format('.gro', Gro)
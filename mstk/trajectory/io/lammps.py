@@ -1,117 +1,302 @@
 import numpy as np
 import pandas as pd
-from io import StringIO
+from io import BytesIO
 from mstk import logger
+from mstk.topology import UnitCell
 from mstk.trajectory.handler import TrjHandler
+from mstk.trajectory.index import FrameIndex, scan_frame_markers
+from mstk.trajectory.compress import open_file
 
 
 class LammpsTrj(TrjHandler):
     '''
-    Read step, cell and atomic positions (and charges if provided) from dump file of Lammps.
+    Read and write step, cell and atomic positions (and charges if provided) from/to dump file of Lammps.
 
     Velocities are ignored.
     Because the topology information are detailed in data file, the mol, type, element in dump file are also ignored.
     The cell used by Lammps is not originated at (0, 0, 0) usually.
     This handler will translate the positions of atoms based on the lower bound of the cell.
 
-    Writing to LammpsDump is not supported yet.
+    The number of atoms can be different in each frame (e.g. for GCMC or deposition simulations).
+    The number of atoms in every frame is recorded in the frame index,
+    and the frame passed to :func:`read_frame` is resized accordingly.
+    The atoms are sorted by their ids in every frame.
+    If the ids are not consecutive (e.g. some atoms have been deleted), the atoms are stored in the order of ids.
     '''
 
+    compressible = True
+
     def __init__(self, trj_file, mode='r'):
         super().__init__()
+        if mode not in ('r', 'w', 'a'):
+            raise Exception('Invalid mode')
 
-        if mode == 'r':
-            # open it in binary mode so that we can correctly seek despite of line ending
-            self._file = open(trj_file, 'rb')
-        else:
-            raise Exception('Writing support for LammpsTrj haven\'t been implemented')
+        # open it in binary mode so that we can correctly seek despite of line ending
+        # compressed file is decompressed transparently in 'r' mode
+        self._file = open_file(trj_file, mode)
+        self._atom_map = None
+        self._template = None
 
     def get_info(self):
-        try:
-            self._file.readline()
-            self._file.readline()
-            self._file.readline()
-            self.n_atom = int(self._file.readline())
-        except:
-            print('Invalid lammpstrj file')
-            raise
-        self._file.seek(0)
+        self._index = self._load_or_build_index(self._file.name)
+        self._frame_offset = self._index.offsets
+        self.n_atom = self._index.n_atom
+        self.n_frame = self._index.n_frame
+        if self._index.n_atoms is not None:
+            self._n_atoms = self._index.n_atoms
+        else:
+            self._n_atoms = np.full(self.n_frame, self.n_atom, dtype=np.int64)
+
+        return self.n_atom, self.n_frame
 
-        # read in the file once and build a list of line offsets
-        # the last element is the length of whole file
-        self._line_offset = [0]
-        offset = 0
-        for line in self._file:
-            offset += len(line)
-            self._line_offset.append(offset)
+    def _build_index(self):
+        # frames are located by the TIMESTEP section, because the number of atoms can vary between frames
+        offsets, n_lines = scan_frame_markers(self._file, b'ITEM: TIMESTEP')
+        if len(n_lines) == 0:
+            raise Exception('Invalid lammpstrj file')
+
+        n_atoms = np.full(len(n_lines), -1, dtype=np.int64)
+        for i_frame in range(len(n_lines)):
+            self._file.seek(offsets[i_frame])
+            lines = [self._file.readline() for _ in range(4)]
+            try:
+                n_atoms[i_frame] = int(lines[3])
+            except ValueError:
+                pass
         self._file.seek(0)
 
-        # build a list of frame offsets
-        self.n_frame = len(self._line_offset) // (9 + self.n_atom)
-        self._frame_offset = []
-        for i in range(self.n_frame + 1):
-            line_start = (9 + self.n_atom) * i
-            self._frame_offset.append(self._line_offset[line_start])
+        n_lines_expected = n_atoms + 9
+        invalid = np.flatnonzero((n_atoms < 0) | (n_lines != n_lines_expected))
+        if len(invalid) > 0 and invalid[0] != len(n_lines) - 1:
+            raise Exception('Invalid frame %i in lammpstrj file' % invalid[0])
+        if len(invalid) > 0:
+            if n_atoms[-1] >= 0 and n_lines[-1] > n_lines_expected[-1]:
+                # the last frame is followed by the incomplete header of next frame
+                self._file.seek(offsets[-2])
+                for _ in range(n_lines_expected[-1]):
+                    self._file.readline()
+                offsets[-1] = self._file.tell()
+                self._file.seek(0)
+            else:
+                # incomplete frame at the end of the file is ignored
+                offsets = offsets[:-1]
+                n_atoms = n_atoms[:-1]
+                if len(n_atoms) == 0:
+                    raise Exception('Invalid lammpstrj file')
 
-        return self.n_atom, self.n_frame
+        return FrameIndex(int(n_atoms[0]), offsets, n_atoms=n_atoms)
 
-    def read_frame(self, i_frame, frame):
-        # skip to frame i and read only this frame
-        self._file.seek(self._frame_offset[i_frame])
-        string = self._file.read(self._frame_offset[i_frame + 1] - self._frame_offset[i_frame]).decode()
-        lines = string.splitlines()
-        frame.step = int(lines[1])
+    @staticmethod
+    def _parse_box(lines):
+        '''
+        Parse the three lines of BOX BOUNDS section into the argument for :func:`UnitCell.set_box`
+        and the lower bound of the box.
+        '''
         try:
-            xlo, xhi = tuple(map(lambda x: float(x) / 10, lines[5].split()))  # convert from A to nm
-            ylo, yhi = tuple(map(lambda x: float(x) / 10, lines[6].split()))
-            zlo, zhi = tuple(map(lambda x: float(x) / 10, lines[7].split()))
-            frame.cell.set_box([xhi - xlo, yhi - ylo, zhi - zlo])
+            xlo, xhi = tuple(map(lambda x: float(x) / 10, lines[0].split()))  # convert from A to nm
+            ylo, yhi = tuple(map(lambda x: float(x) / 10, lines[1].split()))
+            zlo, zhi = tuple(map(lambda x: float(x) / 10, lines[2].split()))
+            _box = [xhi - xlo, yhi - ylo, zhi - zlo]
         except:
             # read triclinic box, convert from A to nm
-            xlo, xhi, bx = tuple(map(lambda x: float(x) / 10, lines[5].split()))
-            ylo, yhi, cx = tuple(map(lambda x: float(x) / 10, lines[6].split()))
-            zlo, zhi, cy = tuple(map(lambda x: float(x) / 10, lines[7].split()))
-            frame.cell.set_box([[xhi - xlo, 0, 0], [bx, yhi - ylo, 0], [cx, cy, zhi - zlo]])
-        box = frame.cell.get_size()
-
-        tokens = lines[8].split()
-        title = tokens[2:]
-
-        data = '\n'.join(lines[9:])
-        df = pd.read_csv(StringIO(data), header=None, index_col=None, names=title, sep=r'\s+')
-        wrapped = False
-        if 'x' in df.columns:
-            df['x'] = df['x'] / 10  # convert from A to nm
-            df['y'] = df['y'] / 10
-            df['z'] = df['z'] / 10
-            wrapped = True
-        elif 'xs' in df.columns:
-            df['x'] = df.xs * box[0] + xlo
-            df['y'] = df.ys * box[1] + ylo
-            df['z'] = df.zs * box[2] + zlo
-            wrapped = True
-        elif 'xu' in df.columns:
-            df['x'] = df.xu / 10  # convert from A to nm
-            df['y'] = df.yu / 10
-            df['z'] = df.zu / 10
-        elif 'xsu' in df.columns:
-            df['x'] = df.xsu * box[0] + xlo
-            df['y'] = df.ysu * box[1] + ylo
-            df['z'] = df.zsu * box[2] + zlo
-        if wrapped:
-            if 'ix' not in df.columns:
-                logger.warning('Image flag not found for wrapped positions')
-            else:
-                # ix is revered words for pandas, so use df['ix'] instead of df.ix
-                df['x'] += df['ix'] * box[0]
-                df['y'] += df['iy'] * box[1]
-                df['z'] += df['iz'] * box[2]
-
-        frame.has_charge = 'q' in df.columns
-        for row in df.itertuples():
-            frame.positions[row.id - 1] = np.array([row.x, row.y, row.z])
+            xlo, xhi, bx = tuple(map(lambda x: float(x) / 10, lines[0].split()))
+            ylo, yhi, cx = tuple(map(lambda x: float(x) / 10, lines[1].split()))
+            zlo, zhi, cy = tuple(map(lambda x: float(x) / 10, lines[2].split()))
+            # the bounds in dump file enclose the whole triclinic box
+            xlo -= min(0, bx, cx, bx + cx)
+            xhi -= max(0, bx, cx, bx + cx)
+            ylo -= min(0, cy)
+            yhi -= max(0, cy)
+            _box = [[xhi - xlo, 0, 0], [bx, yhi - ylo, 0], [cx, cy, zhi - zlo]]
+        return _box, np.array([xlo, ylo, zlo])
+
+    def read_metadata(self):
+        return self._load_or_build_metadata(self._file.name)
+
+    def _scan_metadata(self):
+        # time is not recorded in dump file
+        steps = np.empty(self.n_frame, dtype=np.int64)
+        boxes = np.empty((self.n_frame, 3, 3), dtype=float)
+        cell = UnitCell()
+        for i_frame in range(self.n_frame):
+            # only the first 8 lines of header are read
+            self._file.seek(self._frame_offset[i_frame])
+            lines = [self._file.readline() for _ in range(8)]
+            steps[i_frame] = int(lines[1])
+            cell.set_box(self._parse_box(lines[5:8])[0])
+            boxes[i_frame] = cell.vectors
+        return steps, np.full(self.n_frame, -1, dtype=float), boxes
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        n_atom = int(self._n_atoms[i_frame])
+        if atoms is None:
+            if frame.n_atom != n_atom:
+                frame.resize(n_atom)
+        elif n_atom != self.n_atom:
+            raise Exception('Selection of atoms is not supported for frames with different number of atoms')
+
+        # skip to frame i and read only this frame
+        start, end = self._frame_offset[i_frame], self._frame_offset[i_frame + 1]
+        string = self._read_at(start, end - start)
+        # the first 9 lines are header, the remaining is the atom block
+        lines = string.split(b'\n', 9)
+        frame.step = int(lines[1])
+        _box, lower = self._parse_box(lines[5:8])
+        frame.cell.set_box(_box)
+        vectors = frame.cell.vectors
+
+        title = lines[8].decode().split()[2:]
+        for coord in ('x', 'xs', 'xu', 'xsu'):
+            if coord in title:
+                break
+        else:
+            raise Exception('Positions not found in dump file')
+        suffix = coord[1:]
+        columns_xyz = ['x' + suffix, 'y' + suffix, 'z' + suffix]
+        wrapped = coord in ('x', 'xs')
+        has_image = all(col in title for col in ('ix', 'iy', 'iz'))
+        if wrapped and not has_image:
+            logger.warning('Image flag not found for wrapped positions')
+        frame.has_charge = 'q' in title
+        if n_atom == 0:
+            return
+
+        # only parse the columns we need. the element and other string columns are skipped
+        usecols = ['id'] + columns_xyz
+        if wrapped and has_image:
+            usecols += ['ix', 'iy', 'iz']
+        if frame.has_charge:
+            usecols.append('q')
+        df = pd.read_csv(BytesIO(lines[9]), header=None, index_col=None, names=title, usecols=usecols, sep=r'\s+')
+
+        ids = df['id'].to_numpy() - 1
+        if ids.min() < 0 or ids.max() >= n_atom:
+            # the ids are not consecutive. Store the atoms in the order of ids
+            ranks = np.empty(len(ids), dtype=int)
+            ranks[np.argsort(ids, kind='stable')] = np.arange(len(ids))
+            ids = ranks
+        if atoms is not None:
+            # map the id of atoms to the position in the selection. -1 means not selected
+            # read the cache only once, because it may be replaced by other threads in the meantime
+            mapping, cached_atoms = self._atom_map or (None, None)
+            if cached_atoms is not atoms:
+                mapping = np.full(self.n_atom, -1, dtype=int)
+                mapping[atoms] = np.arange(len(atoms))
+                self._atom_map = (mapping, atoms)
+            ids = mapping[ids]
+            selected = ids >= 0
+            ids = ids[selected]
+            df = df[selected]
+        positions = df[columns_xyz].to_numpy(dtype=float)
+        if coord in ('x', 'xu'):
+            positions /= 10  # convert from A to nm
+        else:
+            positions = positions @ vectors + lower
+        if wrapped and has_image:
+            positions += df[['ix', 'iy', 'iz']].to_numpy(dtype=float) @ vectors
+
+        # atoms are not necessarily sorted by id in dump file
+        frame.positions[ids] = positions
+        if frame.has_charge:
+            frame.charges[ids] = df['q'].to_numpy(dtype=float)
+
+    def read_positions(self, i_frames, positions, boxes, steps, times, atoms=None, velocities=None, charges=None):
+        if (self._n_atoms[list(i_frames)] != self.n_atom).any():
+            raise Exception('Frames with different number of atoms cannot be read into one array')
+        super().read_positions(i_frames, positions, boxes, steps, times, atoms=atoms,
+                               velocities=velocities, charges=charges)
+
+    def _get_template(self, topology, subset, write_charge, write_image):
+        '''
+        Get the format string of the atom block.
+
+        The id and type columns are formatted only once for the same topology, subset and columns,
+        so that only the numbers need to be formatted for every frame.
+        It is assumed that the topology is not modified during writing.
+        '''
+        key = (subset if isinstance(subset, range) else tuple(subset), write_charge, write_image)
+        if self._template is not None and self._template[0] is topology and self._template[1] == key:
+            return self._template[2]
+
+        columns = ' %.6f %.6f %.6f' + (' %.6f' if write_charge else '') + (' %i %i %i' if write_image else '') + '\n'
+        if topology is None:
+            lines = ['%i 1' % (id + 1) + columns for id in subset]
+        else:
+            # atom types are numbered in the order of their first appearance, which is consistent with data file
+            types = {}
+            for atom in topology.atoms:
+                types.setdefault(atom.type, len(types) + 1)
+            lines = ['%i %i' % (id + 1, types[topology.atoms[id].type]) + columns for id in subset]
+        template = ''.join(lines)
+        self._template = (topology, key, template)
+        return template
+
+    def write_frame(self, frame, topology=None, subset=None, write_charge=True, write_image=False, **kwargs):
+        '''
+        Write a frame into the opened dump file
+
+        The columns `id type xu yu zu` are written, followed by `q` if charges are written.
+        If `write_image` is True, the atoms are wrapped into the cell
+        and the columns `id type x y z` are written instead, followed by `q` and the image flags `ix iy iz`.
+        The atom types are numbered in the order of their first appearance in the topology.
+        If topology is not provided, all atoms are of type 1.
+
+        Parameters
+        ----------
+        frame : Frame
+        topology : Topology, optional
+        subset : list of int, optional
+        write_charge : bool
+            Whether or not charges should be written.
+            The charges are taken from the frame if available, otherwise from the topology.
+            If neither is available, charges are not written.
+        write_image : bool
+            Whether or not the wrapped positions and image flags should be written instead of the unwrapped positions.
+        kwargs : dict
+            Ignored
+        '''
+        if topology is not None and topology.n_atom != frame.n_atom:
+            raise Exception('Number of atoms in topology and frame do not match')
+        index = slice(None) if subset is None else subset
+        if subset is None:
+            subset = range(len(frame.positions))
+
+        positions = frame.positions[index] * 10  # convert from nm to A
+        vectors = frame.cell.vectors * 10
+        columns = [positions]
+        if write_image:
+            images = np.floor(positions @ np.linalg.inv(vectors))
+            columns[0] = positions - images @ vectors
+        if write_charge:
             if frame.has_charge:
-                frame.charges[row.id - 1] = float(row.q)
+                columns.append(frame.charges[index][:, None])
+            elif topology is not None:
+                charges = np.array([atom.charge for atom in topology.atoms], dtype=float)
+                columns.append(charges[index][:, None])
+            else:
+                write_charge = False
+        if write_image:
+            columns.append(images)
+        values = np.hstack(columns) if len(columns) > 1 else columns[0]
+
+        string = 'ITEM: TIMESTEP\n%i\nITEM: NUMBER OF ATOMS\n%i\n' % (frame.step, len(subset))
+        a, b, c = vectors
+        if frame.cell.is_rectangular:
+            string += 'ITEM: BOX BOUNDS pp pp pp\n0 %.6f\n0 %.6f\n0 %.6f\n' % (a[0], b[1], c[2])
+        else:
+            # the bounds enclose the whole triclinic box
+            xy, xz, yz = b[0], c[0], c[1]
+            string += 'ITEM: BOX BOUNDS xy xz yz pp pp pp\n%.6f %.6f %.6f\n%.6f %.6f %.6f\n0 %.6f %.6f\n' % (
+                min(0, xy, xz, xy + xz), a[0] + max(0, xy, xz, xy + xz), xy,
+                min(0, yz), b[1] + max(0, yz), xz, c[2], yz)
+        string += 'ITEM: ATOMS id type %s%s%s\n' % ('x y z' if write_image else 'xu yu zu',
+                                                      ' q' if write_charge else '',
+                                                      ' ix iy iz' if write_image else '')
+        # the whole atom block is formatted at once
+        string += self._get_template(topology, subset, write_charge, write_image) % tuple(values.ravel().tolist())
+
+        self._file.write(string.encode())
+        self._frame_written()
 
 
 TrjHandler.register_format('.lammpstrj', LammpsTrj)
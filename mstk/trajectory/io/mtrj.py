@@ -0,0 +1,229 @@
+import os
+import struct
+import numpy as np
+from mstk.trajectory.handler import TrjHandler
+
+MTRJ_MAGIC = b'MSTKTRJ\0'
+MTRJ_VERSION = 1
+
+_HEADER_FORMAT = '<8s5i'
+_HEADER_SIZE = 64
+
+_FLAG_VELOCITY = 1
+_FLAG_CHARGE = 2
+
+
+class Mtrj(TrjHandler):
+    '''
+    Read and write step, time, cell, positions and optionally velocities and charges from/to MTRJ file.
+
+    MTRJ is the native binary trajectory format of mstk.
+    It consists of a header of 64 bytes followed by fixed-size records, one record for each frame.
+    All numbers are stored in little-endian and in the units used by mstk (nm, ps, e),
+    so that no conversion is required when reading.
+    A record is made of
+
+    * step as int64
+    * time as float64
+    * box vectors as 3*3 float64
+    * positions as n_atom*3 float32 or float64
+    * velocities as n_atom*3 float32 or float64 (optional)
+    * charges as n_atom float32 or float64 (optional)
+
+    The file is memory-mapped in read mode, and the records are exposed as a structured array without copying.
+    Because the location of every frame can be calculated arithmetically, random access of frames is O(1).
+    The precision of floating numbers and the presence of velocities and charges are determined by the first frame written.
+    It is convenient to convert text trajectories (e.g. GRO, LAMMPS dump) into MTRJ once with `trjconv.py`
+    for faster analysis later.
+
+    Writing in single precision without velocities and charges,
+    every atom costs 12 bytes, which is several times smaller than the text formats.
+    '''
+
+    def __init__(self, file, mode='r'):
+        super().__init__()
+
+        if mode not in ('r', 'w', 'a'):
+            raise Exception('Invalid mode')
+
+        self._dtype = None
+        self._n_frame_written = 0
+
+        if mode == 'r':
+            self._file = open(file, 'rb')
+            self._parse_header()
+            self._mmap = np.memmap(file, dtype=np.uint8, mode='r')
+        elif mode == 'a' and os.path.exists(file) and os.path.getsize(file) > 0:
+            self._file = open(file, 'r+b')
+            self._parse_header()
+            self._n_frame_written = self._get_n_frame()
+            # discard the incomplete frame at the end if there is any
+            self._file.truncate(_HEADER_SIZE + self._dtype.itemsize * self._n_frame_written)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(file, 'wb')
+
+    def close(self):
+        self._records = None
+        self._mmap = None
+        self._file.close()
+
+    @staticmethod
+    def _get_record_dtype(n_atom, itemsize, has_velocity, has_charge):
+        '''
+        Get the structured data type of a record.
+        '''
+        real = '<f%i' % itemsize
+        fields = [('step', '<i8'), ('time', '<f8'), ('box', '<f8', (3, 3)), ('positions', real, (n_atom, 3))]
+        if has_velocity:
+            fields.append(('velocities', real, (n_atom, 3)))
+        if has_charge:
+            fields.append(('charges', real, (n_atom,)))
+        return np.dtype(fields)
+
+    def _parse_header(self):
+        self._file.seek(0)
+        head = self._file.read(_HEADER_SIZE)
+        if len(head) < _HEADER_SIZE:
+            raise Exception('Invalid MTRJ file')
+        magic, version, n_atom, itemsize, flags, _ = struct.unpack(_HEADER_FORMAT, head[:struct.calcsize(_HEADER_FORMAT)])
+        if magic != MTRJ_MAGIC:
+            raise Exception('Invalid MTRJ file')
+        if version != MTRJ_VERSION:
+            raise Exception('Unsupported version of MTRJ file: %i' % version)
+        if itemsize not in (4, 8):
+            raise Exception('Invalid MTRJ file')
+
+        self.n_atom = n_atom
+        self._has_velocity = bool(flags & _FLAG_VELOCITY)
+        self._has_charge = bool(flags & _FLAG_CHARGE)
+        self._dtype = self._get_record_dtype(n_atom, itemsize, self._has_velocity, self._has_charge)
+
+    def _write_header(self, n_atom, itemsize, has_velocity, has_charge):
+        flags = (_FLAG_VELOCITY if has_velocity else 0) | (_FLAG_CHARGE if has_charge else 0)
+        header = struct.pack(_HEADER_FORMAT, MTRJ_MAGIC, MTRJ_VERSION, n_atom, itemsize, flags, 0)
+        self._file.write(header.ljust(_HEADER_SIZE, b'\0'))
+        self.n_atom = n_atom
+        self._has_velocity = has_velocity
+        self._has_charge = has_charge
+        self._dtype = self._get_record_dtype(n_atom, itemsize, has_velocity, has_charge)
+
+    def _get_n_frame(self):
+        # incomplete frame at the end of the file is ignored
+        return (os.path.getsize(self._file.name) - _HEADER_SIZE) // self._dtype.itemsize
+
+    def get_info(self):
+        self.n_frame = self._get_n_frame()
+        if self.n_frame == 0:
+            raise Exception('Empty MTRJ file')
+
+        # structured view into the memory map. No data is copied
+        self._records = np.ndarray((self.n_frame,), dtype=self._dtype, buffer=self._mmap, offset=_HEADER_SIZE)
+
+        return self.n_atom, self.n_frame
+
+    @property
+    def records(self):
+        '''
+        The records of all frames in the MTRJ file.
+
+        It is a read-only view of the memory-mapped file. No data is copied.
+        The fields of a record are `step`, `time`, `box`, `positions`, and optionally `velocities` and `charges`.
+
+        Returns
+        -------
+        records : np.ndarray
+            The records is a structured array of shape (n_frame,)
+        '''
+        return self._records
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        record = self._records[i_frame]
+        # only the selected atoms are gathered from the memory map
+        frame.positions[:] = record['positions'] if atoms is None else record['positions'][atoms]
+        frame.cell.set_box(record['box'])
+        frame.step = int(record['step'])
+        frame.time = float(record['time'])
+        frame.has_velocity = self._has_velocity
+        if self._has_velocity:
+            frame.velocities[:] = record['velocities'] if atoms is None else record['velocities'][atoms]
+        frame.has_charge = self._has_charge
+        if self._has_charge:
+            frame.charges[:] = record['charges'] if atoms is None else record['charges'][atoms]
+
+    def read_positions(self, i_frames, positions, boxes, steps, times, atoms=None, velocities=None, charges=None):
+        i_frames = np.asarray(i_frames, dtype=int)
+        boxes[:] = self._records['box'][i_frames]
+        steps[:] = self._records['step'][i_frames]
+        times[:] = self._records['time'][i_frames]
+        for array, field, present in [(positions, 'positions', True),
+                                      (velocities, 'velocities', self._has_velocity),
+                                      (charges, 'charges', self._has_charge)]:
+            if array is None:
+                continue
+            if not present:
+                array.fill(0)
+                continue
+            # gather from the field view, so that the other fields and the atoms not selected are not copied
+            view = self._records[field]
+            array[:] = view[i_frames] if atoms is None else view[i_frames[:, None], atoms]
+
+    def read_metadata(self):
+        return (np.array(self._records['step']), np.array(self._records['time']),
+                np.array(self._records['box']))
+
+    def write_frame(self, frame, subset=None, write_velocity=False, write_charge=False, dtype=np.float32, **kwargs):
+        '''
+        Write a frame into the opened MTRJ file
+
+        The arguments `write_velocity`, `write_charge` and `dtype` are only used for the first frame written into a new file.
+        They cannot be changed for the following frames.
+
+        Parameters
+        ----------
+        frame : Frame
+        subset : list of int, optional
+        write_velocity : bool
+            Whether or not velocities should be written.
+            If set to True but velocities not available in frame, an Exception will be raised.
+        write_charge : bool
+            Whether or not charges should be written.
+            If set to True but charges not available in frame, an Exception will be raised.
+        dtype : [np.float32, np.float64]
+            The data type of positions, velocities and charges.
+        kwargs : dict
+            Ignored
+        '''
+        if subset is None:
+            subset = slice(None)
+
+        if self._dtype is None:
+            itemsize = np.dtype(dtype).itemsize
+            if itemsize not in (4, 8):
+                raise Exception('Only float32 and float64 are supported for MTRJ file')
+            self._write_header(len(frame.positions[subset]), itemsize, write_velocity, write_charge)
+
+        if self._has_velocity and not frame.has_velocity:
+            raise Exception('Velocities are required by MTRJ file but not exist in frame')
+        if self._has_charge and not frame.has_charge:
+            raise Exception('Charges are required by MTRJ file but not exist in frame')
+
+        record = np.zeros(1, dtype=self._dtype)
+        positions = frame.positions[subset]
+        if len(positions) != self.n_atom:
+            raise Exception('Number of atoms should be the same for all frames in MTRJ file')
+        record['positions'] = positions
+        record['box'] = frame.cell.vectors
+        record['step'] = frame.step
+        record['time'] = frame.time
+        if self._has_velocity:
+            record['velocities'] = frame.velocities[subset]
+        if self._has_charge:
+            record['charges'] = frame.charges[subset]
+
+        self._file.write(record.tobytes())
+        self._frame_written()
+        self._n_frame_written += 1
+
+
+TrjHandler.register_format('.mtrj', Mtrj)
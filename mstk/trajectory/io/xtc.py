@@ -1,54 +1,518 @@
+import os
+import struct
+import threading
 import numpy as np
 from mstk.chem.constant import *
 from mstk.trajectory import Frame
 from mstk.trajectory.handler import TrjHandler
+from mstk.trajectory.index import FrameIndex
+
+try:
+    import chemfiles
+except ImportError:
+    CHEMFILES_FOUND = False
+else:
+    CHEMFILES_FOUND = True
+
+XTC_MAGIC = 1995
+
+# the magic integers used by the compression algorithm of xdrfile library
+_MAGIC_INTS = (
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 8, 10, 12, 16, 20, 25, 32, 40, 50, 64,
+    80, 101, 128, 161, 203, 256, 322, 406, 512, 645, 812, 1024, 1290,
+    1625, 2048, 2580, 3250, 4096, 5060, 6501, 8192, 10321, 13003,
+    16384, 20642, 26007, 32768, 41285, 52015, 65536, 82570, 104031,
+    131072, 165140, 208063, 262144, 330280, 416127, 524287, 660561,
+    832255, 1048576, 1321122, 1664510, 2097152, 2642245, 3329021,
+    4194304, 5284491, 6658042, 8388607, 10568983, 13316085, 16777216)
+_FIRST_IDX = 9
+_LAST_IDX = len(_MAGIC_INTS)
+
+
+class _BitWriter():
+    '''
+    Write unsigned integers into a bit stream, with the most significant bit first.
+    '''
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._value = 0
+        self._n_bit = 0
+
+    def write(self, n_bit, num):
+        self._value = (self._value << n_bit) | num
+        self._n_bit += n_bit
+        if self._n_bit >= 64:
+            n_byte = self._n_bit >> 3
+            self._n_bit &= 7
+            self._buffer += (self._value >> self._n_bit).to_bytes(n_byte, 'big')
+            self._value &= (1 << self._n_bit) - 1
+
+    def write_ints(self, n_bit, sizes, nums):
+        '''
+        Write three integers packed in n_bit bits as one large number.
+        The large number is stored as little-endian bytes, while each byte is stored with the most significant bit first.
+        '''
+        n_byte, n_rest = divmod(n_bit, 8)
+        num = (nums[0] * sizes[1] + nums[1]) * sizes[2] + nums[2]
+        raw = num.to_bytes(n_byte + 1, 'little')
+        self.write(n_byte << 3, int.from_bytes(raw[:n_byte], 'big'))
+        if n_rest:
+            self.write(n_rest, raw[n_byte])
+
+    def get_bytes(self):
+        # pad the last byte with zero
+        n_pad = -self._n_bit & 7
+        return bytes(self._buffer) + (self._value << n_pad).to_bytes((self._n_bit + n_pad) >> 3, 'big')
+
+
+def _size_of_int(size):
+    return size.bit_length()
+
+
+def _decompress(data, n_atom, minint, sizeint, smallidx, out):
+    '''
+    Decompress the coordinates compressed by the xdrfile library.
+
+    The bit stream is read with the most significant bit first.
+    A group of three integers is packed as one large number, which is stored as little-endian bytes.
+    The bit reading is inlined in the loop for performance.
+
+    The integer coordinates are written into `out`, which should be a list of length 3*n_atom
+    '''
+    from_bytes = int.from_bytes
+    minx, miny, minz = minint
+    size_y, size_z = sizeint[1], sizeint[2]
+
+    large = any(size > 0xffffff for size in sizeint)
+    if large:
+        bitsizeint = [_size_of_int(size) for size in sizeint]
+    else:
+        bitsize = (sizeint[0] * sizeint[1] * sizeint[2]).bit_length()
+        n_byte, n_rest = divmod(bitsize, 8)
+        shift = n_byte << 3
+        mask = (1 << bitsize) - 1
+        mask_rest = (1 << n_rest) - 1
+
+    smaller = _MAGIC_INTS[max(_FIRST_IDX, smallidx - 1)] // 2
+    smallnum = _MAGIC_INTS[smallidx] // 2
+    sizesmall = _MAGIC_INTS[smallidx]
+
+    pos = 0  # position of bit
+    run = 0
+    i = 0
+    k = 0
+    while i < n_atom:
+        if large:
+            xyz = []
+            for n_bit in bitsizeint:
+                start = pos >> 3
+                pos += n_bit
+                end = (pos + 7) >> 3
+                xyz.append((from_bytes(data[start:end], 'big') >> ((end << 3) - pos)) & ((1 << n_bit) - 1))
+            x, y, z = xyz
+        else:
+            start = pos >> 3
+            pos += bitsize
+            end = (pos + 7) >> 3
+            value = (from_bytes(data[start:end], 'big') >> ((end << 3) - pos)) & mask
+            num = from_bytes((value >> n_rest).to_bytes(n_byte, 'big'), 'little') | ((value & mask_rest) << shift)
+            num, z = divmod(num, size_z)
+            x, y = divmod(num, size_y)
+        x += minx
+        y += miny
+        z += minz
+        i += 1
+
+        is_smaller = 0
+        flag = (data[pos >> 3] >> (7 - (pos & 7))) & 1
+        pos += 1
+        if flag:
+            start = pos >> 3
+            pos += 5
+            end = (pos + 7) >> 3
+            run = (from_bytes(data[start:end], 'big') >> ((end << 3) - pos)) & 0b11111
+            is_smaller = run % 3
+            run -= is_smaller
+            is_smaller -= 1
+
+        if run > 0:
+            s_byte, s_rest = divmod(smallidx, 8)
+            s_shift = s_byte << 3
+            s_mask = (1 << smallidx) - 1
+            s_mask_rest = (1 << s_rest) - 1
+            for j in range(0, run, 3):
+                start = pos >> 3
+                pos += smallidx
+                end = (pos + 7) >> 3
+                value = (from_bytes(data[start:end], 'big') >> ((end << 3) - pos)) & s_mask
+                num = from_bytes((value >> s_rest).to_bytes(s_byte, 'big'), 'little') | ((value & s_mask_rest) << s_shift)
+                num, dz = divmod(num, sizesmall)
+                dx, dy = divmod(num, sizesmall)
+                i += 1
+                dx += x - smallnum
+                dy += y - smallnum
+                dz += z - smallnum
+                if j == 0:
+                    # the first and second atoms are interchanged for better compression of water molecules
+                    out[k:k + 6] = dx, dy, dz, x, y, z
+                    k += 6
+                else:
+                    out[k:k + 3] = dx, dy, dz
+                    k += 3
+                x, y, z = dx, dy, dz
+        else:
+            out[k:k + 3] = x, y, z
+            k += 3
+
+        if is_smaller != 0:
+            smallidx += is_smaller
+            if is_smaller < 0:
+                smallnum = smaller
+                smaller = _MAGIC_INTS[smallidx - 1] // 2 if smallidx > _FIRST_IDX else 0
+            else:
+                smaller = smallnum
+                smallnum = _MAGIC_INTS[smallidx] // 2
+            sizesmall = _MAGIC_INTS[smallidx]
+
+    if k != n_atom * 3:
+        raise Exception('Corrupted XTC frame')
+
+
+def _compress(ints, minint, maxint):
+    '''
+    Compress the integer coordinates with the algorithm of xdrfile library.
+
+    Parameters
+    ----------
+    ints : list of int
+        The integer coordinates of all atoms in a flat list. It will be modified in place.
+    minint : list of int
+    maxint : list of int
+
+    Returns
+    -------
+    smallidx : int
+    data : bytes
+    '''
+    n_atom = len(ints) // 3
+    writer = _BitWriter()
+    write = writer.write
+    write_ints = writer.write_ints
+
+    sizeint = [maxint[k] - minint[k] + 1 for k in range(3)]
+    if any(size > 0xffffff for size in sizeint):
+        bitsizeint = [_size_of_int(size) for size in sizeint]
+        bitsize = 0
+    else:
+        bitsize = (sizeint[0] * sizeint[1] * sizeint[2]).bit_length()
+
+    # the smallest distance between successive atoms determines the initial size of small integers
+    array = np.array(ints, dtype=np.int64).reshape(n_atom, 3)
+    diffs = np.abs(np.diff(array, axis=0)).sum(axis=1)
+    mindiff = int(diffs.min()) if len(diffs) > 0 else 0x7fffffff
+    smallidx = _FIRST_IDX
+    while smallidx < _LAST_IDX and _MAGIC_INTS[smallidx] < mindiff:
+        smallidx += 1
+    init_smallidx = smallidx
+
+    maxidx = min(_LAST_IDX, smallidx + 8)
+    minidx = maxidx - 8
+    smaller = _MAGIC_INTS[max(_FIRST_IDX, smallidx - 1)] // 2
+    smallnum = _MAGIC_INTS[smallidx] // 2
+    sizesmall = (_MAGIC_INTS[smallidx],) * 3
+    larger = _MAGIC_INTS[maxidx] // 2
+    minx, miny, minz = minint
+
+    prevrun = -1
+    px = py = pz = 0
+    i = 0
+    while i < n_atom:
+        is_small = False
+        k = i * 3
+        x, y, z = ints[k:k + 3]
+        if smallidx < maxidx and i >= 1 and abs(x - px) < larger and abs(y - py) < larger and abs(z - pz) < larger:
+            is_smaller = 1
+        elif smallidx > minidx:
+            is_smaller = -1
+        else:
+            is_smaller = 0
+        if i + 1 < n_atom:
+            nx, ny, nz = ints[k + 3:k + 6]
+            if abs(x - nx) < smallnum and abs(y - ny) < smallnum and abs(z - nz) < smallnum:
+                # interchange the first and second atoms for better compression of water molecules
+                ints[k:k + 6] = nx, ny, nz, x, y, z
+                x, y, z = nx, ny, nz
+                is_small = True
+
+        if bitsize == 0:
+            write(bitsizeint[0], x - minx)
+            write(bitsizeint[1], y - miny)
+            write(bitsizeint[2], z - minz)
+        else:
+            write_ints(bitsize, sizeint, (x - minx, y - miny, z - minz))
+        px, py, pz = x, y, z
+        i += 1
+
+        run = []
+        if not is_small and is_smaller == -1:
+            is_smaller = 0
+        while is_small and len(run) < 8 * 3:
+            k = i * 3
+            x, y, z = ints[k:k + 3]
+            if is_smaller == -1 and (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2 >= smaller * smaller:
+                is_smaller = 0
+            run += [x - px + smallnum, y - py + smallnum, z - pz + smallnum]
+            px, py, pz = x, y, z
+            i += 1
+            is_small = False
+            if i < n_atom:
+                x, y, z = ints[k + 3:k + 6]
+                if abs(x - px) < smallnum and abs(y - py) < smallnum and abs(z - pz) < smallnum:
+                    is_small = True
+
+        if len(run) != prevrun or is_smaller != 0:
+            prevrun = len(run)
+            write(1, 1)  # flag the change in run-length
+            write(5, len(run) + is_smaller + 1)
+        else:
+            write(1, 0)  # flag the fact that run-length did not change
+        for j in range(0, len(run), 3):
+            write_ints(smallidx, sizesmall, run[j:j + 3])
+
+        if is_smaller != 0:
+            smallidx += is_smaller
+            if is_smaller < 0:
+                smallnum = smaller
+                smaller = _MAGIC_INTS[smallidx - 1] // 2
+            else:
+                smaller = smallnum
+                smallnum = _MAGIC_INTS[smallidx] // 2
+            sizesmall = (_MAGIC_INTS[smallidx],) * 3
+
+    return init_smallidx, writer.get_bytes()
 
 
 class Xtc(TrjHandler):
     '''
-    Read and write step, cell and positions from XTC file.
+    Read and write step, time, cell and positions from/to XTC file.
+
+    The compressed coordinates are decoded natively with the same algorithm as the xdrfile library of GROMACS.
+    The offsets of all frames are indexed once when the file is opened, so that any frame can be accessed directly.
 
-    Simulation time is ignored.
+    The codec is written in pure Python, therefore it is much slower than the compiled one.
+    It is registered for XTC format only if chemfiles is not available. Otherwise, :class:`ChemfilesXtc` is used.
 
-    Currently mstk use chemfiles to support XTC format.
+    Parameters
+    ----------
+    file : str
+    mode : ['r', 'w', 'a']
     '''
 
     def __init__(self, file, mode='r'):
         super().__init__()
 
-        try:
-            import chemfiles
-        except:
-            raise ImportError('Currently mstk use chemfiles to parse XTC format. Cannot import chemfiles')
-
         if mode not in ('r', 'w', 'a'):
             raise Exception('Invalid mode')
 
-        self._xtc = chemfiles.Trajectory(file, mode, format='XTC')
+        if mode == 'r':
+            self._file = open(file, 'rb')
+        elif mode == 'a':
+            self._file = open(file, 'ab')
+        elif mode == 'w':
+            self._file = open(file, 'wb')
 
-    def close(self):
-        try:
-            self._xtc.close()
-        except:
-            pass
+        self._buffers = threading.local()  # the buffer for decoded integer coordinates in each thread
 
     def get_info(self):
-        self.n_frame = self._xtc.nsteps
+        self._index = self._load_or_build_index(self._file.name)
+        self._frame_offset = self._index.offsets
+        self.n_atom = self._index.n_atom
+        self.n_frame = self._index.n_frame
         if self.n_frame == 0:
             raise Exception('Empty XTC file')
-        cf_frame = self._xtc.read()
-        self.n_atom = len(cf_frame.atoms)
 
         return self.n_atom, self.n_frame
 
-    def read_frame(self, i_frame, frame):
-        cf_frame = self._xtc.read_step(i_frame)
+    def _build_index(self):
+        # jump from header to header. The steps, times and boxes are also recorded because they come for free
+        size = os.path.getsize(self._file.name)
+        offsets = [0]
+        steps = []
+        times = []
+        boxes = []
+        n_atom = -1
+        while offsets[-1] < size:
+            self._file.seek(offsets[-1])
+            head = self._file.read(92)
+            if len(head) < 56:
+                break
+            magic, _n_atom, step, time = struct.unpack('>iiif', head[:16])
+            if magic != XTC_MAGIC:
+                raise Exception('Invalid XTC file')
+            if n_atom == -1:
+                n_atom = _n_atom
+            elif _n_atom != n_atom:
+                raise Exception('All frames in XTC file should have the same number of atoms')
+            if n_atom <= 9:
+                frame_size = 56 + 12 * n_atom
+            else:
+                if len(head) < 92:
+                    break
+                frame_size = 92 + (struct.unpack('>i', head[88:92])[0] + 3) // 4 * 4
+            if offsets[-1] + frame_size > size:
+                break  # incomplete frame at the end
+            offsets.append(offsets[-1] + frame_size)
+            steps.append(step)
+            times.append(time)
+            boxes.append(struct.unpack('>9f', head[16:52]))
+        self._file.seek(0)
+
+        return FrameIndex(n_atom, offsets, steps=steps, times=times, boxes=np.array(boxes).reshape(-1, 3, 3))
+
+    def read_metadata(self):
+        return self._load_or_build_metadata(self._file.name)
+
+    def _scan_metadata(self):
+        # the steps, times and boxes are recorded when building the index. They are missing only for stale sidecar file
+        index = self._build_index()
+        return index.steps, index.times, index.boxes
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        start, end = self._frame_offset[i_frame], self._frame_offset[i_frame + 1]
+        data = self._read_at(start, end - start)
+
+        frame.step, frame.time = struct.unpack('>if', data[8:16])
+        frame.cell.set_box(np.array(struct.unpack('>9f', data[16:52]), dtype=float).reshape(3, 3))
+
+        if self.n_atom <= 9:
+            positions = np.frombuffer(data, dtype='>f4', count=self.n_atom * 3, offset=56).reshape(-1, 3)
+            frame.positions[:] = positions if atoms is None else positions[atoms]
+            return
+
+        precision = struct.unpack('>f', data[56:60])[0]
+        ints = struct.unpack('>6i', data[60:84])
+        minint, maxint = ints[:3], ints[3:]
+        smallidx = struct.unpack('>i', data[84:88])[0]
+        sizeint = [maxint[k] - minint[k] + 1 for k in range(3)]
+
+        ints = getattr(self._buffers, 'ints', None)
+        if ints is None or len(ints) != self.n_atom * 3:
+            ints = self._buffers.ints = [0] * (self.n_atom * 3)
+        _decompress(memoryview(data)[92:], self.n_atom, minint, sizeint, smallidx, ints)
+        # the compressed coordinates of all atoms have to be decoded. Only the selected atoms are converted
+        ints = np.array(ints, dtype=np.float32).reshape(-1, 3)
+        if atoms is not None:
+            ints = ints[atoms]
+        # the same float32 arithmetic as xdrfile library
+        np.multiply(ints, np.float32(1 / precision),
+                    out=frame.positions, dtype=np.float32, casting='unsafe')
+
+    def write_frame(self, frame, subset=None, precision=1000, **kwargs):
+        '''
+        Write a frame into the opened XTC file
+
+        Parameters
+        ----------
+        frame : Frame
+        subset : list of int, optional
+        precision : float
+            The precision of compressed coordinates. Default is 1000, which means 0.001 nm.
+        kwargs : dict
+            Ignored
+        '''
+        if subset is None:
+            positions = frame.positions
+        else:
+            positions = frame.positions[subset]
+        n_atom = len(positions)
+
+        # step and time can not be unknown in XTC file
+        step = max(frame.step, 0)
+        time = max(frame.time, 0)
+        data = struct.pack('>iiif', XTC_MAGIC, n_atom, step, time)
+        data += np.asarray(frame.cell.vectors, dtype='>f4').tobytes()
+        data += struct.pack('>i', n_atom)
+
+        xyz = np.asarray(positions, dtype=np.float32)
+        if n_atom <= 9:
+            data += xyz.astype('>f4').tobytes()
+        else:
+            precision = np.float32(precision)
+            # round to nearest integer in the same way as xdrfile library
+            scaled = (xyz * precision).astype(np.float64)
+            scaled = np.where(scaled >= 0, scaled + 0.5, scaled - 0.5).astype(np.float32)
+            ints = np.trunc(scaled).astype(np.int64)
+            if np.abs(ints).max(initial=0) >= 2 ** 31 - 1:
+                raise Exception('Positions are too large to be written in XTC format with precision %f' % precision)
+            minint = ints.min(axis=0).tolist()
+            maxint = ints.max(axis=0).tolist()
+            smallidx, compressed = _compress(ints.ravel().tolist(), minint, maxint)
+            data += struct.pack('>f6iii', precision, *minint, *maxint, smallidx, len(compressed))
+            data += compressed + b'\0' * (-len(compressed) % 4)
+
+        self._file.write(data)
+        self._frame_written()
+
+
+class ChemfilesXtc(Xtc):
+    '''
+    Read and write step, time, cell and positions from/to XTC file with chemfiles.
+
+    The coordinates are decoded and encoded by the compiled library of chemfiles,
+    which is much faster than the pure Python implementation in :class:`Xtc`.
+    The frames are still indexed natively in read mode,
+    so that the number of atoms and frames are known without decoding any frame,
+    and the times and the metadata of all frames are taken from the index.
+
+    This handler is registered for XTC format if chemfiles is available.
+    Otherwise, :class:`Xtc` is used.
+    The file is buffered by chemfiles, which cannot be flushed before closing.
+    Therefore, `flush_interval` has no effect for this handler.
+
+    Parameters
+    ----------
+    file : str
+    mode : ['r', 'w', 'a']
+    '''
+
+    def __init__(self, file, mode='r'):
+        if not CHEMFILES_FOUND:
+            raise ImportError('Cannot import chemfiles for parsing XTC format')
+
+        if mode == 'r':
+            super().__init__(file, mode)
+        else:
+            if mode not in ('w', 'a'):
+                raise Exception('Invalid mode')
+            # the file is written only by chemfiles
+            TrjHandler.__init__(self)
+            self._file = None
+
+        self._xtc = chemfiles.Trajectory(file, mode, format='XTC')
+
+    def close(self):
+        try:
+            self._xtc.close()
+        except:
+            pass
+        if self._file is not None:
+            self._file.close()
+
+    def read_frame(self, i_frame, frame, atoms=None):
+        # chemfiles trajectory is not thread-safe
+        with self._lock:
+            cf_frame = self._xtc.read_step(i_frame)
         cf_cell = cf_frame.cell
         lengths = [i / 10 for i in cf_cell.lengths]
         angles = [i * DEG2RAD for i in cf_cell.angles]
-        frame.positions = cf_frame.positions.astype(float) / 10
+        positions = cf_frame.positions if atoms is None else cf_frame.positions[atoms]
+        np.multiply(positions, 0.1, out=frame.positions, casting='unsafe')
         frame.cell.set_box([lengths, angles])
-        frame.step = frame.step
+        frame.step = cf_frame.step
+        # simulation time is not provided by chemfiles
+        if self._index.times is not None:
+            frame.time = float(self._index.times[i_frame])
 
     def write_frame(self, frame, subset=None, **kwargs):
         '''
@@ -61,8 +525,6 @@ class Xtc(TrjHandler):
         kwargs : dict
             Ignored
         '''
-        import chemfiles
-
         if subset is None:
             positions = frame.positions
         else:
@@ -72,9 +534,10 @@ class Xtc(TrjHandler):
         cf_frame.resize(len(positions))
         cf_frame.positions[:] = positions * 10
         cf_frame.cell = chemfiles.UnitCell(frame.cell.lengths * 10, frame.cell.angles * RAD2DEG)
-        cf_frame.step = frame.step
+        cf_frame.step = max(frame.step, 0)
 
         self._xtc.write(cf_frame)
 
 
-TrjHandler.register_format('.xtc', Xtc)
+# the compiled codec of chemfiles is preferred. The native one is the fallback
+TrjHandler.register_format('.xtc', ChemfilesXtc if CHEMFILES_FOUND else Xtc)
@@ -1,6 +1,9 @@
+import numpy as np
 from mstk.topology import Topology
 from mstk.trajectory import Frame
 from mstk.trajectory.handler import TrjHandler
+from mstk.trajectory.index import FrameIndex, scan_frame_offsets
+from mstk.trajectory.compress import open_file
 
 
 class Xyz(TrjHandler):
@@ -8,56 +11,89 @@ class Xyz(TrjHandler):
     Read and write positions from XYZ file.
     '''
 
+    compressible = True
+
     def __init__(self, file, mode='r'):
         super().__init__()
         if mode not in ('r', 'w', 'a'):
             raise Exception('Invalid mode')
 
-        if mode == 'r':
-            # open it in binary mode so that we can correctly seek despite of line ending
-            self._file = open(file, 'rb')
-        elif mode == 'a':
-            self._file = open(file, 'ab')
-        elif mode == 'w':
-            self._file = open(file, 'wb')
+        # open it in binary mode so that we can correctly seek despite of line ending
+        # compressed file is decompressed transparently in 'r' mode
+        self._file = open_file(file, mode)
+        self._template = None
 
     def get_info(self):
+        self._index = self._load_or_build_index(self._file.name)
+        self._frame_offset = self._index.offsets
+        self.n_atom = self._index.n_atom
+        self.n_frame = self._index.n_frame
+
+        return self.n_atom, self.n_frame
+
+    def _build_index(self):
         try:
-            self.n_atom = int(self._file.readline())
+            n_atom = int(self._file.readline())
         except:
             raise Exception('Invalid XYZ file')
         self._file.seek(0)
 
-        # read in the file once and build a list of line offsets
-        # the last element is the length of whole file
-        self._line_offset = [0]
-        offset = 0
-        for line in self._file:
-            offset += len(line)
-            self._line_offset.append(offset)
-        self._file.seek(0)
-
-        # build a list of frame offsets
-        self.n_frame = len(self._line_offset) // (2 + self.n_atom)
-        self._frame_offset = []
-        for i in range(self.n_frame + 1):
-            line_start = (2 + self.n_atom) * i
-            self._frame_offset.append(self._line_offset[line_start])
+        # record the offsets of frames, so that we can read arbitrary frame later
+        offsets = scan_frame_offsets(self._file, n_atom + 2)
 
-        return self.n_atom, self.n_frame
+        return FrameIndex(n_atom, offsets)
 
-    def read_frame(self, i_frame, frame):
-        # skip to frame i and read only this frame
-        self._file.seek(self._frame_offset[i_frame])
-        lines = self._file.read(self._frame_offset[i_frame + 1] - self._frame_offset[i_frame]) \
-            .decode().splitlines()
-        for i in range(self.n_atom):
-            words = lines[i + 2].split()
+    def read_frame(self, i_frame, frame, atoms=None):
+        start, end = self._frame_offset[i_frame], self._frame_offset[i_frame + 1]
+        lines = None
+        if atoms is not None:
+            # lines written by mstk are of fixed width, so only the lines of selected atoms are read
+            chars, _ = self._read_uniform_lines(start, end, 2, self.n_atom, atoms)
+            if chars is not None:
+                lines = chars.tobytes().splitlines()
+        if lines is None:
+            # skip to frame i and read only this frame
+            lines = self._read_at(start, end - start).splitlines()[2:self.n_atom + 2]
+            if atoms is not None:
+                lines = [lines[i] for i in atoms]
+        for i, line in enumerate(lines):
+            words = line.split()
             x = float(words[1]) / 10  # convert A to nm
             y = float(words[2]) / 10
             z = float(words[3]) / 10
             frame.positions[i][:] = x, y, z
 
+    def read_metadata(self):
+        return self._load_or_build_metadata(self._file.name)
+
+    def _scan_metadata(self):
+        # box is not recorded in XYZ file. The step and time written by mstk can be found in title line
+        steps = np.empty(self.n_frame, dtype=np.int64)
+        times = np.empty(self.n_frame, dtype=float)
+        for i_frame in range(self.n_frame):
+            self._file.seek(self._frame_offset[i_frame])
+            self._file.readline()
+            steps[i_frame], times[i_frame] = self._parse_step_time(self._file.readline())
+        return steps, times, np.zeros((self.n_frame, 3, 3), dtype=float)
+
+    def _get_template(self, topology, subset):
+        '''
+        Get the format string of the atom block.
+
+        The symbol column is formatted only once for the same topology and subset,
+        so that only the positions need to be formatted for every frame.
+        It is assumed that the topology is not modified during writing.
+        '''
+        key = subset if isinstance(subset, range) else tuple(subset)
+        if self._template is not None and self._template[0] is topology and self._template[1] == key:
+            return self._template[2]
+
+        # atom.symbol is more friendly than atom.type for visualizing trajectory
+        template = ''.join(('%-8s ' % topology.atoms[id].symbol).replace('%', '%%') + '%10.5f %10.5f %10.5f\n'
+                           for id in subset)
+        self._template = (topology, key, template)
+        return template
+
     def write_frame(self, frame, topology, subset=None, **kwargs):
         '''
         Write a frame into the opened XYZ file
@@ -71,18 +107,18 @@ class Xyz(TrjHandler):
             Ignored
         '''
         if subset is None:
-            subset = list(range(len(frame.positions)))
+            positions = frame.positions * 10  # convert from nm to A
+            subset = range(len(positions))
+        else:
+            positions = frame.positions[subset] * 10
 
         string = '%i\n' % len(subset)
         string += 'Created by mstk: step= %i, t= %f ps\n' % (frame.step, frame.time)
-
-        for ii, id in enumerate(subset):
-            atom = topology.atoms[id]
-            pos = frame.positions[id] * 10  # convert from nm to A
-            # atom.symbol is more friendly than atom.type for visualizing trajectory
-            string += '%-8s %10.5f %10.5f %10.5f\n' % (atom.symbol, pos[0], pos[1], pos[2])
+        # the whole atom block is formatted at once
+        string += self._get_template(topology, subset) % tuple(positions.ravel().tolist())
 
         self._file.write(string.encode())
-        self._file.flush()
+        self._frame_written()
+
 
 TrjHandler.register_format('.xyz', Xyz)
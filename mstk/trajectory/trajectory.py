@@ -1,3 +1,12 @@
+import os
+import copy
+import queue
+import threading
+import functools
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from mstk.topology import UnitCell
 from .frame import Frame
 from .handler import TrjHandler
 
@@ -6,15 +15,19 @@ class Trajectory():
     '''
     A Trajectory is made of a series of Frames.
 
-    It is assumed that all frames have the same number of atoms.
+    Usually all frames have the same number of atoms.
     If it's not the case (e.g. the LammpsDump can have variable number of atoms in each frame),
-    then this class may not be able to work correctly.
+    the frames read from the trajectory are resized to the number of atoms in each frame,
+    and `n_atom` is the number of atoms in the first frame.
+    In this case, the selection of atoms and :func:`read_positions` are not supported.
 
     The file(s) can be opened in 'r', 'w' or 'a' modes, which mean read, write and append.
     The frames are loaded on request for performance issue,
     therefore a file handler is kept open until :func:`close` is called.
     The handler class used for parsing the trajectory is determined by the extension of the file.
     It can also be specified explicitly if non-standard extension is used for the name of trajectory file.
+    Compressed text trajectory (e.g. `traj.gro.gz`, `dump.lammpstrj.xz`) can be read directly,
+    without decompressing it into a temporary file (see :class:`CompressedFile`).
 
     Several files can be opened at the same time (even for files of different format),
     which is useful for processing truncated trajectories.
@@ -29,16 +42,42 @@ class Trajectory():
     Handler : subclass of TrjHandler
         Specify the handler class for parsing the trajectory.
         If set to None, then the handler class will be determined from the extension of the file name.
+    dtype : data-type
+        The data type of positions and velocities of the frames read from the trajectory.
+        Use np.float32 to halve the memory if the precision of trajectory is not a concern (e.g. XTC).
+    atoms : list of int, optional
+        The indexes of atoms to read in 'r' mode. If not set, all atoms will be read.
+        The frames read from the trajectory will contain only these atoms, in the order of this list.
+        The handlers skip the atoms not selected as early as possible,
+        which is much faster than reading all atoms if only a small portion of atoms are concerned.
+    flush_interval : int
+        In 'w' and 'a' modes, flush the file after every this number of frames written.
+        If set to 0, the file is flushed only when the buffer is full or the trajectory is closed.
+        A larger interval reduces the number of system calls for writing large number of small frames.
+    async_write : bool
+        In 'w' and 'a' modes, write the frames in a background thread,
+        so that :func:`write_frame` returns before the frame is formatted and written.
+        The frame is copied before returning, therefore it can be modified by the caller right away.
+        Errors raised by the background thread are raised by the following :func:`write_frame` or :func:`close`.
+    cache_size : float
+        In 'r' mode, the memory budget in MB for caching the frames read by :func:`read_frame`.
+        If set to 0, no frame is cached.
+        See :func:`read_frame` for details.
 
     Attributes
     ----------
     n_atom : int
-        Number of atoms in the trajectory. -1 means unknown yet
+        Number of atoms in the frames read from the trajectory. -1 means unknown yet.
+        It equals to the length of `atoms` if `atoms` is set.
     n_frame : int
         Number of frames in the trajectory. -1 means unknown yet
     frame : Frame or None
         The latest frame been read by :func:`read_frame`.
         None means no frame has been read.
+    n_cache_hit : int
+        The number of calls of :func:`read_frame` served by the frame cache.
+    n_cache_miss : int
+        The number of calls of :func:`read_frame` not served by the frame cache, when the frame cache is enabled.
 
     Examples
     --------
@@ -52,9 +91,23 @@ class Trajectory():
     >>> trj.close()
 
     >>> trj = Trajectory(['input1.dcd', 'input2.xtc'])
+
+    >>> trj = Trajectory('input.gro', atoms=[0, 1, 2])
+    >>> frame = trj.read_frame(0)
+    >>> frame.positions.shape
+    (3, 3)
+
+    >>> trj = Trajectory('input.dcd')
+    >>> for frame in trj.iter_frames(begin=100, step=10):
+    >>>     print(frame.step)
+
+    >>> trj = Trajectory('output.gro', mode='w', flush_interval=0, async_write=True)
+    >>> trj.write_frame(frame, topology)
+    >>> trj.close()
     '''
 
-    def __init__(self, file, mode='r', Handler=None):
+    def __init__(self, file, mode='r', Handler=None, dtype=float, atoms=None, flush_interval=1, async_write=False,
+                 cache_size=0):
         modes_allowed = ('r', 'w', 'a')
         if mode not in modes_allowed:
             raise Exception('mode should be one of %s' % str(modes_allowed))
@@ -66,12 +119,78 @@ class Trajectory():
                 raise Exception('Cannot determine the format of the trajectory file. Try to specify the handler class')
 
         self._handler: TrjHandler = Handler(file, mode)
+        self._file = file
+        self._Handler = Handler
         self._opened: bool = True
         self._mode: str = mode
+        self._dtype = dtype
+        self._atoms = None
+        self._writer = None
+        self._transforms = []
+        self._cache = OrderedDict() if cache_size > 0 else None
+        self._cache_bytes = int(cache_size * 1024 * 1024)
+        self._cache_used = 0  # the memory in bytes occupied by the cached frames
+        self.n_cache_hit = 0
+        self.n_cache_miss = 0
         self.frame: Frame = None
 
         if mode == 'r':
             self.n_atom, self.n_frame = self._handler.get_info()
+            if atoms is not None:
+                self._atoms = self._check_atoms(atoms)
+                self.n_atom = len(self._atoms)
+        else:
+            self._handler.flush_interval = flush_interval
+            if async_write:
+                self._writer = _AsyncWriter(self._handler)
+
+    def _check_atoms(self, atoms):
+        '''
+        Convert the selection of atoms into an array of int and make sure all the indexes are valid.
+        '''
+        atoms = np.array(atoms, dtype=int).ravel()
+        if len(atoms) == 0:
+            raise Exception('At least one atom should be selected')
+        if atoms.min() < 0 or atoms.max() >= self._handler.n_atom:
+            raise Exception('Index of atoms should be in the range of [0, %i)' % self._handler.n_atom)
+        return atoms
+
+    def _read_frame_into(self, i_frame, frame):
+        # handlers do not need to know about selection of atoms if it is not set
+        if self._atoms is None:
+            self._handler.read_frame(i_frame, frame)
+        else:
+            self._handler.read_frame(i_frame, frame, atoms=self._atoms)
+        for transform in self._transforms:
+            transform.apply(frame.positions, frame.cell)
+
+    def add_transform(self, *transforms):
+        '''
+        Add on-the-fly transformations, which will be applied in order on every frame read from the trajectory.
+
+        The transformations are applied in place right after a frame is decoded,
+        therefore the frames returned by :func:`read_frame`, :func:`read_frames`, :func:`iter_frames`,
+        the positions returned by :func:`read_positions` and the frames processed by :func:`map`
+        are all transformed without extra copy.
+
+        Parameters
+        ----------
+        transforms : Transform
+            See :mod:`mstk.trajectory.transform` for available transformations.
+
+        Examples
+        --------
+        >>> trj = Trajectory('input.xtc')
+        >>> trj.add_transform(Wrap(topology), Center())
+        >>> frame = trj.read_frame(0)
+        '''
+        if self._mode != 'r':
+            raise Exception('Transformations are only supported in "r" mode')
+        self._transforms.extend(transforms)
+        # the frames cached before are not transformed
+        if self._cache is not None:
+            self._cache.clear()
+            self._cache_used = 0
 
     def __del__(self):
         self.close()
@@ -82,12 +201,22 @@ class Trajectory():
     def close(self):
         '''
         Close the opened trajectory file(s).
+
+        If the frames are written in background thread, wait until all the frames are written.
         '''
+        writer, self._writer = getattr(self, '_writer', None), None
+        if getattr(self, '_cache', None) is not None:
+            self._cache.clear()
+            self._cache_used = 0
         try:
-            self._handler.close()
-        except:
-            pass
-        self._opened = False
+            if writer is not None:
+                writer.close()
+        finally:
+            try:
+                self._handler.close()
+            except:
+                pass
+            self._opened = False
 
     def read_frame(self, i_frame: int):
         '''
@@ -100,6 +229,13 @@ class Trajectory():
         this method should not be used because all the frames actually point to the same frame.
         In this case, use :func:`read_frames` instead.
 
+        If the frame cache is enabled by argument `cache_size` of the constructor,
+        the frames are no longer reused. Instead, the decoded frames are kept in a least recently used cache,
+        so that reading the same frame again does not parse the trajectory file.
+        The frames in cache are shared by all callers, therefore they are read-only.
+        Modifying the positions, velocities or charges of a cached frame will raise an Exception.
+        Make a copy of the data if you want to modify them.
+
         i_frame should be in the range of [-1, n_frame), otherwise and Exception will be raised.
         -1 means the last frame.
 
@@ -119,20 +255,52 @@ class Trajectory():
         if i_frame >= self.n_frame:
             raise Exception('i_frame should be smaller than %i' % self.n_frame)
 
+        if i_frame == -1:
+            i_frame = self.n_frame - 1
+
+        if self._cache is not None:
+            self.frame = self._read_frame_cached(i_frame)
+            return self.frame
+
         if self.frame is None:
             if self.n_atom == -1:
                 raise Exception('Invalid number of atoms')
-            self.frame = Frame(self.n_atom)
+            self.frame = Frame(self.n_atom, dtype=self._dtype)
 
         # Reset the information in self.frame in case the frames read from different trajectory files pollute each other for CombinedTrajectory
         self.frame.reset()
 
-        if i_frame == -1:
-            i_frame = self.n_frame - 1
-        self._handler.read_frame(i_frame, self.frame)
+        self._read_frame_into(i_frame, self.frame)
         return self.frame
 
-    def read_frames(self, i_frames: [int]):
+    def _read_frame_cached(self, i_frame):
+        '''
+        Read a frame through the frame cache.
+        '''
+        frame = self._cache.get(i_frame)
+        if frame is not None:
+            self._cache.move_to_end(i_frame)
+            self.n_cache_hit += 1
+            return frame
+
+        self.n_cache_miss += 1
+        frame = Frame(self.n_atom, dtype=self._dtype)
+        self._read_frame_into(i_frame, frame)
+        arrays = (frame.positions, frame.velocities, frame.charges)
+        for array in arrays:
+            array.flags.writeable = False
+
+        # the frames can have different number of atoms. A frame larger than the budget is not cached
+        nbytes = sum(array.nbytes for array in arrays)
+        if nbytes <= self._cache_bytes:
+            while self._cache_used + nbytes > self._cache_bytes:
+                _, oldest = self._cache.popitem(last=False)
+                self._cache_used -= sum(array.nbytes for array in (oldest.positions, oldest.velocities, oldest.charges))
+            self._cache[i_frame] = frame
+            self._cache_used += nbytes
+        return frame
+
+    def read_frames(self, i_frames: [int], n_thread=1):
         '''
         Read a bunch of frames from the trajectory.
 
@@ -140,12 +308,18 @@ class Trajectory():
         Instead, a new Frame object is constructed for each frame.
         This method should be called when you want to multiprocess several frames in parallel.
 
+        The frames can be decoded concurrently by a pool of threads.
+        It is beneficial for the handlers which parse the frames with NumPy or pandas (e.g. LAMMPS dump, GRO),
+        because the GIL is released during the parsing.
+
         All the items in i_frames should be in the range of [-1, n_frame), otherwise and Exception will be raised.
         -1 means the last frame.
 
         Parameters
         ----------
         i_frames : list of int
+        n_thread : int
+            The number of threads for decoding the frames.
 
         Returns
         -------
@@ -158,13 +332,289 @@ class Trajectory():
         if any(i >= self.n_frame for i in i_frames):
             raise Exception('i_frame should be smaller than %i' % self.n_frame)
 
-        frames = [Frame(self.n_atom) for _ in i_frames]
-        for ii, i_frame in enumerate(i_frames):
-            if i_frame == -1:
-                i_frame = self.n_frame - 1
-            self._handler.read_frame(i_frame, frames[ii])
+        frames = [Frame(self.n_atom, dtype=self._dtype) for _ in i_frames]
+        i_frames = [self.n_frame - 1 if i == -1 else i for i in i_frames]
+        if n_thread <= 1 or len(i_frames) <= 1:
+            for i_frame, frame in zip(i_frames, frames):
+                self._read_frame_into(i_frame, frame)
+        else:
+            with ThreadPoolExecutor(min(n_thread, len(i_frames))) as executor:
+                # consume the iterator so that the exception raised by any thread is propagated
+                list(executor.map(self._read_frame_into, i_frames, frames))
         return frames
 
+    def read_positions(self, i_frames, atoms=None, dtype=np.float32, velocities=False, charges=False):
+        '''
+        Read the positions of a bunch of frames into one contiguous array.
+
+        Unlike :func:`read_frames`, no Frame object is constructed.
+        The positions of all frames are written into a single preallocated array of shape (n_frame, n_atom, 3),
+        and the box vectors, steps and times are written into per-frame arrays.
+        Velocities and charges are not read unless they are requested.
+        They are set to zero for frames without such information.
+        The transformations added by :func:`add_transform` are applied on the positions and boxes.
+
+        All the items in i_frames should be in the range of [-1, n_frame), otherwise and Exception will be raised.
+        -1 means the last frame.
+
+        Parameters
+        ----------
+        i_frames : list of int
+        atoms : list of int, optional
+            The indexes of atoms in the trajectory file to read.
+            If not set, the atoms selected when opening the trajectory will be read.
+        dtype : data-type
+            The data type of positions and velocities.
+        velocities : bool
+            Whether or not velocities should be read.
+        charges : bool
+            Whether or not charges should be read.
+
+        Returns
+        -------
+        positions : np.ndarray
+            The positions in shape of (n_frame, n_atom, 3)
+        boxes : np.ndarray
+            The box vectors in shape of (n_frame, 3, 3)
+        steps : np.ndarray
+            The steps in shape of (n_frame,). -1 means unknown.
+        times : np.ndarray
+            The times in shape of (n_frame,). -1 means unknown.
+        velocities : np.ndarray
+            The velocities in shape of (n_frame, n_atom, 3). Only returned if `velocities` is True.
+        charges : np.ndarray
+            The charges in shape of (n_frame, n_atom). Only returned if `charges` is True.
+
+        Examples
+        --------
+        >>> trj = Trajectory('input.dcd')
+        >>> positions, boxes, steps, times = trj.read_positions(range(trj.n_frame))
+        '''
+        if self._mode != 'r' or not self._opened:
+            raise Exception('mode != "r" or closed trajectory')
+
+        i_frames = [self.n_frame - 1 if i == -1 else i for i in i_frames]
+        if any(i >= self.n_frame for i in i_frames):
+            raise Exception('i_frame should be smaller than %i' % self.n_frame)
+
+        atoms = self._atoms if atoms is None else self._check_atoms(atoms)
+        n_frame = len(i_frames)
+        n_atom = self._handler.n_atom if atoms is None else len(atoms)
+        positions = np.empty((n_frame, n_atom, 3), dtype=dtype)
+        boxes = np.empty((n_frame, 3, 3), dtype=float)
+        steps = np.empty(n_frame, dtype=int)
+        times = np.empty(n_frame, dtype=float)
+        _velocities = np.empty((n_frame, n_atom, 3), dtype=dtype) if velocities else None
+        _charges = np.empty((n_frame, n_atom), dtype=float) if charges else None
+
+        self._handler.read_positions(i_frames, positions, boxes, steps, times, atoms=atoms,
+                                     velocities=_velocities, charges=_charges)
+        if self._transforms:
+            cell = UnitCell()
+            for ii in range(n_frame):
+                cell.set_box(boxes[ii])
+                # positions[ii] is a view, so the positions are transformed in place
+                for transform in self._transforms:
+                    transform.apply(positions[ii], cell)
+                boxes[ii] = cell.vectors
+
+        results = (positions, boxes, steps, times)
+        if velocities:
+            results += (_velocities,)
+        if charges:
+            results += (_charges,)
+        return results
+
+    def read_metadata(self):
+        '''
+        Read the step, time and box of all frames, without reading the positions of atoms.
+
+        Only the headers of frames are read, e.g. the title and box lines of GRO file,
+        the TIMESTEP and BOX BOUNDS sections of LAMMPS dump file and the frame headers of XTC file.
+        For text formats, the result is recorded in the frame index and persisted in the sidecar index file,
+        so that it is cheap to call this method again.
+        It is useful for selecting frames by time or box before reading the frames.
+
+        Returns
+        -------
+        steps : np.ndarray
+            The steps in shape of (n_frame,). -1 means unknown.
+        times : np.ndarray
+            The times in shape of (n_frame,). -1 means unknown.
+        boxes : np.ndarray
+            The box vectors in shape of (n_frame, 3, 3). Zero means unknown.
+
+        Examples
+        --------
+        >>> trj = Trajectory('input.xtc')
+        >>> steps, times, boxes = trj.read_metadata()
+        >>> begin, end = np.searchsorted(times, [1000, 2000])
+        >>> for frame in trj.iter_frames(begin, end):
+        >>>     print(frame.time)
+        '''
+        if self._mode != 'r' or not self._opened:
+            raise Exception('mode != "r" or closed trajectory')
+
+        # copy the arrays so that the frame index cached by handler is never modified
+        return tuple(np.array(array) for array in self._handler.read_metadata())
+
+    def iter_frames(self, begin=0, end=None, step=1, prefetch=2, n_thread=1):
+        '''
+        Iterate over the frames in range [begin, end) with an interval of step.
+
+        The arguments have the same meaning as slicing a Python list, so negative values are allowed.
+
+        The frames are read and decoded by background threads into a ring of preallocated frames,
+        so that the I/O and parsing of next frames overlap with the analysis of the current frame.
+        Like :func:`read_frame`, the frames are reused for the best of performance.
+        The yielded frame is valid until the next frame is requested from the iterator.
+        If you want to keep a frame, make a copy of the data you need.
+
+        If `n_thread` is larger than 1, several frames are decoded concurrently,
+        while the frames are always yielded in order.
+        The transformations added by :func:`add_transform` are applied by the background threads as well.
+        Therefore, a transformation which records the state of the first frame (e.g. :class:`Wrap` with `first_only`)
+        may not take the state from the first frame in the range.
+
+        Other methods for reading frames should not be called until the iteration is finished or stopped.
+
+        Parameters
+        ----------
+        begin : int
+        end : int, optional
+            If not set, will iterate until the end of the trajectory
+        step : int
+        prefetch : int
+            The number of frames to be read in advance by the background threads.
+            If set to 0, the frames will be read in the calling thread.
+        n_thread : int
+            The number of background threads. At most `prefetch` frames are decoded at the same time.
+
+        Yields
+        ------
+        frame : Frame
+        '''
+        if self._mode != 'r' or not self._opened:
+            raise Exception('mode != "r" or closed trajectory')
+
+        i_frames = range(*slice(begin, end, step).indices(self.n_frame))
+
+        if prefetch <= 0:
+            frame = Frame(self.n_atom, dtype=self._dtype)
+            for i_frame in i_frames:
+                frame.reset()
+                self._read_frame_into(i_frame, frame)
+                yield frame
+            return
+
+        def _read(i_frame, frame):
+            frame.reset()
+            self._read_frame_into(i_frame, frame)
+            return frame
+
+        free = [Frame(self.n_atom, dtype=self._dtype) for _ in range(prefetch + 1)]
+        pending = deque()
+        frame = None
+        with ThreadPoolExecutor(max(1, min(n_thread, prefetch))) as executor:
+            try:
+                for i_frame in i_frames:
+                    # the frame yielded last time is not used by the caller anymore
+                    if frame is not None:
+                        free.append(frame)
+                    pending.append(executor.submit(_read, i_frame, free.pop()))
+                    if len(pending) > prefetch:
+                        frame = pending.popleft().result()
+                        yield frame
+                while pending:
+                    frame = pending.popleft().result()
+                    yield frame
+            finally:
+                # the frames being read are not consumed anymore
+                for future in pending:
+                    future.cancel()
+
+    def map(self, func, i_frames=None, n_workers=None, reduce=None):
+        '''
+        Apply a function on frames in parallel with a pool of processes, and optionally combine the results.
+
+        The frame indexes are split into contiguous chunks and distributed to the worker processes.
+        Every worker opens the trajectory file(s) by itself, so that the open file handles are never shared.
+        The frame index persisted in the sidecar file is reused by the workers (see :class:`FrameIndex`).
+        Only the frame indexes and the results are transferred between processes, not the frames.
+
+        If `reduce` is provided, the results of each chunk are combined inside the worker,
+        and the partial results are then combined in the calling process.
+        Therefore, `reduce` should be associative, e.g. `operator.add` for summing up histograms.
+
+        Both `func` and `reduce` should be picklable, i.e. functions defined at the top level of a module.
+        The transformations added by :func:`add_transform` are also applied by the workers.
+
+        Parameters
+        ----------
+        func : callable
+            The function to be called on every frame as `func(frame)`.
+            The frame is reused by the worker, so it should not be returned directly.
+        i_frames : list of int, optional
+            The indexes of frames to be processed. If not set, all frames will be processed.
+        n_workers : int, optional
+            The number of worker processes. If not set, the number of CPUs will be used.
+            If set to 1, the frames will be processed in the calling process.
+        reduce : callable, optional
+            The function to combine two results as `reduce(result1, result2)`.
+
+        Returns
+        -------
+        results : list or object
+            If `reduce` is None, the list of results for all frames in the order of `i_frames`.
+            Otherwise, the combined result.
+
+        Examples
+        --------
+        >>> def calc_volume(frame):
+        >>>     return frame.cell.volume
+        >>> trj = Trajectory('input.dcd')
+        >>> volumes = trj.map(calc_volume, n_workers=4)
+        >>> total = trj.map(calc_volume, n_workers=4, reduce=operator.add)
+        '''
+        if self._mode != 'r' or not self._opened:
+            raise Exception('mode != "r" or closed trajectory')
+
+        if i_frames is None:
+            i_frames = list(range(self.n_frame))
+        else:
+            i_frames = [self.n_frame - 1 if i == -1 else i for i in i_frames]
+        if any(i >= self.n_frame for i in i_frames):
+            raise Exception('i_frame should be smaller than %i' % self.n_frame)
+        if len(i_frames) == 0:
+            raise Exception('No frame to process')
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_workers = min(n_workers, len(i_frames))
+
+        if n_workers == 1:
+            results = [func(self.read_frame(i)) for i in i_frames]
+            return results if reduce is None else functools.reduce(reduce, results)
+
+        # several chunks for each worker for better load balance
+        n_chunk = min(n_workers * 4, len(i_frames))
+        size, rest = divmod(len(i_frames), n_chunk)
+        chunks = []
+        start = 0
+        for i in range(n_chunk):
+            end = start + size + (1 if i < rest else 0)
+            chunks.append(i_frames[start:end])
+            start = end
+
+        with ProcessPoolExecutor(n_workers, initializer=_map_init,
+                                 initargs=(self._file, self._Handler, self._dtype, self._atoms,
+                                           self._transforms)) as executor:
+            partials = list(executor.map(_map_chunk, [func] * n_chunk, [reduce] * n_chunk, chunks))
+
+        if reduce is None:
+            return [result for partial in partials for result in partial]
+        return functools.reduce(reduce, partials)
+
     def write_frame(self, frame, topology=None, subset=None, **kwargs):
         '''
         Write one frame to the opened trajectory file.
@@ -187,7 +637,10 @@ class Trajectory():
         if self._mode not in ('w', 'a') or not self._opened:
             raise Exception('mode not in ("w", "a") or closed trajectory')
 
-        self._handler.write_frame(frame, topology=topology, subset=subset, **kwargs)
+        if self._writer is not None:
+            self._writer.write_frame(frame, topology=topology, subset=subset, **kwargs)
+        else:
+            self._handler.write_frame(frame, topology=topology, subset=subset, **kwargs)
 
     @staticmethod
     def open(file, mode='r'):
@@ -231,3 +684,61 @@ class Trajectory():
         frame = trj.read_frame(i_frame)
         trj.close()
         return frame
+
+
+class _AsyncWriter():
+    '''
+    Write frames with a handler in a background thread.
+
+    The frames are copied and put into a bounded queue,
+    so that the memory usage is limited if the frames are produced faster than they can be written.
+    '''
+
+    def __init__(self, handler, max_pending=8):
+        self._handler = handler
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # the remaining frames are discarded once an error occurred
+            if self._error is not None:
+                continue
+            frame, kwargs = item
+            try:
+                self._handler.write_frame(frame, **kwargs)
+            except Exception as e:
+                self._error = e
+
+    def _check_error(self):
+        if self._error is not None:
+            raise Exception('Error in writing trajectory in background thread') from self._error
+
+    def write_frame(self, frame, **kwargs):
+        self._check_error()
+        self._queue.put((copy.deepcopy(frame), kwargs))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+
+# the trajectory opened by each worker process of :func:`Trajectory.map`
+_map_trajectory = None
+
+
+def _map_init(file, Handler, dtype, atoms, transforms):
+    global _map_trajectory
+    _map_trajectory = Trajectory(file, 'r', Handler=Handler, dtype=dtype, atoms=atoms)
+    _map_trajectory.add_transform(*transforms)
+
+
+def _map_chunk(func, reduce, i_frames):
+    results = [func(_map_trajectory.read_frame(i)) for i in i_frames]
+    return results if reduce is None else functools.reduce(reduce, results)
@@ -0,0 +1,243 @@
+import numpy as np
+
+
+class Transform():
+    '''
+    Base class of on-the-fly transformations applied on the frames read from a trajectory.
+
+    The transformations are added to a trajectory by :func:`Trajectory.add_transform`,
+    and they are applied on every frame right after it is decoded,
+    so that all the consumers of the trajectory get the transformed positions and cell.
+
+    The method :func:`apply` should be implemented by subclasses.
+    It modifies the positions and cell in place, so that no copy is made.
+    Anything independent of the frame (e.g. the residue each atom belongs to)
+    should be prepared once in the constructor instead of in :func:`apply`.
+    '''
+
+    def apply(self, positions, cell):
+        '''
+        Transform the positions and cell of a frame in place.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            The positions of atoms in shape of (n_atom, 3)
+        cell : UnitCell
+        '''
+        raise NotImplementedError('Method not implemented')
+
+    @staticmethod
+    def _get_groups(topology):
+        '''
+        Get the index of residue each atom belongs to, and the number of atoms in each residue.
+        '''
+        _, groups, counts = np.unique([atom.residue.id for atom in topology.atoms],
+                                      return_inverse=True, return_counts=True)
+        return groups, counts
+
+    @staticmethod
+    def _check_n_atom(positions, n_atom):
+        if len(positions) != n_atom:
+            raise Exception('Number of atoms in topology and frame do not match')
+
+
+class SetBox(Transform):
+    '''
+    Overwrite and/or scale the box of a rectangular cell.
+
+    Parameters
+    ----------
+    lengths : list of float, optional
+        The new lengths of the box in nm. The elements which are None or not positive are not overwritten.
+    scale : list of float, optional
+        The factors for scaling the lengths of the box, after they are overwritten.
+    '''
+
+    def __init__(self, lengths=None, scale=None):
+        lengths = [-1] * 3 if lengths is None else [-1 if v is None else v for v in lengths]
+        self._lengths = np.array(lengths, dtype=float)
+        self._scale = np.ones(3) if scale is None else np.array(scale, dtype=float)
+
+    def apply(self, positions, cell):
+        box = np.where(self._lengths > 0, self._lengths, cell.get_size()) * self._scale
+        cell.set_box(box)
+
+
+class Shift(Transform):
+    '''
+    Translate all atoms by a vector.
+
+    Parameters
+    ----------
+    vector : list of float
+        The translation vector in nm
+    '''
+
+    def __init__(self, vector):
+        self._vector = np.array(vector, dtype=float)
+
+    def apply(self, positions, cell):
+        positions += self._vector
+
+
+class Center(Transform):
+    '''
+    Translate all atoms so that the geometric center of some atoms is at the center of the box.
+
+    Parameters
+    ----------
+    atoms : list of int, optional
+        The indexes of atoms whose center is moved to the center of box. If not set, all atoms are considered.
+    '''
+
+    def __init__(self, atoms=None):
+        self._atoms = None if atoms is None else np.array(atoms, dtype=int)
+
+    def apply(self, positions, cell):
+        selected = positions if self._atoms is None else positions[self._atoms]
+        positions += cell.vectors.sum(axis=0) / 2 - selected.mean(axis=0)
+
+
+class Wrap(Transform):
+    '''
+    Put atoms or residues into the main cell.
+
+    If topology is provided, the residues are wrapped as a whole based on their geometric centers.
+    Otherwise, each atom is wrapped individually.
+    Triclinic cells are supported.
+
+    Parameters
+    ----------
+    topology : Topology, optional
+        The topology should have the same atoms as the frames.
+    first_only : bool
+        If set to True, the images are determined from the first frame transformed,
+        and the same translations are applied on all the following frames.
+        Therefore, the residues are put into the main cell for the first frame,
+        and they will not jump across the boundary in later frames.
+        It should not be used with :func:`Trajectory.map`,
+        because every worker process determines the images from the first frame it reads.
+    '''
+
+    def __init__(self, topology=None, first_only=False):
+        self._first_only = first_only
+        self._images = None
+        if topology is None:
+            self._n_atom = None
+            self._groups = None
+        else:
+            self._n_atom = topology.n_atom
+            self._groups, self._counts = self._get_groups(topology)
+
+    def apply(self, positions, cell):
+        if self._n_atom is not None:
+            self._check_n_atom(positions, self._n_atom)
+
+        vectors = cell.vectors
+        images = self._images
+        if images is None:
+            fractions = positions @ np.linalg.inv(vectors)
+            if self._groups is None:
+                images = np.floor(fractions)
+            else:
+                centers = np.column_stack([np.bincount(self._groups, weights=fractions[:, k]) for k in range(3)])
+                images = np.floor(centers / self._counts[:, None])[self._groups]
+            if self._first_only:
+                self._images = images
+        positions -= images @ vectors
+
+
+class MakeWhole(Transform):
+    '''
+    Make the molecules broken by periodic boundaries whole again.
+
+    The bonds (and the virtual site pairs) of every unique molecule in the topology are traversed in breadth-first order,
+    and the bonded pairs are grouped by the depth of the child atom in the traversal.
+    The same traversal is shared by all the consecutive molecules similar to the unique molecule.
+    For each depth, the minimum image convention is applied on the bonded pairs of all molecules at once,
+    and the child atoms are moved next to their parent atoms.
+    Therefore, the cost is proportional to the largest depth of molecules, not the number of molecules.
+    Triclinic cells are supported.
+
+    The first atom of every molecule is never moved. Combine it with :class:`Wrap` if required.
+
+    Parameters
+    ----------
+    topology : Topology
+        The topology should have the same atoms as the frames.
+    '''
+
+    def __init__(self, topology):
+        self._n_atom = topology.n_atom
+
+        # every template is the traversal of an unique molecule and the index of first atom of its similar molecules
+        templates = []
+        mol_last = None
+        for mol in topology.molecules:
+            if mol.n_atom == 0:
+                continue
+            if mol_last is None or not mol.is_similar_to(mol_last):
+                templates.append((self._traverse(mol), []))
+            templates[-1][1].append(mol.atoms[0].id)
+            mol_last = mol
+
+        self._levels = []
+        for depth in range(max((len(levels) for levels, _ in templates), default=0)):
+            parents, children = [], []
+            for levels, starts in templates:
+                if depth < len(levels):
+                    starts = np.array(starts)[:, None]
+                    parents.append((levels[depth][0] + starts).ravel())
+                    children.append((levels[depth][1] + starts).ravel())
+            self._levels.append((np.concatenate(parents), np.concatenate(children)))
+
+    @staticmethod
+    def _traverse(mol):
+        '''
+        Traverse the bond graph of a molecule in breadth-first order.
+
+        Returns
+        -------
+        levels : list of tuple of np.ndarray
+            The indexes of parent and child atoms in the molecule for every depth of the traversal
+        '''
+        neighbors = [[] for _ in range(mol.n_atom)]
+        pairs = [(bond.atom1, bond.atom2) for bond in mol.bonds] + mol.get_virtual_site_pairs()
+        for atom1, atom2 in pairs:
+            neighbors[atom1.id_in_mol].append(atom2.id_in_mol)
+            neighbors[atom2.id_in_mol].append(atom1.id_in_mol)
+
+        depths = [-1] * mol.n_atom
+        levels = []
+        # every fragment not bonded to others is traversed from its first atom
+        for root in range(mol.n_atom):
+            if depths[root] != -1:
+                continue
+            depths[root] = 0
+            queue = [root]
+            while queue:
+                queue_next = []
+                for i in queue:
+                    for j in neighbors[i]:
+                        if depths[j] != -1:
+                            continue
+                        depths[j] = depths[i] + 1
+                        if len(levels) < depths[j]:
+                            levels.append(([], []))
+                        levels[depths[j] - 1][0].append(i)
+                        levels[depths[j] - 1][1].append(j)
+                        queue_next.append(j)
+                queue = queue_next
+
+        return [(np.array(parents, dtype=int), np.array(children, dtype=int)) for parents, children in levels]
+
+    def apply(self, positions, cell):
+        self._check_n_atom(positions, self._n_atom)
+
+        vectors = cell.vectors
+        inverse = np.linalg.inv(vectors)
+        for parents, children in self._levels:
+            delta = positions[children] - positions[parents]
+            delta -= np.round(delta @ inverse) @ vectors
+            positions[children] = positions[parents] + delta
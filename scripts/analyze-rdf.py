@@ -78,9 +78,8 @@ def main():
     rdf_array = np.zeros(n_bin, dtype=float)
 
     n_frame = 0
-    for i in range(args.begin, args.end, args.skip):
+    for i, frame in zip(range(args.begin, args.end, args.skip), trj.iter_frames(args.begin, args.end, args.skip)):
         n_frame += 1
-        frame = trj.read_frame(i)
         sys.stdout.write('\r    frame %i' % i)
 
         vol = frame.cell.volume
@@ -2,10 +2,9 @@
 
 import sys
 import argparse
-import numpy as np
 
 from mstk.topology import Topology
-from mstk.trajectory import Trajectory
+from mstk.trajectory import Trajectory, SetBox, Wrap, Shift, Center
 from mstk import logger
 
 
@@ -49,7 +48,8 @@ if __name__ == '__main__':
     if (top.n_atom != trj.n_atom):
         raise Exception('Number of atoms in topology and trajectory files do not match')
 
-    trj_out = Trajectory.open(args.output, 'w')
+    # the frames are written in background thread, so that reading and writing overlap
+    trj_out = Trajectory(args.output, 'w', flush_interval=0, async_write=True)
 
     if args.ignore or args.ignoreatom:
         subset = [atom.id for atom in top.atoms
@@ -64,36 +64,19 @@ if __name__ == '__main__':
     elif args.end < 0:
         args.end += trj.n_frame
 
-    cell_offset = np.zeros((top.n_atom, 3), dtype=int)
+    # the transformations are applied on every frame right after it is read
+    transforms = []
+    if any(val != -1 for val in args.box) or any(val != 1 for val in args.boxscale):
+        transforms.append(SetBox(args.box, args.boxscale))
     if args.wrapfirst:
-        frame = trj.read_frame(args.begin)
-        box = frame.cell.get_size()
-        for res in top.residues:
-            ids = [atom.id for atom in res.atoms]
-            positions = frame.positions[ids]
-            center = np.sum(positions, axis=0) / len(positions)
-            cell_offset[ids] = np.floor(center / box).astype(int)
-
+        transforms.append(Wrap(top, first_only=True))
     if any(val != 0 for val in args.shift):
-        pos_shift = np.array([args.shift] * top.n_atom)
-    else:
-        pos_shift = None
+        transforms.append(Shift(args.shift))
+    if args.center:
+        transforms.append(Center())
+    trj.add_transform(*transforms)
 
-    for i in range(args.begin, args.end, args.skip):
+    for i, frame in zip(range(args.begin, args.end, args.skip), trj.iter_frames(args.begin, args.end, args.skip)):
         sys.stdout.write('\r    %i' % i)
-        frame = trj.read_frame(i)
-        box = frame.cell.get_size()
-        for k in range(3):
-            if args.box[k] != -1:
-                box[k] = args.box[k]
-            box[k] *= args.boxscale[k]
-        frame.cell.set_box(box)
-        if args.wrapfirst:
-            frame.positions -= cell_offset * box
-        if pos_shift is not None:
-            frame.positions += pos_shift
-        if args.center:
-            center = np.sum(frame.positions, axis=0) / top.n_atom
-            frame.positions += box / 2 - center
         trj_out.write_frame(frame, top, subset=subset)
     trj_out.close()
@@ -180,3 +180,61 @@ def test_nonbonded_kernel():
 
     assert pytest.approx(sum(energy), rel=1E-6) == e
     assert pytest.approx(forces, rel=1E-6) == f
+
+
+def test_scatter_add():
+    rng = np.random.default_rng(0)
+    indexes = rng.integers(0, 10, size=50)
+    values = rng.random((50, 3))
+    forces = scatter_add(12, (indexes[:30], values[:30]), (indexes[30:], -values[30:]))
+    expected = np.zeros((12, 3))
+    for i, index in enumerate(indexes):
+        expected[index] += values[i] if i < 30 else -values[i]
+    assert pytest.approx(forces, abs=1E-12) == expected
+
+
+def test_kernel_large():
+    # every atom belongs to exactly one bond, so the accumulated forces can be checked bond by bond
+    rng = np.random.default_rng(0)
+    n_bond = 100000
+    positions = rng.random((n_bond * 2, 3)) * 10
+    bonds = np.arange(n_bond * 2).reshape(-1, 2)
+    kernel = HarmonicBondKernel(positions, bonds, [[0.1, 1000]] * n_bond)
+    r, energy, forces = kernel.evaluate()
+
+    delta = positions[1::2] - positions[::2]
+    r_expected = np.sqrt(np.sum(delta * delta, axis=1))
+    assert pytest.approx(r, rel=1E-12) == r_expected
+    assert pytest.approx(energy, rel=1E-12) == 1000 * (r_expected - 0.1) ** 2
+    f = (-2 * 1000 * (r_expected - 0.1) / r_expected)[:, np.newaxis] * delta
+    assert pytest.approx(forces[1::2], rel=1E-9, abs=1E-9) == f
+    assert pytest.approx(forces[::2], rel=1E-9, abs=1E-9) == -f
+
+
+def test_evaluate_frames():
+    rng = np.random.default_rng(0)
+    frames = np.array(top.positions)[np.newaxis] + rng.normal(scale=0.005, size=(5, top.n_atom, 3))
+    kernels = [
+        HarmonicBondKernel(top.positions, [tuple(a.id for a in bond.atoms) for bond in top.bonds],
+                           [[0.1, 100]] * top.n_bond),
+        HarmonicAngleKernel(top.positions, [tuple(a.id for a in angle.atoms) for angle in top.angles],
+                            [[2, 100]] * top.n_angle),
+        OplsTorsionKernel(top.positions, [tuple(a.id for a in dihedral.atoms) for dihedral in top.dihedrals],
+                          [[1, 2, 3, 4]] * top.n_dihedral),
+        HarmonicTorsionKernel(top.positions, [tuple(a.id for a in dihedral.atoms) for dihedral in top.dihedrals],
+                              [[1, 2]] * top.n_dihedral),
+        ConstrainedTorsionKernel(top.positions, [tuple(a.id for a in dihedral.atoms) for dihedral in top.dihedrals],
+                                 [[1, 2]] * top.n_dihedral),
+        NonbondedKernel(top.positions, list(itertools.combinations(range(top.n_atom), 2)),
+                        [[0.5, 0.3, 0.1]] * (top.n_atom * (top.n_atom - 1) // 2)),
+    ]
+    for kernel in kernels:
+        for chunk_size in (None, 2):
+            values, energy, forces = kernel.evaluate(frames, chunk_size=chunk_size)
+            assert energy.shape == (5, len(kernel.indexes))
+            assert forces.shape == (5, top.n_atom, 3)
+            for i, positions in enumerate(frames):
+                _values, _energy, _forces = kernel.evaluate(positions)
+                assert pytest.approx(values[i], rel=1E-9) == _values
+                assert pytest.approx(energy[i], rel=1E-9) == _energy
+                assert pytest.approx(forces[i], rel=1E-9, abs=1E-9) == _forces
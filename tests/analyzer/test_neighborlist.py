@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from mstk.analyzer.neighborlist import NeighborList
+
+
+def test_build():
+    box = np.array([3.0, 4.0, 5.0])
+    with pytest.raises(Exception):
+        NeighborList(box, 1.2)
+
+    nlist = NeighborList(box, 0.9)
+    assert list(nlist.n_cell) == [3, 4, 5]
+    assert len(nlist.cell_indexes) == 60
+
+    np.random.seed(0)
+    positions = np.random.random((1000, 3)) * box * 3 - box
+    nlist.build(positions)
+    assert np.all(positions >= 0) and np.all(positions < box)
+
+    locations = np.floor(positions / nlist.cell_size).astype(int)
+    n_total = 0
+    for index in nlist.cell_indexes:
+        atoms = nlist.get_cell(index)
+        n_total += len(atoms)
+        assert np.all(locations[atoms] == index)
+    assert n_total == 1000
+
+    index = (0, 3, 2)
+    surrounding = set()
+    for shift in np.ndindex(3, 3, 3):
+        cell = tuple((np.array(index) + shift - 1) % nlist.n_cell)
+        surrounding.update(nlist.get_cell(cell).tolist())
+    atoms = nlist.get_interacting_cell(index)
+    assert len(atoms) == len(surrounding)
+    assert set(atoms.tolist()) == surrounding
+
+
+def test_get_pairs():
+    box = np.array([3.0, 4.0, 5.0])
+    cutoff = 0.9
+    np.random.seed(0)
+    positions = np.random.random((500, 3)) * box
+    molecules = np.arange(500) // 5
+    exclusions = np.array([(k, k + 1) for k in range(0, 500, 2)] + [(k + 3, k) for k in range(0, 497, 7)])
+
+    i_all, j_all = np.triu_indices(500, 1)
+    delta = positions[j_all] - positions[i_all]
+    delta -= np.round(delta / box) * box
+    r_all = np.sqrt(np.sum(delta * delta, axis=-1))
+
+    nlist = NeighborList(box, cutoff)
+    for chunk in (NeighborList.max_chunk_pairs, 1000):
+        nlist.max_chunk_pairs = chunk
+        i, j, r = nlist.get_pairs(positions, cutoff)
+        assert np.all(i < j)
+        within = r_all < cutoff
+        assert len(i) == within.sum()
+        order = np.lexsort((j, i))
+        assert np.all(i[order] == i_all[within])
+        assert np.all(j[order] == j_all[within])
+        assert pytest.approx(r[order], abs=1E-12) == r_all[within]
+
+    i, j, r = nlist.get_pairs(positions, cutoff, molecules=molecules)
+    assert len(i) == np.sum((r_all < cutoff) & (molecules[i_all] != molecules[j_all]))
+    assert np.all(molecules[i] != molecules[j])
+
+    i, j, r = nlist.get_pairs(positions, cutoff, exclusions=exclusions)
+    excluded = set(map(tuple, np.sort(exclusions, axis=1).tolist()))
+    assert not excluded.intersection(zip(i.tolist(), j.tolist()))
+    n_excluded = sum(1 for a, b in zip(i_all[r_all < cutoff], j_all[r_all < cutoff]) if (a, b) in excluded)
+    assert len(i) == np.sum(r_all < cutoff) - n_excluded
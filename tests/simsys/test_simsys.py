@@ -3,13 +3,14 @@
 import os
 import sys
 import pytest
+import numpy as np
 from mstk.topology import Topology, UnitCell
 from mstk.forcefield import ForceField
-from mstk.simsys import System
+from mstk.simsys import System, NumpyEngine
 
 import openmm.openmm as mm
 from openmm import app
-from openmm.unit import kilocalorie_per_mole as kcal_mol, kilojoule_per_mole as kJ_mol
+from openmm.unit import kilocalorie_per_mole as kcal_mol, kilojoule_per_mole as kJ_mol, nanometer as nm
 
 cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -80,6 +81,63 @@ def test_team_vacuum():
     assert pytest.approx(pe, abs=1.0) == 490.8
 
 
+def test_numpy_engine():
+    ff = ForceField.open(cwd + '/files/10-benzene.ppf')
+    top = Topology.open(cwd + '/files/10-benzene.lmp', improper_center=3)
+    top.cell.set_box([0, 0, 0])
+    ff.assign_charge(top)
+    system = System(top, ff)
+
+    context = mm.Context(system.to_omm_system(), *get_omm_integrator_platform())
+    context.setPositions(top.positions)
+
+    engine = system.to_numpy_engine()
+    energies, forces = engine.evaluate()
+    for group, name in enumerate(['Bond', 'Angle', 'Dihedral', 'Improper', 'vdW', 'Coulomb'], start=1):
+        state = context.getState(getEnergy=True, getForces=True, groups={group})
+        energy = state.getPotentialEnergy().value_in_unit(kJ_mol)
+        omm_forces = state.getForces(asNumpy=True).value_in_unit(kJ_mol / nm)
+        assert pytest.approx(energies[name], rel=1E-5) == energy
+        assert pytest.approx(forces[name], rel=1E-4, abs=1E-3) == omm_forces
+
+    # a stack of frames gives the same results as single frames
+    positions = np.array([top.positions, top.positions * 1.01])
+    energies_stack, forces_stack = engine.evaluate(positions)
+    energies, forces = engine.evaluate(positions[1])
+    for name in energies:
+        assert pytest.approx(energies_stack[name][1], rel=1E-8) == energies[name]
+        assert pytest.approx(forces_stack[name][1], rel=1E-8, abs=1E-8) == forces[name]
+
+
+def test_numpy_engine_pbc():
+    for long_range in (ForceField.VDW_LONGRANGE_CORRECT, ForceField.VDW_LONGRANGE_SHIFT):
+        # the cell list is not used for the smaller box, because box/3 is smaller than cutoff
+        for box in ([2.96032, 2.96032, 2.96032], [3.2, 3.2, 3.2]):
+            ff = ForceField.open(cwd + '/files/10-benzene.ppf')
+            ff.vdw_cutoff = 1.0
+            ff.vdw_long_range = long_range
+            top = Topology.open(cwd + '/files/10-benzene.lmp', improper_center=3)
+            top.cell.set_box(box)
+            ff.assign_charge(top)
+            system = System(top, ff)
+
+            omm_system = system.to_omm_system()
+            # the Coulomb interactions are evaluated with reaction field instead of PME by NumpyEngine
+            nbforce = next(f for f in omm_system.getForces() if type(f) == mm.NonbondedForce)
+            nbforce.setNonbondedMethod(mm.NonbondedForce.CutoffPeriodic)
+            nbforce.setReactionFieldDielectric(NumpyEngine.dielectric)
+            context = mm.Context(omm_system, *get_omm_integrator_platform())
+            context.setPositions(top.positions)
+
+            energies, forces = system.to_numpy_engine().evaluate()
+            for group, name in enumerate(['Bond', 'Angle', 'Dihedral', 'Improper', 'vdW', 'Coulomb'], start=1):
+                state = context.getState(getEnergy=True, getForces=True, groups={group})
+                energy = state.getPotentialEnergy().value_in_unit(kJ_mol)
+                omm_forces = state.getForces(asNumpy=True).value_in_unit(kJ_mol / nm)
+                assert pytest.approx(energies[name], rel=1E-5) == energy
+                assert pytest.approx(forces[name], rel=1E-4, abs=1E-3) == omm_forces
+
+
 def test_eqt_vdw():
     ff = ForceField.open(cwd + '/files/c_3ad.ppf')
     top = Topology.open(cwd + '/files/c_3ad.msd')
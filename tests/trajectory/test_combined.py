@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import pytest
-from mstk.trajectory import Trajectory
+from mstk.trajectory import Trajectory, CombinedTrj, Gro
 
 import os
 
@@ -34,3 +34,35 @@ def test_read():
     assert frame.cell.is_rectangular
     assert pytest.approx(frame.cell.get_size(), abs=1E-6) == [3.0004316] * 3
     assert pytest.approx(frame.positions[-1], abs=1E-6) == [2.11148, 0.241373, 0.664092]
+
+
+def test_lazy_open(monkeypatch):
+    monkeypatch.setattr(CombinedTrj, 'max_open', 1)
+    files = [cwd + '/files/100-SPCE.gro', cwd + '/files/100HOH.lammpstrj', cwd + '/files/100-SPCE.gro']
+    trj = Trajectory(files)
+    assert trj.n_frame == 8
+    assert len(trj._handler._handlers) == 1
+
+    gro = Trajectory(cwd + '/files/100-SPCE.gro')
+    lammps = Trajectory(cwd + '/files/100HOH.lammpstrj')
+    # the files are opened again after they are closed
+    for i_frame, trj_single, i in [(7, gro, 1), (2, lammps, 0), (6, gro, 0), (5, lammps, 3)]:
+        frame = trj.read_frame(i_frame)
+        assert pytest.approx(frame.positions, abs=1E-6) == trj_single.read_frame(i).positions
+        assert len(trj._handler._handlers) == 1
+
+    positions, boxes, steps, times = trj.read_positions([7, 0, 3])
+    assert pytest.approx(positions[0], abs=1E-6) == gro.read_frame(1).positions
+    assert pytest.approx(positions[1], abs=1E-6) == gro.read_frame(0).positions
+    assert pytest.approx(positions[2], abs=1E-6) == lammps.read_frame(1).positions
+    trj.close()
+
+
+def test_scan_error(monkeypatch):
+    closed = []
+    close = Gro.close
+    monkeypatch.setattr(Gro, 'close', lambda self: closed.append(self) or close(self))
+    # the handler opened successfully is closed if another file cannot be opened
+    with pytest.raises(Exception):
+        Trajectory([cwd + '/files/100-SPCE.gro', cwd + '/files/not-exist.gro'])
+    assert len(closed) == 1
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import bz2
+import gzip
+import lzma
+import tempfile
+import shutil
+import random
+import pytest
+from mstk.trajectory import Trajectory, CompressedFile, FrameIndex
+
+import os
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_compressed_file():
+    tmpdir = tempfile.mkdtemp()
+    data = b''.join(b'line %i\n' % i for i in range(20000))
+    tmp = os.path.join(tmpdir, 'data.gz')
+    # two concatenated streams
+    with open(tmp, 'wb') as f:
+        f.write(gzip.compress(data[:50000]))
+        f.write(gzip.compress(data[50000:]))
+
+    f = CompressedFile(tmp)
+    f.spacing = 10000
+    f.history = 100
+    f.chunk_size = 1000
+    assert f.read() == data
+    assert f.tell() == len(data)
+    # seek points are recorded at the start of second stream and every spacing bytes
+    assert f.n_seek_point > 2
+
+    random.seed(0)
+    for _ in range(100):
+        start = random.randrange(len(data))
+        f.seek(start)
+        assert f.read(300) == data[start:start + 300]
+        assert f.readline() == data[start + 300:].split(b'\n', 1)[0] + b'\n'
+    assert f.seek(-7, os.SEEK_END) == len(data) - 7
+    assert f.read() == data[-7:]
+    f.close()
+
+    for ext, compress in [('.bz2', bz2.compress), ('.xz', lzma.compress)]:
+        tmp = os.path.join(tmpdir, 'data' + ext)
+        with open(tmp, 'wb') as f:
+            f.write(compress(data))
+        f = CompressedFile(tmp)
+        f.seek(100000)
+        assert f.read(100) == data[100000:100100]
+        f.seek(10)
+        assert f.readline() == data[10:].split(b'\n', 1)[0] + b'\n'
+        f.close()
+
+    shutil.rmtree(tmpdir)
+
+
+def test_read():
+    tmpdir = tempfile.mkdtemp()
+    for file, compress, ext in [('100-SPCE.gro', gzip.compress, '.gz'),
+                                ('100-SPCE.xyz', bz2.compress, '.bz2'),
+                                ('100HOH.lammpstrj', lzma.compress, '.xz')]:
+        tmp = os.path.join(tmpdir, file + ext)
+        with open(cwd + '/files/' + file, 'rb') as f:
+            with open(tmp, 'wb') as f_out:
+                f_out.write(compress(f.read()))
+
+        trj = Trajectory(cwd + '/files/' + file)
+        trj_compressed = Trajectory(tmp)
+        assert trj_compressed.n_atom == trj.n_atom
+        assert trj_compressed.n_frame == trj.n_frame
+        for i in reversed(range(trj.n_frame)):
+            frame = trj.read_frame(i)
+            frame_compressed = trj_compressed.read_frame(i)
+            assert pytest.approx(frame_compressed.positions, abs=1E-6) == frame.positions
+            assert pytest.approx(frame_compressed.cell.vectors, abs=1E-6) == frame.cell.vectors
+        trj.close()
+        trj_compressed.close()
+
+    with pytest.raises(Exception):
+        Trajectory(os.path.join(tmpdir, 'out.gro.gz'), 'w')
+    with pytest.raises(Exception):
+        Trajectory(os.path.join(tmpdir, 'traj.dcd.gz'))
+
+    shutil.rmtree(tmpdir)
+
+
+def test_seek_points_cache():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'traj.gro.gz')
+    with open(cwd + '/files/100-SPCE.gro', 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    # every frame of 100-SPCE.gro has 303 lines. Compress every frame as an individual stream
+    with open(tmp, 'wb') as f:
+        for i in range(0, len(lines), 303):
+            f.write(gzip.compress(b''.join(lines[i:i + 303])))
+
+    min_file_size = FrameIndex.min_file_size
+    FrameIndex.min_file_size = 0
+    try:
+        trj = Trajectory(tmp)
+        n_frame = trj.n_frame
+        frame = trj.read_frame(n_frame - 1)
+        trj.close()
+        index = FrameIndex.load(tmp)
+        assert len(index.seek_points) >= n_frame
+
+        # the seek points are restored without decompressing the file
+        trj = Trajectory(tmp)
+        assert trj._handler._file.seek_points == [tuple(point) for point in index.seek_points.tolist()]
+        frame_cached = trj.read_frame(n_frame - 1)
+        assert pytest.approx(frame_cached.positions, abs=1E-6) == frame.positions
+        trj.close()
+    finally:
+        FrameIndex.min_file_size = min_file_size
+
+    shutil.rmtree(tmpdir)
@@ -38,3 +38,43 @@ def test_write():
     dcd.close()
     assert filecmp.cmp(tmp, cwd + '/files/baselines/gro-out.dcd')
     shutil.rmtree(tmpdir)
+
+
+def test_write_unflushed():
+    tmpdir = tempfile.mkdtemp()
+
+    gro = Trajectory.open(cwd + '/files/100-SPCE.gro')
+    tmp = os.path.join(tmpdir, 'gro-out.dcd')
+    dcd = Trajectory(tmp, 'w', flush_interval=0)
+    # the header is not updated after every frame, so that the frames are kept in the buffer
+    for i in range(gro.n_frame):
+        dcd.write_frame(gro.read_frame(i))
+        assert os.path.getsize(tmp) == 0
+    dcd.close()
+    assert filecmp.cmp(tmp, cwd + '/files/baselines/gro-out.dcd')
+    shutil.rmtree(tmpdir)
+
+
+def test_append():
+    tmpdir = tempfile.mkdtemp()
+
+    gro = Trajectory.open(cwd + '/files/100-SPCE.gro')
+    tmp = os.path.join(tmpdir, 'gro-out.dcd')
+    dcd = Trajectory.open(tmp, 'w')
+    dcd.write_frame(gro.read_frame(0))
+    dcd.close()
+    dcd = Trajectory.open(tmp, 'a')
+    dcd.write_frame(gro.read_frame(1))
+    dcd.close()
+    assert filecmp.cmp(tmp, cwd + '/files/baselines/gro-out.dcd')
+
+    dcd = Trajectory.open(tmp)
+    assert dcd.n_frame == 2
+    positions, boxes, steps, times = dcd.read_positions([1, 0])
+    assert positions.shape == (2, 300, 3)
+    assert list(steps) == [1, 0]
+    assert pytest.approx(positions[0], abs=1E-6) == gro.read_frame(1).positions
+    assert pytest.approx(positions[1], abs=1E-6) == gro.read_frame(0).positions
+    dcd.close()
+
+    shutil.rmtree(tmpdir)
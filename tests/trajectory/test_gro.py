@@ -41,3 +41,24 @@ def test_write():
     assert filecmp.cmp(tmp, cwd + '/files/baselines/xtc-out.gro')
 
     shutil.rmtree(tmpdir)
+
+
+def test_write_async():
+    tmpdir = tempfile.mkdtemp()
+    top = Topology.open(cwd + '/files/100-SPCE.psf')
+    xtc = Trajectory.open(cwd + '/files/100-SPCE.xtc')
+
+    tmp = os.path.join(tmpdir, 'xtc-out.gro')
+    gro = Trajectory(tmp, 'w', flush_interval=0, async_write=True)
+    # the frame is reused by iter_frames, but it is copied before written in background
+    for frame in xtc.iter_frames():
+        gro.write_frame(frame, top, subset=list(range(150, 300)))
+    gro.close()
+    assert filecmp.cmp(tmp, cwd + '/files/baselines/xtc-out.gro')
+
+    gro = Trajectory(tmp, 'w', async_write=True)
+    gro.write_frame(xtc.read_frame(0), top, write_velocity=True)
+    with pytest.raises(Exception):
+        gro.close()
+
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import io
+import tempfile
+import shutil
+import pytest
+from mstk.trajectory import Trajectory, FrameIndex
+from mstk.trajectory.index import scan_frame_offsets, scan_frame_markers
+
+import os
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_scan_frame_offsets():
+    with open(cwd + '/files/100-SPCE.gro', 'rb') as f:
+        data = f.read()
+    line_offsets = [0]
+    for line in data.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    with open(cwd + '/files/100-SPCE.gro', 'rb') as f:
+        for chunk_size in (1, 7, 100, 4096, 1024 * 1024):
+            offsets = scan_frame_offsets(f, 303, chunk_size=chunk_size)
+            assert list(offsets) == [0, line_offsets[303], line_offsets[606]]
+
+    # last line not terminated and incomplete frame at the end
+    f = io.BytesIO(b'a\nb\nc\nd\ne\nf')
+    assert list(scan_frame_offsets(f, 2, chunk_size=3)) == [0, 4, 8, 11]
+    assert list(scan_frame_offsets(f, 4, chunk_size=3)) == [0, 8]
+    assert list(scan_frame_offsets(io.BytesIO(b''), 2)) == [0]
+
+
+def test_scan_frame_markers():
+    data = b'head\nITEM: A\n1\nITEM: A\n1\n2\n3\nx ITEM: A\nITEM: A\n4'
+    for chunk_size in (1, 3, 7, 1024):
+        offsets, n_lines = scan_frame_markers(io.BytesIO(data), b'ITEM: A', chunk_size=chunk_size)
+        assert list(offsets) == [5, 15, 39, len(data)]
+        assert list(n_lines) == [2, 5, 2]
+
+    offsets, n_lines = scan_frame_markers(io.BytesIO(b''), b'ITEM: A')
+    assert list(offsets) == [0]
+    assert list(n_lines) == []
+
+
+def test_frame_index_cache():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'traj.gro')
+    shutil.copy(cwd + '/files/100-SPCE.gro', tmp)
+
+    # small trajectory file is not cached
+    trj = Trajectory(tmp)
+    trj.close()
+    assert not os.path.exists(tmp + '.mstkidx')
+
+    index = FrameIndex.load(tmp)
+    assert index is None
+    index = FrameIndex(300, [0, 10, 20], steps=[0, 100])
+    assert index.save(tmp, force=True)
+    assert os.path.exists(tmp + '.mstkidx')
+
+    index = FrameIndex.load(tmp)
+    assert index.n_atom == 300
+    assert index.n_frame == 2
+    assert list(index.offsets) == [0, 10, 20]
+    assert list(index.steps) == [0, 100]
+    assert index.times is None
+
+    # the index saved in sidecar file is used
+    trj = Trajectory(tmp)
+    assert list(trj._handler._frame_offset) == [0, 10, 20]
+    trj.close()
+
+    # stale sidecar file is ignored
+    with open(tmp, 'ab') as f:
+        f.write(b'\n')
+    assert FrameIndex.load(tmp) is None
+    trj = Trajectory(tmp)
+    assert trj.n_frame == 2
+    assert trj._handler._frame_offset[1] == 20780
+    trj.close()
+
+    shutil.rmtree(tmpdir)
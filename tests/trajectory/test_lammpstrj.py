@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import tempfile
+import shutil
 import pytest
-from mstk.trajectory import Trajectory
+from mstk.topology import Topology
+from mstk.trajectory import Trajectory, Frame
 
 import os
 
@@ -23,3 +26,86 @@ def test_read():
     assert frame.cell.is_rectangular
     assert pytest.approx(frame.cell.get_size(), abs=1E-6) == [3.0004316] * 3
     assert pytest.approx(frame.positions[-1], abs=1E-6) == [2.11148, 0.241373, 0.664092]
+
+
+def test_read_scaled_wrapped():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'scaled.lammpstrj')
+    with open(tmp, 'w') as f:
+        f.write('ITEM: TIMESTEP\n100\nITEM: NUMBER OF ATOMS\n3\nITEM: BOX BOUNDS pp pp pp\n'
+                '-10 10\n-10 10\n0 20\nITEM: ATOMS id type element xs ys zs ix iy iz\n'
+                '3 1 C 0.5 0.5 0.5 0 0 0\n'
+                '1 1 C 0.1 0.2 0.3 1 0 -1\n'
+                '2 1 C 0.9 0.8 0.7 0 -1 0\n')
+
+    trj = Trajectory.open(tmp)
+    assert trj.n_atom == 3
+    assert trj.n_frame == 1
+
+    frame = trj.read_frame(0)
+    assert frame.step == 100
+    assert frame.has_charge == False
+    assert pytest.approx(frame.positions, abs=1E-6) == [[1.2, -0.6, -1.4], [0.8, -1.4, 1.4], [0, 0, 1]]
+    trj.close()
+
+    shutil.rmtree(tmpdir)
+
+
+def test_write():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'out.lammpstrj')
+    top = Topology.open(cwd + '/files/100-SPCE.psf')
+    gro = Trajectory(cwd + '/files/100-SPCE.gro')
+    frame = gro.read_frame(0)
+    positions = frame.positions.copy()
+
+    trj = Trajectory(tmp, 'w')
+    trj.write_frame(frame, top)
+    trj.write_frame(frame, top, write_image=True)
+    trj.close()
+
+    trj = Trajectory(tmp)
+    assert trj.n_atom == 300
+    assert trj.n_frame == 2
+    for i in range(2):
+        frame = trj.read_frame(i)
+        assert frame.has_charge
+        assert pytest.approx(frame.charges[:3], abs=1E-6) == [atom.charge for atom in top.atoms[:3]]
+        assert pytest.approx(frame.positions, abs=1E-5) == positions
+    trj.close()
+    gro.close()
+
+    shutil.rmtree(tmpdir)
+
+
+def test_variable_n_atom():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'gcmc.lammpstrj')
+    frame = Frame(3)
+    frame.cell.set_box([2, 2, 2])
+    frame.positions = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+
+    trj = Trajectory(tmp, 'w')
+    for n_atom in (3, 1, 2):
+        frame.resize(n_atom)
+        trj.write_frame(frame)
+    trj.close()
+    # incomplete frame at the end is ignored
+    with open(tmp, 'a') as f:
+        f.write('ITEM: TIMESTEP\n0\nITEM: NUMBER OF ATOMS\n3\n')
+
+    trj = Trajectory(tmp)
+    assert trj.n_atom == 3
+    assert trj.n_frame == 3
+    assert trj.read_frame(1).n_atom == 1
+    assert trj.read_frame(2).n_atom == 2
+    frame = trj.read_frame(0)
+    assert frame.n_atom == 3
+    assert frame.has_charge == False
+    assert pytest.approx(frame.positions, abs=1E-6) == [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+    assert [f.n_atom for f in trj.iter_frames()] == [3, 1, 2]
+    with pytest.raises(Exception):
+        trj.read_positions([0, 1])
+    trj.close()
+
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import pytest
+import shutil
+import numpy as np
+from mstk.trajectory import Trajectory
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_write_read():
+    tmpdir = tempfile.mkdtemp()
+
+    gro = Trajectory.open(cwd + '/files/100-SPCE.gro')
+    tmp = os.path.join(tmpdir, 'gro-out.mtrj')
+    mtrj = Trajectory.open(tmp, 'w')
+    for i in range(gro.n_frame):
+        frame = gro.read_frame(i)
+        mtrj.write_frame(frame, write_velocity=True)
+    mtrj.close()
+    assert os.path.getsize(tmp) == 64 + gro.n_frame * (8 + 8 + 72 + 300 * 3 * 4 * 2)
+
+    mtrj = Trajectory.open(tmp)
+    assert mtrj.n_atom == 300
+    assert mtrj.n_frame == 2
+
+    frame = mtrj.read_frame(1)
+    assert frame.has_velocity == True
+    assert frame.has_charge == False
+    assert pytest.approx(frame.positions[0], abs=1E-6) == gro.read_frame(1).positions[0]
+    assert pytest.approx(frame.velocities[-1], abs=1E-6) == [-1.0323, 0.5604, -0.3797]
+    assert pytest.approx(frame.cell.get_size(), abs=1E-6) == [3.00906, 3.00906, 3.00906]
+
+    positions, boxes, steps, times = mtrj.read_positions([1, 0], atoms=[299, 0])
+    assert positions.shape == (2, 2, 3)
+    assert pytest.approx(positions[0, 0], abs=1E-6) == gro.read_frame(1).positions[299]
+    assert pytest.approx(positions[1, 1], abs=1E-6) == gro.read_frame(0).positions[0]
+    mtrj.close()
+
+    shutil.rmtree(tmpdir)
+
+
+def test_append():
+    tmpdir = tempfile.mkdtemp()
+
+    lammps = Trajectory.open(cwd + '/files/100HOH.lammpstrj')
+    tmp = os.path.join(tmpdir, 'lammps-out.mtrj')
+    mtrj = Trajectory.open(tmp, 'w')
+    mtrj.write_frame(lammps.read_frame(0), write_charge=True, dtype=np.float64)
+    mtrj.close()
+    mtrj = Trajectory.open(tmp, 'a')
+    mtrj.write_frame(lammps.read_frame(1), write_charge=True)
+    mtrj.close()
+
+    mtrj = Trajectory.open(tmp)
+    assert mtrj.n_frame == 2
+    frame = mtrj.read_frame(1)
+    assert frame.step == lammps.read_frame(1).step
+    assert frame.has_charge == True
+    assert pytest.approx(frame.charges[:4], abs=1E-12) == [0.4238, -0.8476, 0.4238, 0.4238]
+    assert pytest.approx(frame.positions, abs=1E-12) == lammps.read_frame(1).positions
+    mtrj.close()
+
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import operator
+import pytest
+import numpy as np
+from mstk.trajectory import Trajectory
+
+import os
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_iter_frames():
+    trj = Trajectory(cwd + '/files/100-SPCE.xtc')
+    for prefetch in (0, 1, 3):
+        steps = [frame.step for frame in trj.iter_frames(prefetch=prefetch)]
+        assert steps == [0, 1000, 2000, 3000]
+
+        steps = [frame.step for frame in trj.iter_frames(-3, step=2, prefetch=prefetch)]
+        assert steps == [1000, 3000]
+
+        for frame in trj.iter_frames(1, 3, prefetch=prefetch):
+            assert pytest.approx(frame.positions[0], abs=1E-4) == [1.335, 1.775, 1.818]
+            break
+
+    # reading frames is allowed after the iteration is stopped
+    frame = trj.read_frame(2)
+    assert pytest.approx(frame.positions[-1], abs=1E-4) == [2.529, 0.136, 1.780]
+    trj.close()
+
+
+def test_read_concurrent():
+    for file in ('100-SPCE.gro', '100-SPCE.xtc', '100-SPCE.xyz', '100-SPCE.dcd', '100HOH.lammpstrj'):
+        trj = Trajectory(cwd + '/files/' + file)
+        positions = [frame.positions.copy() for frame in trj.iter_frames(prefetch=0)]
+        i_frames = list(range(trj.n_frame)) * 4
+
+        frames = trj.read_frames(i_frames, n_thread=4)
+        for i_frame, frame in zip(i_frames, frames):
+            assert pytest.approx(frame.positions, abs=1E-6) == positions[i_frame]
+
+        for prefetch, n_thread in [(1, 1), (3, 2), (4, 4)]:
+            for i_frame, frame in enumerate(trj.iter_frames(prefetch=prefetch, n_thread=n_thread)):
+                assert pytest.approx(frame.positions, abs=1E-6) == positions[i_frame]
+        trj.close()
+
+
+def _get_step(frame):
+    return frame.step
+
+
+def _get_center(frame):
+    return frame.positions.mean(axis=0)
+
+
+def test_map():
+    trj = Trajectory([cwd + '/files/100-SPCE.xtc', cwd + '/files/100-SPCE.dcd'])
+    assert trj.map(_get_step, n_workers=2) == [0, 1000, 2000, 3000, 1000, 2000, 3000]
+    assert trj.map(_get_step, [6, 0, -1], n_workers=1) == [3000, 0, 3000]
+    assert trj.map(_get_step, n_workers=3, reduce=operator.add) == 12000
+
+    centers = trj.map(_get_center, n_workers=2, reduce=operator.add)
+    assert pytest.approx(centers, abs=1E-6) == sum(_get_center(trj.read_frame(i)) for i in range(trj.n_frame))
+    trj.close()
+
+
+def test_read_positions():
+    trj = Trajectory([cwd + '/files/100-SPCE.gro', cwd + '/files/100HOH.lammpstrj', cwd + '/files/100-SPCE.dcd'])
+    positions, boxes, steps, times, velocities, charges = trj.read_positions([8, 0, 3, 1], atoms=[0, 299],
+                                                                             velocities=True, charges=True)
+    assert positions.shape == (4, 2, 3)
+    assert positions.dtype == np.float32
+    assert velocities.shape == (4, 2, 3)
+    assert charges.shape == (4, 2)
+    assert list(steps) == [3000, -1, 10, -1]
+    assert pytest.approx(boxes[0], abs=1E-6) == np.diag([2.983427] * 3)
+    assert pytest.approx(positions[1][0], abs=1E-6) == [1.283, 1.791, 1.658]
+    assert pytest.approx(positions[0][-1], abs=1E-6) == [2.545774, 2.661569, 1.707037]
+    assert pytest.approx(velocities[3][-1], abs=1E-6) == [-1.0323, 0.5604, -0.3797]
+    assert pytest.approx(velocities[0], abs=1E-6) == 0
+    assert pytest.approx(charges[2], abs=1E-6) == [0.4238, 0.4238]
+
+    positions, boxes, steps, times = trj.read_positions(range(trj.n_frame), dtype=float)
+    assert positions.shape == (9, 300, 3)
+    for i in range(trj.n_frame):
+        assert pytest.approx(positions[i], abs=1E-12) == trj.read_frame(i).positions
+    trj.close()
+
+
+def test_read_subset():
+    atoms = [299, 5, 0, 150]
+    for ext in ('gro', 'xyz', 'xtc', 'dcd', 'lammpstrj'):
+        file = cwd + ('/files/100HOH.lammpstrj' if ext == 'lammpstrj' else '/files/100-SPCE.' + ext)
+        trj = Trajectory(file)
+        trj_sub = Trajectory(file, atoms=atoms)
+        assert trj_sub.n_atom == 4
+        for i in range(trj.n_frame):
+            frame = trj.read_frame(i)
+            frame_sub = trj_sub.read_frame(i)
+            assert frame_sub.positions.shape == (4, 3)
+            assert pytest.approx(frame_sub.positions, abs=1E-12) == frame.positions[atoms]
+            assert frame_sub.step == frame.step
+            assert frame_sub.has_velocity == frame.has_velocity
+            if frame.has_velocity:
+                assert pytest.approx(frame_sub.velocities, abs=1E-12) == frame.velocities[atoms]
+            if frame.has_charge:
+                assert pytest.approx(frame_sub.charges, abs=1E-12) == frame.charges[atoms]
+            assert pytest.approx(frame_sub.cell.vectors, abs=1E-12) == frame.cell.vectors
+
+        frames = list(trj_sub.iter_frames())
+        assert frames[-1].positions.shape == (4, 3)
+        positions = trj_sub.read_positions([0], dtype=float)[0]
+        assert pytest.approx(positions[0], abs=1E-12) == trj.read_frame(0).positions[atoms]
+        trj.close()
+        trj_sub.close()
+
+    with pytest.raises(Exception):
+        Trajectory(cwd + '/files/100-SPCE.gro', atoms=[300])
+
+
+def test_read_metadata():
+    files = [cwd + '/files/100-SPCE.gro', cwd + '/files/100HOH.lammpstrj', cwd + '/files/100-SPCE.dcd',
+             cwd + '/files/100-SPCE.xtc', cwd + '/files/100-SPCE.xyz']
+    trj = Trajectory(files)
+    steps, times, boxes = trj.read_metadata()
+    assert steps.shape == (trj.n_frame,)
+    assert times.shape == (trj.n_frame,)
+    assert boxes.shape == (trj.n_frame, 3, 3)
+
+    # step and time in the title of GRO file
+    assert list(steps[:2]) == [-1, -1]
+    assert pytest.approx(times[:2], abs=1E-6) == [0, 1]
+    assert pytest.approx(boxes[1], abs=1E-6) == np.diag([3.00906] * 3)
+    # box is not recorded in XYZ file
+    assert pytest.approx(boxes[-4:], abs=1E-6) == 0
+
+    for i in range(2, trj.n_frame - 4):
+        frame = trj.read_frame(i)
+        assert steps[i] == frame.step
+        assert pytest.approx(times[i], abs=1E-6) == frame.time
+        assert pytest.approx(boxes[i], abs=1E-6) == frame.cell.vectors
+    trj.close()
+
+
+def test_frame_cache():
+    # each frame costs 300 * 7 * 8 bytes for positions, velocities and charges
+    trj = Trajectory(cwd + '/files/100-SPCE.xtc', cache_size=2 * 300 * 7 * 8 / 1024 / 1024)
+    frame0 = trj.read_frame(0)
+    frame1 = trj.read_frame(1)
+    assert frame0 is not frame1
+    assert trj.read_frame(0) is frame0
+    assert (trj.n_cache_hit, trj.n_cache_miss) == (1, 2)
+
+    # frame 1 is the least recently used one, and it is evicted
+    frame3 = trj.read_frame(-1)
+    assert frame3.step == 3000
+    assert trj.read_frame(0) is frame0
+    assert trj.read_frame(1) is not frame1
+    assert (trj.n_cache_hit, trj.n_cache_miss) == (2, 4)
+    assert pytest.approx(frame1.positions, abs=1E-6) == trj.read_frame(1).positions
+
+    with pytest.raises(ValueError):
+        frame0.positions[0] = [0, 0, 0]
+    trj.close()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from mstk.topology import Topology
+from mstk.trajectory import Trajectory, SetBox, Shift, Center, Wrap, MakeWhole
+
+import os
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_transform():
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    frame = trj.read_frame(0)
+    positions = frame.positions.copy()
+    box = frame.cell.get_size()
+
+    trj.add_transform(SetBox([None, 4.0, -1], scale=[2, 1, 1]), Shift([0.1, 0, 0]))
+    frame = trj.read_frame(0)
+    assert pytest.approx(frame.cell.get_size(), abs=1E-6) == [box[0] * 2, 4.0, box[2]]
+    assert pytest.approx(frame.positions, abs=1E-6) == positions + [0.1, 0, 0]
+
+    trj.add_transform(Center())
+    frame = trj.read_frame(0)
+    assert pytest.approx(frame.positions.mean(axis=0), abs=1E-6) == frame.cell.get_size() / 2
+
+    # the transformations are applied on the bulk read as well
+    _positions, boxes, steps, times = trj.read_positions([1, 0], dtype=float)
+    assert pytest.approx(_positions[1], abs=1E-6) == frame.positions
+    assert pytest.approx(boxes[1], abs=1E-6) == frame.cell.vectors
+    trj.close()
+
+
+def test_wrap():
+    top = Topology.open(cwd + '/files/100-SPCE.psf')
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    trj.add_transform(Shift([1.5, 0, 0]), Wrap())
+    frame = trj.read_frame(0)
+    box = frame.cell.get_size()
+    assert (frame.positions >= 0).all() and (frame.positions < box).all()
+
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    trj.add_transform(Shift([1.5, 0, 0]), Wrap(top))
+    frame = trj.read_frame(0)
+    for residue in top.residues:
+        ids = [atom.id for atom in residue.atoms]
+        center = frame.positions[ids].mean(axis=0)
+        assert (center >= 0).all() and (center < box).all()
+
+    # the translations determined from the first frame are reused
+    wrap = Wrap(top, first_only=True)
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    raw = [trj.read_frame(i).positions.copy() for i in range(trj.n_frame)]
+    trj.add_transform(wrap)
+    wrapped = [trj.read_frame(i).positions.copy() for i in range(trj.n_frame)]
+    shift = raw[0] - wrapped[0]
+    assert pytest.approx(raw[1] - wrapped[1], abs=1E-6) == shift / box * trj.read_frame(1).cell.get_size()
+    trj.close()
+
+
+def test_make_whole():
+    top = Topology.open(cwd + '/files/100-SPCE.psf')
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    # break the molecules by wrapping atoms individually
+    trj.add_transform(Shift([1.5, 1.5, 1.5]), Wrap(), MakeWhole(top))
+    for i in range(trj.n_frame):
+        frame = trj.read_frame(i)
+        for bond in top.bonds:
+            delta = frame.positions[bond.atom2.id] - frame.positions[bond.atom1.id]
+            assert np.sqrt(np.sum(delta ** 2)) < 0.11
+    trj.close()
+
+    # triclinic cell
+    trj = Trajectory(cwd + '/files/100-SPCE.gro')
+    frame = trj.read_frame(0)
+    vectors = frame.cell.vectors.copy()
+    vectors[1][0] = vectors[0][0] * 0.3
+    vectors[2][0] = vectors[0][0] * 0.2
+    vectors[2][1] = vectors[1][1] * 0.4
+    frame.cell.set_box(vectors)
+    positions = frame.positions.copy()
+    Wrap().apply(positions, frame.cell)
+    MakeWhole(top).apply(positions, frame.cell)
+    for bond in top.bonds:
+        delta = positions[bond.atom2.id] - positions[bond.atom1.id]
+        assert np.sqrt(np.sum(delta ** 2)) < 0.11
+    trj.close()
@@ -5,8 +5,9 @@ import tempfile
 import filecmp
 import pytest
 import shutil
+import numpy as np
 from mstk.topology import Topology
-from mstk.trajectory import Trajectory
+from mstk.trajectory import Trajectory, Xtc
 
 cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -25,16 +26,54 @@ def test_read():
     frame2, frame1 = xtc.read_frames([2, 1])
     assert pytest.approx(frame1.positions[0], abs=1E-4) == [1.335, 1.775, 1.818]
     assert pytest.approx(frame2.positions[-1], abs=1E-4) == [2.529, 0.136, 1.780]
+    assert frame2.step == 2000
+    assert pytest.approx(frame2.time, abs=1E-6) == 2.0
+    assert pytest.approx(frame2.cell.get_size(), abs=1E-6) == [3.0093882, 3.0093882, 3.0093882]
+
+
+def test_read_native():
+    xtc = Trajectory(cwd + '/files/100-SPCE.xtc', Handler=Xtc)
+    frame = xtc.read_frame(2)
+    assert pytest.approx(frame.positions[-1], abs=1E-4) == [2.529, 0.136, 1.780]
+    assert frame.step == 2000
+    assert pytest.approx(frame.time, abs=1E-6) == 2.0
+    xtc.close()
+
+
+def test_read_float32():
+    xtc = Trajectory(cwd + '/files/100-SPCE.xtc', dtype=np.float32)
+    frame = xtc.read_frame(3)
+    assert frame.positions.dtype == np.float32
+    assert frame.step == 3000
+    assert pytest.approx(frame.positions[-1], abs=1E-4) == [2.282, 0.011, 1.721]
 
 
 def test_write():
     tmpdir = tempfile.mkdtemp()
     gro = Trajectory.open(cwd + '/files/100-SPCE.gro')
     tmp = os.path.join(tmpdir, 'gro-out.xtc')
-    xtc = Trajectory.open(tmp, 'w')
+    # the baseline is written by the native encoder
+    xtc = Trajectory(tmp, 'w', Handler=Xtc)
     for i in range(gro.n_frame):
         frame = gro.read_frame(i)
         xtc.write_frame(frame)
     xtc.close()
     assert filecmp.cmp(tmp, cwd + '/files/baselines/gro-out.xtc')
+
+    # frames with less than 10 atoms are not compressed
+    tmp = os.path.join(tmpdir, 'small.xtc')
+    xtc = Trajectory.open(tmp, 'w')
+    for i in range(gro.n_frame):
+        frame = gro.read_frame(i)
+        frame.step = i * 10
+        xtc.write_frame(frame, subset=list(range(6)))
+    xtc.close()
+    xtc = Trajectory.open(tmp)
+    assert xtc.n_atom == 6
+    assert xtc.n_frame == 2
+    frame = xtc.read_frame(1)
+    assert frame.step == 10
+    assert pytest.approx(frame.positions, abs=1E-6) == gro.read_frame(1).positions[:6]
+    xtc.close()
+
     shutil.rmtree(tmpdir)
@@ -36,3 +36,22 @@ def test_write():
     assert filecmp.cmp(tmp, cwd + '/files/baselines/xtc-out.xyz')
 
     shutil.rmtree(tmpdir)
+
+
+def test_read_ragged():
+    tmpdir = tempfile.mkdtemp()
+    tmp = os.path.join(tmpdir, 'ragged.xyz')
+    # the lines are of different widths, but their total length equals four times the width of the first line
+    lines = ['C 1.0 1.0 1.0', 'C 2.0 2.0 2', 'Cl 9 30.0 3.0 3', 'C 4.0 4.0 4.0']
+    with open(tmp, 'w') as f:
+        for _ in range(2):
+            f.write('4\nragged\n' + '\n'.join(lines) + '\n')
+
+    positions = Trajectory.open(tmp).read_frame(1).positions.copy()
+    assert pytest.approx(positions[2], abs=1E-6) == [0.9, 3.0, 0.3]
+    for atoms in ([0], [1], [2], [3], [1, 2], [3, 0], [2, 3]):
+        trj = Trajectory(tmp, atoms=atoms)
+        assert pytest.approx(trj.read_frame(1).positions, abs=1E-6) == positions[atoms]
+        trj.close()
+
+    shutil.rmtree(tmpdir)